@@ -8,7 +8,7 @@ Interrogates and manipulates a CE Release Notes (seano) database.
 """
 
 from seano_cli.cmd import *
-from seano_cli.utils import SeanoFatalError
+from seano_cli.utils import SeanoFatalError, SeanoYamlLoader
 import argparse
 import logging
 import os
@@ -115,7 +115,10 @@ def main():
                                       'to identify the origin of the note, and with that knowledge, ' +
                                       'identify when an external database has *deleted* a note.  Thus, ' +
                                       'this command can (a) import new notes, (b) update modified notes, ' +
-                                      'and (c) delete deleted notes.')
+                                      'and (c) delete deleted notes.  A manifest of the imported notes ' +
+                                      'is kept in the extern-manifests folder of the local seano ' +
+                                      'database; commit it along with the imported notes, so that ' +
+                                      'external databases that did not change are skipped quickly.')
     subparser.set_defaults(func=import_from_submodules)
     add_db_args(subparser)
     subparser.add_argument('--dry-run', action='store_true', dest='is_dry_run', default=False,
@@ -123,6 +126,19 @@ def main():
     subparser.add_argument('--assert-no-change', action='store_true', default=False,
                            help='If the import made changes in the local database, or would have made ' +
                            'changes and --dry-run was specified, exit with a non-zero exit code.')
+    subparser.add_argument('--from-gitlink', action='store_true', default=False,
+                           help='Treat each path as a Git submodule, and import the notes in the commit recorded ' +
+                           'for the submodule in the index of the local repository, read straight out of the ' +
+                           'submodule\'s object database.  The submodule does not need to be checked out, and ' +
+                           'local changes in it are ignored.')
+    subparser.add_argument('--reference', action='store_true', dest='as_reference', default=False,
+                           help='Instead of a complete copy of each note, import a small reference to the original ' +
+                           '(its relative path and sha1).  The original is read from the extern database (or from a ' +
+                           'cache) whenever the note is loaded, so the extern database must be available to queries.')
+    subparser.add_argument('--note-cache', action='store_true', default=False,
+                           help='With --reference, also store the originals in the user cache directory, so that ' +
+                                'queries with --note-cache can resolve references while the extern database is not ' +
+                                'available')
     subparser.add_argument(nargs='+', dest='db_defs', type=repo_spec, help='Accumulator')
 
     subparser = subparsers.add_parser('ghost', help='Mark certain notes as ghosts',
@@ -145,6 +161,38 @@ def main():
                            'note ID, or it may be a commit ID or range in the underlying repository, from '
                            'which we auto-detect added notes.')
 
+    subparser = subparsers.add_parser('convert', help='Converts notes between the Yaml and Json note formats',
+                                      description='Converts notes between the Yaml and Json note formats.  Json ' +
+                                      'notes have the same schema as Yaml notes, and are much faster to load, ' +
+                                      'but are less pleasant to edit by hand.  Notes keep their note ID.  Yaml notes ' +
+                                      'are only converted when Json can represent them exactly, and comments in ' +
+                                      'Yaml notes are not carried over.')
+    subparser.set_defaults(func=convert_notes)
+    add_db_args(subparser)
+    subparser.add_argument('--dry-run', action='store_true', dest='is_dry_run', default=False,
+                           help='Describe modifications that would be made, and do not modify any files on disk')
+    subparser.add_argument('--to', dest='to_format', choices=['json', 'yaml'], default='json',
+                           help='The note format to convert to.  Defaults to `%(default)s`.')
+    subparser.add_argument('patterns', metavar='PATTERN', nargs='*', default=[],
+                           help='Only convert notes matching a pattern.  The pattern may be the beginning of a note ' +
+                           'ID, or it may be a commit ID or range in the underlying repository, from which we ' +
+                           'auto-detect added notes.  By default, all notes are converted, except extern notes.')
+
+    subparser = subparsers.add_parser('pack', help='Packs old notes into one file per release',
+                                      description='Moves the notes that only belong to releases older than the ' +
+                                      'given release (its ancestors) out of their own note files, and into one ' +
+                                      'pack file per release, inside the `packs` folder of the database.  Packed ' +
+                                      'notes keep their note ID, contents and releases, and are read straight out ' +
+                                      'of the pack files by queries, so databases with many notes need far fewer ' +
+                                      'files.  Packed notes can no longer be edited.  Extern notes and ghost notes ' +
+                                      'are never packed.')
+    subparser.set_defaults(func=pack_notes)
+    add_db_args(subparser)
+    subparser.add_argument('--dry-run', action='store_true', dest='is_dry_run', default=False,
+                           help='Describe modifications that would be made, and do not modify any files on disk')
+    subparser.add_argument('--before', metavar='RELEASE', dest='before_release', required=True,
+                           help='Pack the notes that only belong to releases older than this release')
+
     subparser = subparsers.add_parser('hash', help='Returns an arbitrary string that changes with all database '+
                                       'modifications; used by build systems to properly support incremental builds')
     subparser.set_defaults(func=hash_release_notes_db)
@@ -164,7 +212,48 @@ def main():
     subparser = subparsers.add_parser('query', help='Compiles release notes from the given database')
     subparser.set_defaults(func=query_release_notes)
     add_db_args(subparser, True)
-    subparser.add_argument('--out', action='store', required=True, help='Output file; use a single hyphen for stdout')
+    subparser.add_argument('--out', action='store', help='Output file; use a single hyphen for stdout')
+    subparser.add_argument('--normalized', action='store_true', default=False,
+                           help='Instead of copying every note into every release that contains it, store each note ' +
+                                'once in a top-level `notes` table keyed by note ID, and list only note references ' +
+                                '(the note ID plus flags such as `is-copied-from-backstory`) in each release')
+    subparser.add_argument('--fields', metavar='KEY[,KEY...]', dest='note_fields', default=None,
+                           type=lambda value: [x.strip() for x in value.split(',') if x.strip()],
+                           help='Only load and output these keys of each note (`id`, `commits`, and `releases` are ' +
+                                'always included).  Overrides `query_note_fields` in the seano config.')
+    subparser.add_argument('--where', metavar='EXPR', action='append', dest='note_filters', default=[],
+                           help='Only include notes matching this filter; may be repeated (all filters must match).  ' +
+                                'EXPR is one of `key`, `!key`, `key=value`, or `key!=value`; a list-valued key ' +
+                                'matches when any of its items equals the value.  Filters on ' +
+                                '`x-seano-extern-identifier` are applied before opening any note files.')
+    subparser.add_argument('--since-release', metavar='NAME',
+                           help='Only include this release, the releases newer than it, and their notes.  With a ' +
+                                'Git-backed database, the commit graph is only scanned as far back as needed.')
+    subparser.add_argument('--max-releases', metavar='N', type=int,
+                           help='Only include the N most recent releases, and their notes.  With a Git-backed ' +
+                                'database, the commit graph is read in full to sort releases, but file changes are ' +
+                                'only scanned as far back as needed.')
+    subparser.add_argument('--ancestor-closure', action='store_true', default=False,
+                           help='Add an `ancestor-closure` key to each release: a hexadecimal bitmask in which bit N ' +
+                                'is set when the release at index N of `releases` is an ancestor of this release')
+    subparser.add_argument('--jobs', '-j', metavar='N', type=int, default=1,
+                           help='Parse note files using N processes.  The query result is identical; only the time ' +
+                                'it takes changes.  Defaults to %(default)s.')
+    subparser.add_argument('--note-cache', action='store_true', default=False,
+                           help='Re-use notes parsed by previous queries (cached in the user cache directory, or in ' +
+                                'the Git directory) when the note file is unchanged, instead of parsing every note file')
+    subparser.add_argument('--snapshot', nargs=3, metavar=('REF', 'VERSION', 'OUT'), action='append',
+                           dest='snapshots', default=[],
+                           help='Also write the query result as of the given Git ref (such as a release tag), with ' +
+                                '`current_version` set to VERSION, into the file OUT; may be repeated.  All snapshots ' +
+                                'share one read of the commit graph, and each version of each note is only parsed once.')
+
+    subparser = subparsers.add_parser('where', help='Lists the releases that contain a single note')
+    subparser.set_defaults(func=where_release_note)
+    add_db_args(subparser)
+    subparser.add_argument('pattern', metavar='PATTERN',
+                           help='The note ID, or the beginning of a note ID, of the note to look up.  Only the ' +
+                                'part of the history that is newer than the note is scanned.')
 
     subparser = subparsers.add_parser('print-note-template', help='Print the default note template to stdout')
     add_db_args(subparser)
@@ -191,6 +280,7 @@ def main():
             min(max(ns.verbose, 0), 2)
         ))
 
+    log.info('Using Yaml loader: %s', SeanoYamlLoader.__name__)
     log.debug('Arguments: %s', ns)
 
     kwargs = dict(vars(ns))
@@ -1,3 +1,4 @@
+from .convert_notes import convert_notes
 from .edit_note import edit_latest_release_note
 from .format_query_output import format_query_output, list_public_formatters
 from .hash_repo import hash_release_notes_db
@@ -6,4 +7,6 @@ from .init_note import make_new_release_notes, print_note_template
 from .init_repo import make_new_release_notes_db
 from .list_notes import list_latest_release_notes
 from .mark_as_ghost import mark_as_ghost
+from .pack_notes import pack_notes
 from .query_repo import query_release_notes
+from .where_note import where_release_note
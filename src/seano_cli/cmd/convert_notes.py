@@ -0,0 +1,43 @@
+"""
+seano_cli/cmd/convert_notes.py
+
+Interactive command-line wrapper on top of the infrastructure that converts
+notes between the Yaml and Json note file formats.
+"""
+
+from seano_cli.db import *
+from seano_cli.utils import *
+
+log = logging.getLogger(__name__)
+
+
+def convert_notes(db_search_seed_path, is_dry_run, to_format, patterns):
+    db = find_and_open_seano_database(db_search_seed_path)
+    files = []
+    for pattern in patterns:
+        new_files, errors = db.get_notes_matching_pattern(pattern, include_modified=True)
+        if not new_files:
+            raise SeanoFatalError('Unable to resolve pattern:\n    %s' % ('\n    '.join(errors),))
+        log.debug("Pattern '%s' yielded:\n    %s", pattern, "\n    ".join(new_files))
+        files.extend(new_files)
+
+    if not patterns:
+        # Convert the entire database (except extern notes, which are re-created by `seano import`):
+        files = [x.path for x in db.get_note_index().entries if x.extern_id is None]
+
+    files = sorted(set(files))
+    log.debug("About to convert:\n    %s", "\n    ".join(files))
+
+    path_info = db.convert_notes(files, to_format=to_format, is_dry_run=is_dry_run)
+
+    if path_info:
+        sys.stderr.write('\n'.join([
+            'The following paths were updated:',
+            '',
+            ] + ['    %s  %s' % (s, os.path.relpath(p)) for s, p in path_info] + [
+            '',
+            'Please review the changes and commit them.',
+            '',
+        ]))
+    else:
+        sys.stderr.write('No changes were made to any selected notes\n')
@@ -32,5 +32,8 @@ def edit_latest_release_note(db_search_seed_path, include_wip, include_modified,
     if not files:
         raise SeanoFatalError("Release notes database is empty")
     files = sorted(set(files))
+    packed = [db.extract_uid_from_filename(f) for f in files if f in db.get_note_pack().by_path]
+    if packed:
+        raise SeanoFatalError('Unable to edit packed notes (see `seano pack`):\n    %s' % ('\n    '.join(packed),))
     log.debug("About to edit:\n    %s", "\n    ".join(files))
     edit_files(files)
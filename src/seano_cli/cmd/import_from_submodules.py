@@ -12,14 +12,19 @@ import os
 import sys
 
 
-def import_from_submodules(db_search_seed_path, is_dry_run, assert_no_change, db_defs):
+def import_from_submodules(db_search_seed_path, is_dry_run, assert_no_change, db_defs, from_gitlink=False,
+                           as_reference=False, note_cache=False):
     db = find_and_open_seano_database(db_search_seed_path)
 
     # Check for overlapping databases:
     # ABK: Yes, db.import_extern_notes() does check this as well...  but
     #      we are in a better position to provide a good error message.
 
-    db_defs = [(id, seed_path, find_seano_database(seed_path)) for id, seed_path in db_defs]
+    if from_gitlink:
+        # Submodules need not be checked out; the database is located inside the gitlink commit later on:
+        db_defs = [(id, seed_path, os.path.abspath(seed_path)) for id, seed_path in db_defs]
+    else:
+        db_defs = [(id, seed_path, find_seano_database(seed_path)) for id, seed_path in db_defs]
 
     if len(set([db.path] + [db_path for _, _, db_path in db_defs])) != len(db_defs) + 1:
         raise SeanoFatalError('\n'.join([
@@ -49,7 +54,8 @@ def import_from_submodules(db_search_seed_path, is_dry_run, assert_no_change, db
 
     db_defs = [(id, db_path) for id, _, db_path in db_defs]
 
-    path_info = db.import_extern_notes(is_dry_run=is_dry_run, db_defs=db_defs)
+    path_info = db.import_extern_notes(is_dry_run=is_dry_run, db_defs=db_defs, from_gitlink=from_gitlink,
+                                       as_reference=as_reference, note_cache=note_cache)
 
     if path_info:
         sys.stderr.write('\n'.join([
@@ -0,0 +1,29 @@
+"""
+seano_cli/cmd/pack_notes.py
+
+Interactive command-line wrapper on top of the infrastructure that packs
+old notes into per-release pack files.
+"""
+
+from seano_cli.db import *
+from seano_cli.utils import *
+
+log = logging.getLogger(__name__)
+
+
+def pack_notes(db_search_seed_path, is_dry_run, before_release):
+    db = find_and_open_seano_database(db_search_seed_path)
+
+    path_info = db.pack_notes(before_release=before_release, is_dry_run=is_dry_run)
+
+    if path_info:
+        sys.stderr.write('\n'.join([
+            'The following paths were updated:',
+            '',
+            ] + ['    %s  %s' % (s, os.path.relpath(p)) for s, p in path_info] + [
+            '',
+            'Please review the changes and commit them.',
+            '',
+        ]))
+    else:
+        sys.stderr.write('No notes belong only to releases before %s\n' % (before_release,))
@@ -10,21 +10,66 @@ import json
 
 log = logging.getLogger(__name__)
 
+# Stand-in value for the releases list while serializing everything else in a query result:
+_RELEASES_PLACEHOLDER = '\0seano-releases-placeholder\0'
 
-def query_release_notes(db_search_seed_path, out, **db_kwargs):
-    if not out:
-        raise SeanoFatalError("Invalid desitnation file: (empty string)")
 
-    data = find_and_open_seano_database(db_search_seed_path, **db_kwargs).query()
-    data = json.dumps(data, sort_keys=True)
+def write_query_output(f, data):
+    '''
+    Serializes the given query result as Json into the given stream.
+
+    The `releases` member may be any iterable (such as the generator returned by ``query(stream_releases=True)``);
+    releases are serialized and written one at a time, so that no more than one release is held in memory at once.
+    The bytes written are identical to ``json.dumps(data, sort_keys=True)``.
+    '''
+    releases = data['releases']
+    data = dict(data)
+    data['releases'] = _RELEASES_PLACEHOLDER
+    head, _, tail = json.dumps(data, sort_keys=True).partition(json.dumps(_RELEASES_PLACEHOLDER))
+
+    f.write(coerce_to_str(head))
+    f.write('[')
+    for idx, release in enumerate(releases):
+        if idx:
+            f.write(', ')
+        f.write(coerce_to_str(json.dumps(release, sort_keys=True)))
+    f.write(']')
+    f.write(coerce_to_str(tail))
+    f.write('\n')
 
-    if sys.hexversion < 0x3000000:
-        data = data.encode('utf-8')
 
+def write_query_output_to(out, data):
     if out in ['-']:
-        print(data)
+        write_query_output(sys.stdout, data)
         return
 
     with open(out, 'w', **FILE_ENCODING_KWARGS) as f:
-        f.write(data)
-        f.write('\n')
+        write_query_output(f, data)
+
+
+def query_release_notes(db_search_seed_path, out, normalized=False, note_fields=None, note_filters=None,
+                        since_release=None, max_releases=None, ancestor_closure=False, snapshots=None, jobs=1,
+                        note_cache=False, **db_kwargs):
+    if not out and not snapshots:
+        raise SeanoFatalError("Invalid desitnation file: (empty string)")
+    if max_releases is not None and max_releases < 1:
+        raise SeanoFatalError("Invalid maximum number of releases: %d" % (max_releases,))
+    if jobs < 1:
+        raise SeanoFatalError("Invalid number of jobs: %d" % (jobs,))
+    query_kwargs = dict(stream_releases=True, normalized=normalized, note_fields=note_fields,
+                        note_filters=note_filters, since_release=since_release, max_releases=max_releases,
+                        ancestor_closure=ancestor_closure)
+
+    db = find_and_open_seano_database(db_search_seed_path, **db_kwargs)
+
+    if snapshots:
+        for path in [x[2] for x in snapshots]:
+            if not path:
+                raise SeanoFatalError("Invalid desitnation file: (empty string)")
+        results = db.query_snapshots([(ref, version) for ref, version, _ in snapshots], jobs=jobs,
+                                     note_cache=note_cache, **query_kwargs)
+        for (_, _, path), data in zip(snapshots, results):
+            write_query_output_to(path, data)
+
+    if out:
+        write_query_output_to(out, db.query(jobs=jobs, note_cache=note_cache, **query_kwargs))
@@ -0,0 +1,26 @@
+"""
+seano_cli/cmd/where_note.py
+
+Interactive command-line wrapper on top of the infrastructure that lists the releases containing a single note.
+"""
+
+from seano_cli.db import *
+from seano_cli.utils import *
+
+log = logging.getLogger(__name__)
+
+
+def where_release_note(db_search_seed_path, pattern):
+    db = find_and_open_seano_database(db_search_seed_path)
+    files, errors = db.get_notes_matching_id_prefix(pattern)
+    if not files:
+        raise SeanoFatalError('Unable to resolve pattern:\n    %s' % ('\n    '.join(errors),))
+    if len(files) > 1:
+        raise SeanoFatalError('Pattern %s is ambiguous; it matches these notes:\n    %s'
+                              % (pattern, '\n    '.join(sorted([db.extract_uid_from_filename(f) for f in files]))))
+    uid = db.extract_uid_from_filename(files[0])
+    releases = db.find_note_releases(files[0])
+    if not releases:
+        raise SeanoFatalError('Note %s is a ghost; it does not show up in any release' % (uid,))
+    for name, is_copied_from_backstory in releases:
+        print(name + (' (copied from backstory)' if is_copied_from_backstory else ''))
@@ -144,8 +144,13 @@ releases:
 '''
 
 SEANO_DB_SUBDIR = 'v1'
+SEANO_DB_PACK_SUBDIR = 'packs'  # See `seano pack`
+SEANO_DB_EXTERN_MANIFEST_SUBDIR = 'extern-manifests'  # See `seano import`
+SEANO_NOTE_PACK_EXTENSION = '.jsonl'
 SEANO_EXTERN_NOTE_EXTENSION_PREFIX = '.extern-'
 SEANO_NOTE_EXTENSION = '.yaml'
+SEANO_JSON_NOTE_EXTENSION = '.json'  # Same schema as Yaml notes; much faster to parse
+SEANO_NOTE_EXTENSIONS = (SEANO_NOTE_EXTENSION, SEANO_JSON_NOTE_EXTENSION)
 SEANO_NOTE_DEFAULT_TEMPLATE_CONTENTS = '''---
 risk: One of low, medium, high; does not reflect deployment tricks to lower risk
 
@@ -272,3 +277,4 @@ qa-technical-loc-md:
 SEANO_NOTE_KEY_RELPATH_TO_ORIGINAL_NOTE = 'x-seano-relpath-to-original'
 SEANO_NOTE_KEY_SHA1_OF_ORIGINAL_NOTE = 'x-seano-sha1-of-original'
 SEANO_NOTE_KEY_IS_GHOST = 'x-seano-is-ghost'
+SEANO_NOTE_KEY_IS_EXTERN_REFERENCE = 'x-seano-extern-reference'
@@ -4,11 +4,17 @@ seano_cli/db/common.py
 Organizes a set of release notes, does some sanity checking, and serializes as Json
 """
 
-from seano_cli.constants import SEANO_NOTE_KEY_IS_GHOST
-from seano_cli.db.release_sorting import sorted_release_names_from_releases
+from seano_cli.constants import SEANO_JSON_NOTE_EXTENSION, SEANO_NOTE_KEY_IS_EXTERN_REFERENCE, SEANO_NOTE_KEY_IS_GHOST
+from seano_cli.db.note_filter import parse_note_filters
+from seano_cli.db.release_sorting import get_reachability_closures, sorted_release_names_from_releases
 from seano_cli.db.schema_upgrade import upgrade_note_schema, upgrade_release_schema
-from seano_cli.utils import FILE_ENCODING_KWARGS, SeanoFatalError, list_if_not_already, ascii_str_type, unicode_str_type
+from seano_cli.utils import FILE_ENCODING_KWARGS, SeanoFatalError, list_if_not_already, ascii_str_type, unicode_str_type, \
+                            intern_str, SeanoYamlLoader
+import bisect
+import io
+import json
 import logging
+import multiprocessing
 import os
 import re
 import sys
@@ -17,6 +23,16 @@ import yaml
 log = logging.getLogger(__name__)
 
 
+# Note keys that are always kept, even when the caller asked for only some of the keys of each note:
+STRUCTURAL_NOTE_KEYS = frozenset(['id', 'commits', 'releases'])
+
+# Note keys that are always loaded, because they influence the query result, but are only output if requested:
+BEHAVIORAL_NOTE_KEYS = frozenset(['relative-sort-string', SEANO_NOTE_KEY_IS_GHOST])
+
+# Note keys whose value accumulates while automatic attributes are imported (such as while a Git history is scanned):
+AUTOMATIC_NOTE_KEYS = frozenset(['commits', 'releases'])
+
+
 class AttemptToLoadGhostNote(Exception):
     pass
 
@@ -26,6 +42,9 @@ def structure_deep_copy(src, key_filter=lambda _: True):
         return [structure_deep_copy(x, key_filter=key_filter) for x in src]
     if isinstance(src, set):
         return set([structure_deep_copy(x, key_filter=key_filter) for x in src])
+    if isinstance(src, frozenset):
+        # Immutable, and only ever contains immutable strings; safe to share instead of copying.
+        return src
     if isinstance(src, dict):
         return {k: structure_deep_copy(v, key_filter=key_filter) for k, v in src.items() if key_filter(k)}
     if isinstance(src, ascii_str_type):
@@ -37,8 +56,144 @@ def structure_deep_copy(src, key_filter=lambda _: True):
     raise SeanoFatalError('structure_deep_copy: unsupported value of type %s: %s' % (type(src).__name__, src))
 
 
+def is_json_note_file(filename):
+    'Returns True if the given note file is a Json note (a single Json object), rather than a Yaml note.'
+    return filename.endswith(SEANO_JSON_NOTE_EXTENSION)
+
+
+def load_note_stream(f, is_json=False):
+    '''
+    Returns the list of Yaml documents in the given note file stream.  Json notes contain a single document.
+    '''
+    if is_json:
+        return [json.load(f)]
+    return list(yaml.load_all(f, Loader=SeanoYamlLoader))
+
+
+def load_note_file(filename):
+    'Returns the list of Yaml documents in the given note file.'
+    with open(filename, 'r', **FILE_ENCODING_KWARGS) as f:
+        return load_note_stream(f, is_json=is_json_note_file(filename))
+
+
+def iter_note_file(filename):
+    'Yields the Yaml documents in the given note file, parsing each one only when it is requested.'
+    if is_json_note_file(filename):
+        for d in load_note_file(filename):
+            yield d
+        return
+    with open(filename, 'r', **FILE_ENCODING_KWARGS) as f:
+        for d in yaml.load_all(f, Loader=SeanoYamlLoader):
+            yield d
+
+
+_yaml_document_marker_regex = re.compile(r'^(---|\.\.\.)(\s|$)')
+def load_note_metadata(filename):
+    '''
+    Returns the first non-empty Yaml document in the given note file, or None if there is none.
+
+    This is where seano keeps its own metadata about a note (such as x-seano-is-ghost, and the origin of notes
+    imported from extern databases).  Only the lines up to the end of that document are read and parsed; the rest of
+    the note (usually the vast majority of it) is never looked at.
+
+    Json notes contain a single document, which is returned in full.
+    '''
+    if is_json_note_file(filename):
+        return load_note_file(filename)[0] or None
+    with open(filename, 'r', **FILE_ENCODING_KWARGS) as f:
+        lines = []
+        for line in f:
+            if lines and not lines[-1].startswith('%') and _yaml_document_marker_regex.match(line):
+                # Document markers at column zero always end the current document, even inside a block scalar:
+                d = yaml.load(''.join(lines), Loader=SeanoYamlLoader)
+                if d:
+                    return d
+                lines = []
+                if line.startswith('...'):
+                    continue
+            lines.append(line)
+        return yaml.load(''.join(lines), Loader=SeanoYamlLoader) or None
+
+
+_releases_key_regex = re.compile(r'releases["\']?\s*:')
+def may_override_releases(filename):
+    '''
+    Returns False if the given note file certainly does not set its own releases (which override the releases the
+    note is automatically attributed to).  Only the raw text is searched, which is much cheaper than parsing the note.
+    '''
+    with open(filename, 'r', **FILE_ENCODING_KWARGS) as f:
+        data = f.read()
+    # (The contents of reference-style extern notes are elsewhere; see iter_resolved_note_documents())
+    return bool(_releases_key_regex.search(data)) or SEANO_NOTE_KEY_IS_EXTERN_REFERENCE in data
+
+
+def note_sets_own_releases(filename):
+    '''
+    Returns whether the given note file sets its own releases.  Unlike may_override_releases(), the note is parsed.
+    Reference-style extern notes (whose contents are elsewhere) and notes that fail to parse (whose errors are reported
+    when they are imported) are assumed to set their own releases.
+    '''
+    try:
+        documents = load_note_file(filename)
+    except Exception:
+        return True
+    return any([isinstance(d, dict) and ('releases' in d or d.get(SEANO_NOTE_KEY_IS_EXTERN_REFERENCE, False))
+                for d in documents])
+
+
+def _load_note_file_quietly(filename):
+    # Runs in worker processes.  Errors are reported when the parent process loads the file again by itself.
+    try:
+        return load_note_file(filename)
+    except Exception:
+        return None
+
+
+def _load_note_data_quietly(args):
+    # Same as _load_note_file_quietly(), for note contents that were read by the parent process.
+    data, is_json = args
+    try:
+        return load_note_stream(io.StringIO(data), is_json=is_json)
+    except Exception:
+        return None
+
+
+def _map_in_process_pool(func, items, jobs):
+    pool = multiprocessing.Pool(jobs)
+    try:
+        return pool.map(func, items, chunksize=max(1, len(items) // (jobs * 4)))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def preload_note_files(filenames, jobs):
+    '''
+    Parses the given note files using a pool of `jobs` processes, and returns a dictionary of filename -> list of Yaml
+    documents.  Files that fail to load are left out, so that the error is reported when they are loaded normally.
+    '''
+    results = _map_in_process_pool(_load_note_file_quietly, filenames, jobs)
+    return {f: d for f, d in zip(filenames, results) if d is not None}
+
+
+def preload_note_data(notes, jobs):
+    '''
+    Same as preload_note_files(), for the contents of notes that are already in memory: parses the given
+    (key, contents, is_json) tuples, and returns a dictionary of key -> list of Yaml documents.
+    '''
+    results = _map_in_process_pool(_load_note_data_quietly, [(data, is_json) for _, data, is_json in notes], jobs)
+    return {key: d for (key, _, _), d in zip(notes, results) if d is not None}
+
+
+def dump_key_filter(k):
+    # Remove all of the 'accepts_auto_' keys:
+    if k.startswith('accepts_auto_'):
+        return False
+    return True
+
+
 class SeanoDataAggregator(object):
-    def __init__(self, config):
+    def __init__(self, config, note_fields=None, note_filters=None, note_loader=None, extern_resolver=None):
         # Define structures to store data as we assemble things.
         # Releases and notes are stored separately because they are associated N:N, and they each receive
         # incremental updates throughout the load process.  When an information fragment comes in, we want
@@ -47,6 +202,45 @@ class SeanoDataAggregator(object):
         self.releases = {}
         self.notes = {}
 
+        # Thousands of notes are typically attributed to only a handful of distinct commits and releases.  To keep
+        # memory usage proportional to the number of distinct values (rather than to the number of notes), the
+        # release names and commit IDs on notes are interned, and equal sets of them are stored as a single shared
+        # frozenset.  This is the registry of those shared sets:
+        self.identifier_sets = {}
+
+        # Long-running tools (such as a watch mode) can apply changes to individual notes and release links after
+        # the initial load (see update_note() and friends).  To support that, remember the automatic attributes
+        # each note was imported with, and cache the work dump() does, so that only affected releases need to be
+        # recomputed.  The cache is discarded whenever data is changed by anything other than the incremental API.
+        self.note_automatic_attributes = {}  # note id -> [automatic attributes passed to import_note(), ...]
+        self.dump_cache = None
+
+        # When only some of the keys of each note are wanted, the rest are discarded as early as possible (right
+        # after parsing), to keep memory usage and output size down:
+        self.note_fields = note_fields or config.get('query_note_fields') or None
+        if self.note_fields is not None:
+            self.note_fields = frozenset(list_if_not_already(self.note_fields)) | STRUCTURAL_NOTE_KEYS
+
+        # When only some of the notes are wanted, notes that don't match are discarded as early as possible (when
+        # possible, based on the filename alone; otherwise, right after loading), so that dump() never sees them.
+        # Rejected notes are remembered, so that they are not loaded again when the same note is imported again.
+        # Filters on automatic keys can only be evaluated once all automatic attributes have been imported, so they
+        # are applied right before the notes are used (see apply_note_filters()):
+        self.note_filters = parse_note_filters(note_filters)
+        self.note_filter_keys = frozenset([x.key for x in self.note_filters])
+        self.immediate_note_filters = [x for x in self.note_filters if x.key not in AUTOMATIC_NOTE_KEYS]
+        self.deferred_note_filters = [x for x in self.note_filters if x.key in AUTOMATIC_NOTE_KEYS]
+        self.rejected_note_uids = set()
+        self.unfiltered_note_uids = set()  # notes not yet checked against deferred_note_filters
+
+        # By default, note files are read from disk.  Callers that already have the contents of note files (such as
+        # from a Git object database) can provide a function that returns the list of Yaml documents in a note file:
+        self.note_loader = note_loader
+
+        # Reference-style extern notes only point at their original; the contents of the original are provided by
+        # this object (see ExternReferenceResolver), if any:
+        self.extern_resolver = extern_resolver
+
         # Use the given config to import (pre-populate) anything hard-coded.
 
         # Declare the current version:
@@ -80,6 +274,10 @@ class SeanoDataAggregator(object):
             self.release_setattr(name, k, True, v)
 
     def import_note(self, path, uid, **automatic_attributes):
+        self.note_automatic_attributes.setdefault(uid, []).append(automatic_attributes)
+        if uid in self.rejected_note_uids:
+            return
+        is_new = uid not in self.notes
         try:
             if not automatic_attributes:
                 # note_setattr() (below) invokes get_note() under-the-hood, which means that
@@ -88,20 +286,281 @@ class SeanoDataAggregator(object):
                 # manually invoke get_note(), discarding the result, to ensure that the note
                 # file was loaded, which is the whole point of this function.
                 self.get_note(path, uid)
-                return
 
             for k, v in automatic_attributes.items():
                 self.note_setattr(path, uid, k, True, v)
 
         except AttemptToLoadGhostNote:
-            pass
+            return
+
+        if is_new and not all([x.matches(self.notes[uid]) for x in self.immediate_note_filters]):
+            log.debug('Discarding note %s because it does not match %s', uid, self.immediate_note_filters)
+            del self.notes[uid]
+            self.rejected_note_uids.add(uid)
+        elif self.deferred_note_filters:
+            self.unfiltered_note_uids.add(uid)
+
+
+    def apply_note_filters(self):
+        '''
+        Discards the notes that do not match the note filters on automatic keys (such as commits and releases),
+        now that their automatic attributes are complete.  Invoked right before notes are used; each note is only
+        checked once.
+        '''
+        for uid in self.unfiltered_note_uids:
+            note = self.notes.get(uid)
+            if note is None:
+                continue
+            # (Notes without releases are part of the HEAD release; see dump_note())
+            note = dict(note, releases=note.get('releases') or [self.current_version])
+            if not all([x.matches(note) for x in self.deferred_note_filters]):
+                log.debug('Discarding note %s because it does not match %s', uid, self.deferred_note_filters)
+                del self.notes[uid]
+                self.dump_cache = None
+        self.unfiltered_note_uids = set()
+
+
+    def accepts_note_file(self, filename):
+        '''
+        Returns False if the note located at the given path is known to be rejected by the note filters, based on
+        its filename alone.  Lets callers skip opening (and parsing) the file at all.
+        '''
+        if self.note_filters:
+            m = self._extern_id_path_regex.search(os.path.basename(filename))
+            extern_id = m.group('name') if m else None
+            for x in self.note_filters:
+                if x.key == 'x-seano-extern-identifier' and not x.matches_value(extern_id):
+                    return False
+        return True
+
+
+    def dump(self, normalized=False, ancestor_closure=False):
+        # Return the list of releases, in an idealized sort order:
+        return list(self.iter_dump(normalized=normalized, ancestor_closure=ancestor_closure))
+
+
+    def iter_dump(self, normalized=False, ancestor_closure=False):
+        '''
+        Same as dump(), except that releases are yielded one at a time, in the same order that dump() returns them.
+
+        Each release is populated with copies of its notes right before it is yielded, and is not retained
+        afterwards, so a streaming serializer can keep peak memory proportional to the largest release, rather
+        than to the whole database.
+
+        When normalized is set, the notes list of each release contains only references to notes (the note ID,
+        plus per-reference flags, such as `is-copied-from-backstory`); the notes themselves are available,
+        exactly once each, from dump_note_table().
+
+        When ancestor_closure is set, each release also gets an `ancestor-closure` key (see
+        list_ancestor_closures()), so that consumers can find every release between two releases using bitwise
+        operations, instead of walking the `after` links.
+        '''
+        cache = self.get_dump_cache()
+        dump_note = self.dump_note_ref if normalized else self.dump_note
+        closures = self.list_ancestor_closures(cache) if ancestor_closure else None
+
+        # Yield each release, in an idealized sort order:
+        for idx, name in enumerate(cache['order']):
+            release = dict(cache['releases'][name])
+            release['notes'] = [dump_note(uid, is_copied_from_backstory)
+                                for _, _, is_copied_from_backstory, uid in cache['notes'][name]]
+            if closures is not None:
+                release['ancestor-closure'] = '%x' % (closures[idx],)
+            yield release
+
+
+    def list_ancestor_closures(self, cache):
+        '''
+        Returns, for each release in dump() order, the set of all of its ancestors (direct or not, including
+        backstories), encoded as a bitmask: bit N is set when the release at index N of dump() is an ancestor.
+
+        With these, the releases whose notes are new in release B compared to release A are
+        ``(closure[B] | 1 << B) & ~(closure[A] | 1 << A)``.
+        '''
+        order = cache['order']
+        releases = cache['releases']
+        bits = {name: 1 << idx for idx, name in enumerate(order)}
+        # (dump() order is not topological when the release graph has a cycle; closures come from the graph itself)
+        closures = get_reachability_closures(releases, bits, 'after')
+        # Inside cycles, some closures are incomplete; keep merging the closures of ancestors until nothing changes:
+        is_changed = True
+        while is_changed:
+            is_changed = False
+            for name in order:
+                mask = closures[name]
+                for x in releases[name].get('after', []):
+                    mask |= bits[x['name']] | closures[x['name']]
+                if mask != closures[name]:
+                    closures[name] = mask
+                    is_changed = True
+        return [closures[name] for name in order]
+
+
+    def dump_note_table(self):
+        '''
+        Returns all notes, keyed by note ID.  Used alongside normalized dumps (see iter_dump()).
+        '''
+        self.apply_note_filters()
+        result = {}
+        for uid in self.notes.keys():
+            note = self.dump_note(uid, False)
+            result[note['id']] = note
+        return result
+
+
+    def update_note(self, path, uid, **automatic_attributes):
+        '''
+        Re-loads a single note from disk, after the note was created, edited, or ghosted.
+
+        The note keeps the automatic attributes it was originally imported with, unless new ones are provided.
+        Only the releases that contain (or contained) the note are recomputed in the next dump().
+        '''
+        cache, self.dump_cache = self.dump_cache, None
+        if cache and not self.remove_note_refs(cache, uid):
+            cache = None
+
+        history = self.note_automatic_attributes.pop(uid, None) or [{}]
+        if automatic_attributes:
+            history = [automatic_attributes]
+        self.notes.pop(uid, None)
+        self.rejected_note_uids.discard(uid)
+        for attributes in history:
+            self.import_note(path, uid, **attributes)
+        self.apply_note_filters()
+
+        if cache:
+            self.add_note_refs(cache, uid)
+        self.dump_cache = cache
+
+
+    def remove_note(self, uid):
+        '''
+        Forgets a single note, after it was deleted.
+
+        Only the releases that contained the note are recomputed in the next dump().
+        '''
+        if self.dump_cache and not self.remove_note_refs(self.dump_cache, uid):
+            self.dump_cache = None
+        self.notes.pop(uid, None)
+        self.note_automatic_attributes.pop(uid, None)
+        self.rejected_note_uids.discard(uid)
+
+
+    def link_releases(self, name, after_name, **link_attributes):
+        '''
+        Declares that the release `name` comes after the release `after_name`, creating either release if needed.
+
+        The release ancestry graph is re-processed in the next dump(), but notes are only moved around in releases
+        whose backstory forwarding changed.
+        '''
+        cache, self.dump_cache = self.dump_cache, None
+        self.get_release(after_name)
+        link_attributes['name'] = after_name
+        self.release_setattr(name, 'after', False, [link_attributes])
+        if cache and not self.refresh_dump_cache_release_graph(cache):
+            cache = None
+        self.dump_cache = cache
+
+
+    def unlink_releases(self, name, after_name):
+        '''
+        Removes the ancestry link between the release `name` and the release `after_name`, on both sides.
+
+        The release ancestry graph is re-processed in the next dump(), but notes are only moved around in releases
+        whose backstory forwarding changed.
+        '''
+        for a, key, b in [(name, 'after', after_name), (after_name, 'before', name)]:
+            if a in self.releases:
+                self.releases[a][key] = [x for x in self.releases[a].get(key, []) if x.get('name') != b]
+        if self.dump_cache and not self.refresh_dump_cache_release_graph(self.dump_cache):
+            self.dump_cache = None
+
+
+    def list_note_releases(self, uid):
+        '''
+        Returns the names of the releases the given note shows up in, in the order dump() lists them, each paired
+        with whether or not the note is copied into that release from a backstory.
+        '''
+        cache = self.get_dump_cache()
+        found = {}
+        for name, ref in self.list_note_refs(cache, uid):
+            found.setdefault(name, ref[2])
+        return [(x, found[x]) for x in cache['order'] if x in found]
+
+
+    def list_release_window(self, since_release=None, max_releases=None, candidates=None):
+        '''
+        Returns the set of names of the releases inside the given release window:
+
+        - ``since_release``: the given release, and every release newer than it (i.e., all of its descendants)
+        - ``max_releases``: the given number of most recent releases, in the order dump() lists them
+
+        When both are given, the window is the intersection of both.  When candidates is given, only those
+        releases are considered; the Git scanner uses this to settle the window before it has seen every release.
+        '''
+        names = set(self.releases.keys() if candidates is None else candidates)
+
+        if since_release is not None:
+            if since_release not in self.releases:
+                raise SeanoFatalError('Unable to bound the query: no such release: %s' % (since_release,))
+            newer = {}  # release name -> set of names of the releases immediately after it
+            for name, info in self.releases.items():
+                for x in info.get('after', []):
+                    if not x.get('delete'):
+                        newer.setdefault(x['name'], set()).add(name)
+                for x in info.get('before', []):
+                    if not x.get('delete'):
+                        newer.setdefault(name, set()).add(x['name'])
+            window = set()
+            todo = [since_release]
+            while todo:
+                x = todo.pop()
+                if x not in window:
+                    window.add(x)
+                    todo.extend(newer.get(x, []))
+            names = names & window
+
+        if max_releases is not None:
+            release_dicts, _ = self.dump_release_graph()
+            release_dicts = {k: dict(v, before=[x for x in v['before'] if x['name'] in names],
+                                        after=[x for x in v['after'] if x['name'] in names])
+                             for k, v in release_dicts.items() if k in names}
+            names = set(list(sorted_release_names_from_releases(release_dicts))[:max_releases])
 
+        return names
 
-    def dump(self):
-        # Clone the notes structure, so we can make changes without making this method non-re-entrant-safe:
-        note_dicts = structure_deep_copy(self.notes)
 
-        # Also clone the releases structure, for the same reason:
+    def truncate_releases(self, names):
+        '''
+        Forgets every release not in the given collection of release names, along with the ancestry links that
+        point to them, and the notes (and note release attributions) that only belong to them.
+        '''
+        names = set(names)
+        self.apply_note_filters()  # (against the releases of each note before they are truncated)
+        self.dump_cache = None
+        self.releases = {k: v for k, v in self.releases.items() if k in names}
+        for info in self.releases.values():
+            for key in ['before', 'after']:
+                if key in info:
+                    info[key] = [x for x in info[key] if x['name'] in names]
+        for uid in list(self.notes.keys()):
+            releases = self.notes[uid].get('releases') or [self.current_version]
+            kept = [x for x in releases if x in names]
+            if not kept:
+                del self.notes[uid]
+            elif len(kept) != len(releases):
+                self.notes[uid]['releases'] = self.intern_identifier_set(kept)
+
+
+    # internal plumbing:
+
+
+    def dump_release_graph(self):
+        '''
+        Returns a fully processed copy of the release ancestry graph (without any notes), and the backstory
+        forwarding map (release name -> set of release names that also receive that release's notes).
+        '''
+        # Clone the releases structure, so we can make changes without making this method non-re-entrant-safe:
         release_dicts = structure_deep_copy(self.releases)
 
         # In the course of the dump() method, we patch the output in ways that both (a) require the release
@@ -211,82 +670,181 @@ class SeanoDataAggregator(object):
 
         log.debug('Backstory forwards: %s', backstory_forwards)
 
-        # Inject each note into each release:
-        for note in note_dicts.values():
-
-            # Declare notes to be part of the HEAD release when no release is specified:
-            # (this is important for non-Git-backed databases; when the release is not
-            # specified, the default is HEAD)
-            if not note.get('releases'):
-                note['releases'] = [self.current_version]
-
-            # Convert all sets into lists with predictable sort orders:
-            for k, v in note.items():
-                if isinstance(v, set):
-                    note[k] = sorted(list(v))
-
-            # Append this note to each release when this change was first released:
-            for r in note['releases']:
-                # Add to releases where this note was created:
-                release_dicts[r]['notes'] = (release_dicts[r].get('notes') or []) + [note]
-
-            # Append this note to each release that is a termination of a relevant backstory:
-            note = dict(note) # Copy so that we can make changes
-            note['is-copied-from-backstory'] = True
-            backstory_targets = set()
-            for r in note['releases']:
-                backstory_targets = backstory_targets | backstory_forwards.get(r, set())
-            for p in backstory_targets:
-                release_dicts[p]['notes'] = (release_dicts[p].get('notes') or []) + [note]
-
         # Sort special keys in each release we care about:
         def ancestry_sort_key(x):
             return (
                 x.get('is-backstory', False),
                 x['name'],
             )
-        def note_sort_key(x):
-            return (
-                x.get('relative-sort-string') or x['id'], # Missing, empty, or None-ish falls back to the note ID
-                x['id'], # Break ties using the note ID (for when sort strings are identical)
-            )
         for name, info in release_dicts.items():
             info['before'] = sorted(info.get('before', []), key=ancestry_sort_key)
             info['after'] = sorted(info.get('after', []), key=ancestry_sort_key)
-            info['notes'] = sorted(info.get('notes', []), key=note_sort_key)
 
-        # Remove all of the 'accepts_auto_' keys:
-        def my_key_filter(k):
-            if k.startswith('accepts_auto_'):
-                return False
-            return True
-        release_dicts = structure_deep_copy(release_dicts, key_filter=my_key_filter)
+        release_dicts = structure_deep_copy(release_dicts, key_filter=dump_key_filter)
 
-        # Return the list of releases, in an idealized sort order:
-        return [release_dicts[x] for x in sorted_release_names_from_releases(release_dicts)]
+        return release_dicts, backstory_forwards
 
-    # internal plumbing:
 
+    def dump_note_ref(self, uid, is_copied_from_backstory):
+        '''
+        Returns a reference to the given note, formatted for normalized output.
+        '''
+        ref = {'id': self.notes[uid]['id']}
+        if is_copied_from_backstory:
+            ref['is-copied-from-backstory'] = True
+        return ref
+
+
+    def get_dump_cache(self):
+        '''
+        Returns the processed release ancestry graph, the release sort order, and the (sorted) note references
+        of each release, computing them if necessary.
+        '''
+        self.apply_note_filters()
+        if self.dump_cache is None:
+            release_dicts, backstory_forwards = self.dump_release_graph()
+            cache = {
+                'releases': release_dicts,
+                'forwards': backstory_forwards,
+                'order': list(sorted_release_names_from_releases(release_dicts)),
+                'notes': {name: [] for name in release_dicts.keys()},
+            }
+            for uid in self.notes.keys():
+                self.add_note_refs(cache, uid, keep_sorted=False)
+            for refs in cache['notes'].values():
+                refs.sort()
+            self.dump_cache = cache
+        return self.dump_cache
+
+
+    def list_note_refs(self, cache, uid):
+        '''
+        Lists the releases the given note shows up in, paired with the reference stored in that release's notes
+        list.  A reference is a tuple that sorts in the same order notes are listed in a release.
+        '''
+        note = self.notes.get(uid)
+        if note is None:
+            return []
+
+        sort_key = note.get('relative-sort-string') or note['id'] # Missing, empty, or None-ish falls back to the note ID
 
-    _extern_id_path_regex = re.compile(r'\.extern\-(?P<name>.+)\.yaml$')
+        # Declare notes to be part of the HEAD release when no release is specified:
+        # (this is important for non-Git-backed databases; when the release is not
+        # specified, the default is HEAD)
+        releases = note.get('releases') or [self.current_version]
+
+        # This note appears in each release when this change was first released:
+        result = [(r, (sort_key, note['id'], False, uid)) for r in releases]
+
+        # This note is copied into each release that is a termination of a relevant backstory:
+        backstory_targets = set()
+        for r in releases:
+            backstory_targets = backstory_targets | cache['forwards'].get(r, set())
+        result.extend([(p, (sort_key, note['id'], True, uid)) for p in backstory_targets])
+
+        return result
+
+
+    def add_note_refs(self, cache, uid, keep_sorted=True):
+        for name, ref in self.list_note_refs(cache, uid):
+            if keep_sorted:
+                bisect.insort(cache['notes'][name], ref)
+            else:
+                cache['notes'][name].append(ref)
+
+
+    def remove_note_refs(self, cache, uid):
+        '''
+        Removes the references to the given note from the given dump cache.  Returns False if any of them is missing,
+        in which case the cache is out of sync with the notes, and must be dropped.
+        '''
+        is_in_sync = True
+        for name, ref in self.list_note_refs(cache, uid):
+            refs = cache['notes'].get(name, [])
+            idx = bisect.bisect_left(refs, ref)
+            if idx < len(refs) and refs[idx] == ref:
+                del refs[idx]
+            else:
+                is_in_sync = False
+        return is_in_sync
+
+
+    def refresh_dump_cache_release_graph(self, cache):
+        '''
+        Updates the given dump cache after the release graph changed.  Returns False if the cache turned out to be out
+        of sync with the notes, in which case it must be dropped.
+        '''
+        release_dicts, backstory_forwards = self.dump_release_graph()
+
+        # Only notes originating in releases whose backstory forwarding changed need to be moved around:
+        changed = [x for x in set(cache['forwards'].keys()) | set(backstory_forwards.keys())
+                   if cache['forwards'].get(x, set()) != backstory_forwards.get(x, set())]
+        affected = set()
+        for x in changed:
+            affected.update([ref[3] for ref in cache['notes'].get(x, []) if not ref[2]])
+
+        if not all([self.remove_note_refs(cache, uid) for uid in affected]):
+            return False
+
+        cache['releases'] = release_dicts
+        cache['forwards'] = backstory_forwards
+        cache['order'] = list(sorted_release_names_from_releases(release_dicts))
+        for name in release_dicts.keys():
+            cache['notes'].setdefault(name, [])
+
+        for uid in affected:
+            self.add_note_refs(cache, uid)
+        return True
+
+
+    def dump_note(self, uid, is_copied_from_backstory):
+        '''
+        Returns a copy of the given note, formatted for output.
+        '''
+        note = self.notes[uid]
+        if self.note_fields is not None:
+            note = {k: v for k, v in note.items() if k in self.note_fields}
+        note = structure_deep_copy(note, key_filter=dump_key_filter)
+
+        # Declare notes to be part of the HEAD release when no release is specified:
+        if not note.get('releases'):
+            note['releases'] = [self.current_version]
+
+        # Convert all sets into lists with predictable sort orders:
+        for k, v in note.items():
+            if isinstance(v, (set, frozenset)):
+                note[k] = sorted(list(v))
+
+        if is_copied_from_backstory:
+            note['is-copied-from-backstory'] = True
+
+        return note
+
+
+
+    _extern_id_path_regex = re.compile(r'\.extern\-(?P<name>.+)\.(yaml|json)$')
     def get_note(self, filename, uid):
         if uid not in self.notes:
+            self.dump_cache = None
             log.debug('Loading note %s from disk (from %s)', uid, filename)
             # Start with a template note containing the given information:
             data = {}
             self.generic_setattr(data, 'notes[' + uid + ']', 'id', True, uid)
             m = self._extern_id_path_regex.search(os.path.basename(filename))
-            if m:
+            if m and self.is_note_key_loaded('x-seano-extern-identifier'):
                 self.generic_setattr(data, 'notes[' + uid + ']', 'x-seano-extern-identifier', True, m.group('name'))
 
             self.notes[uid] = data
 
             # Overwrite all members of the template with what exists on disk:
             try:
-                with open(filename, 'r', **FILE_ENCODING_KWARGS) as f:
-                    for d in yaml.load_all(f, Loader=yaml.FullLoader):
-                        for k, v in d.items():
+                for d in self.iter_resolved_note_documents(filename):
+                    for k, v in d.items():
+                        if self.is_note_key_loaded(k):
                             self.note_setattr(filename, uid, k, False, v)
+                    if data.get(SEANO_NOTE_KEY_IS_GHOST, False):
+                        # Nothing else in a ghost note matters; don't bother parsing the rest of it:
+                        break
 
             except:
                 log.error('Something exploded while trying to load a note from disk.  '
@@ -302,20 +860,68 @@ class SeanoDataAggregator(object):
         return self.notes[uid]
 
 
+    def load_note_documents(self, filename):
+        if self.note_loader is not None:
+            return self.note_loader(filename)
+        return iter_note_file(filename)
+
+
+    def iter_resolved_note_documents(self, filename):
+        '''
+        Yields the Yaml documents of the given note file.  If it is a reference-style extern note, the documents of
+        its original follow its own (metadata) document, just like in a complete copy of the original.
+        '''
+        for idx, d in enumerate(self.load_note_documents(filename)):
+            if idx or not isinstance(d, dict) or not d.get(SEANO_NOTE_KEY_IS_EXTERN_REFERENCE, False):
+                yield d
+                continue
+            yield {k: v for k, v in d.items() if k != SEANO_NOTE_KEY_IS_EXTERN_REFERENCE}
+            if d.get(SEANO_NOTE_KEY_IS_GHOST, False):
+                return
+            if self.extern_resolver is None:
+                raise SeanoFatalError('Unable to load %s: reference-style extern notes are not supported here'
+                                      % (filename,))
+            for x in self.extern_resolver.resolve(filename, d):
+                yield x
+
+
+    def is_note_key_loaded(self, key):
+        return self.note_fields is None or key in self.note_fields or key in BEHAVIORAL_NOTE_KEYS \
+            or key in self.note_filter_keys
+
+
     def get_release(self, name):
         if name not in self.releases:
+            self.dump_cache = None
+            name = intern_str(name)
             self.releases[name] = dict(name=name)
         return self.releases[name]
 
 
+    def intern_identifier_set(self, value):
+        '''
+        Returns an immutable copy of the given set of release names or commit IDs, with each member interned.
+
+        Equal sets are de-duplicated; all notes attributed to the same commit end up referencing the same object.
+        '''
+        value = frozenset([intern_str(x) for x in value])
+        return self.identifier_sets.setdefault(value, value)
+
+
     def note_setattr(self, filename, uid, key, is_auto, value):
         value = upgrade_note_schema(key, value)
+        note = self.get_note(filename, uid)
+        self.dump_cache = None
         # ABK: At this time, all keys are flat; we can use generic_setattr() for everything.
-        self.generic_setattr(self.get_note(filename, uid), "notes['%s']" % (uid,), key, is_auto, value)
+        self.generic_setattr(note, "notes['%s']" % (uid,), key, is_auto, value)
+        if key in ['commits', 'releases']:
+            # Whatever survived the merge, swap it out for the shared copy:
+            note[key] = self.intern_identifier_set(note[key])
 
 
     def release_setattr(self, name, key, is_auto, value):
         value = upgrade_release_schema(key, value)
+        self.dump_cache = None
         if key in ['notes']:
             log.error('''this API does not yet support setting notes.  feature request?''')
             explode
@@ -369,6 +975,11 @@ class SeanoDataAggregator(object):
         # is_auto matches, and the attribute is already set.
         # Ugh.  We have to do a merge.
 
+        if isinstance(obj[key], (set, frozenset)) and isinstance(value, (set, frozenset)):
+            # Shared identifier sets (see intern_identifier_set()) are immutable; merge into a new set:
+            obj[key] = set(obj[key]) | value
+            return
+
         if type(obj[key]) != type(value):
             raise SeanoFatalError("cannot merge different types %s (%s) and %s (%s) on %s['%s']"
                                  % (type(obj[key]), obj[key], type(value), value, obj_desc, key))
@@ -377,10 +988,6 @@ class SeanoDataAggregator(object):
             obj[key] = obj[key] + value
             return
 
-        if type(obj[key]) in [set]:
-            obj[key] = obj[key] | value
-            return
-
         if type(obj[key]) in [ascii_str_type, unicode_str_type, bool]:
             obj[key] = value
             return
@@ -4,12 +4,20 @@ seano_cli/db/generic.py
 Base class for the different kinds of seano databases
 """
 
-from seano_cli.db.common import SeanoDataAggregator
+from multiprocessing.pool import ThreadPool
+from seano_cli.db.common import SeanoDataAggregator, is_json_note_file, load_note_file, load_note_metadata, \
+                                preload_note_files
+from seano_cli.db.note_cache import ExternReferenceResolver, NoteCache, get_default_extern_note_cache_file, \
+                                    get_default_note_cache_file
+from seano_cli.db.note_index import NoteIndex
+from seano_cli.db.note_pack import NotePack, PackedNote, make_note_pack_filename
 from seano_cli.db.schema_upgrade import upgrade_root_object_schema
 from seano_cli.utils import *
 import errno
 import glob
+import json
 import logging
+import multiprocessing
 import os
 import re
 import uuid
@@ -18,6 +26,138 @@ import yaml
 log = logging.getLogger(__name__)
 
 
+def get_default_thread_count():
+    'Returns the default size of thread pools that mostly wait on I/O.'
+    cpu_count = os.cpu_count() if hasattr(os, 'cpu_count') else multiprocessing.cpu_count()
+    return min(32, (cpu_count or 1) + 4)
+
+
+class WorkingTreeExternSource(object):
+    '''
+    The notes of an extern database, as they are on disk.
+
+    Extern sources provide the notes to import (see ExternDatabaseImport): db_path (the path of the extern database),
+    get_hash() (which changes whenever any note might have changed, and is the same on every machine), list_notes()
+    (a list of NoteIndexEntry objects, whose paths are the paths of the notes inside db_path), read() (which returns
+    the contents of one of those notes, and may be invoked from multiple threads at once), and close().
+    '''
+    def __init__(self, db_path):
+        self.db_path = db_path
+
+    def get_hash(self):
+        from seano_cli.db.auto_detect import open_seano_database  # (would be a circular import at the module level)
+        return open_seano_database(self.db_path).contentHash()
+
+    def list_notes(self):
+        return [x for x in NoteIndex(os.path.join(self.db_path, SEANO_DB_SUBDIR)).entries
+                if SEANO_EXTERN_NOTE_EXTENSION_PREFIX not in os.path.basename(x.path)]
+
+    def read(self, note):
+        with open(note.path, 'r', **FILE_ENCODING_KWARGS) as f:
+            return f.read()
+
+    def close(self):
+        pass
+
+
+class ExternDatabaseImport(object):
+    '''
+    The import of the notes of a single extern database into a local database.
+
+    Every import leaves behind a manifest (see GenericSeanoDatabase.read_extern_manifest()) describing what was
+    imported.  When the extern database's contentHash() and the local copies are the same as in the manifest,
+    there is nothing to do (is_current is set), and no extern note is imported.  Otherwise, each extern note is hashed
+    (see import_note()), but only the local copies that differ from the manifest are read.  Finally, finish() deletes
+    the local copies of notes that no longer exist, and saves the new manifest.
+
+    Manifests are committed, so they record contents rather than stat data.  Finding out whether a manifest is current
+    therefore hashes files: Git-backed databases (and gitlink sources) take the hashes of files that match the index
+    from Git, which only reads files that its stat cache says changed, but other databases read every file of the
+    extern database (see contentHash()) and every local copy (see GenericSeanoDatabase.hash_local_copies()).
+
+    When as_reference is set, reference-style local copies are written (see GenericSeanoDatabase.import_extern_note()),
+    and, when an ExternReferenceResolver is given, the originals are stored in its cache (an import is only current
+    when all of them already are).
+
+    note_index is the NoteIndex of the local database when the import started; the database's own note index is not
+    touched until the import is finished, so that import_note() may be invoked from multiple threads at once.
+    '''
+    def __init__(self, db, extern_identifier, source, note_index, as_reference=False, extern_resolver=None):
+        self.db = db
+        self.extern_identifier = extern_identifier
+        self.source = source
+        self.as_reference = as_reference
+        self.extern_resolver = extern_resolver
+        self.db_path = source.db_path
+        self.local_notes = {x.uid: x for x in note_index.list_notes_with_extern_id(extern_identifier)}
+        self.manifest = db.read_extern_manifest(extern_identifier)
+        self.db_hash = source.get_hash()
+        self.local_hashes = db.hash_local_copies([x.path for x in self.local_notes.values()])
+        self.notes = {}  # uid -> new manifest entry
+
+        self.is_same_mode = self.manifest.get('reference', False) == as_reference
+        self.is_current = self.is_same_mode and self.manifest.get('database-hash') == self.db_hash \
+            and set(self.manifest['notes']) == set(self.local_notes) \
+            and all([self.is_local_copy_current(uid, x) for uid, x in self.manifest['notes'].items()]) \
+            and (extern_resolver is None or all([extern_resolver.contains(x['sha1'])
+                                                 for x in self.manifest['notes'].values()]))
+        if self.is_current:
+            log.debug('Importing %s: unchanged since the last import', self.db_path)
+            self.notes = self.manifest['notes']
+            self.extern_notes = []
+        else:
+            self.extern_notes = source.list_notes()
+
+    def is_used_now(self):
+        return bool(self.notes)
+
+    def is_local_copy_current(self, uid, entry):
+        return uid in self.local_notes and self.local_hashes.get(self.local_notes[uid].path) == entry.get('local-sha1')
+
+    def import_note(self, note, is_dry_run):
+        '''
+        Imports the given extern note (a NoteIndexEntry), unless the manifest says it is already up-to-date.  Returns
+        the result of GenericSeanoDatabase.import_extern_note(), or None.
+        '''
+        data = self.source.read(note)
+        sha1 = h_data(data)
+        if self.extern_resolver is not None and not is_dry_run:
+            self.extern_resolver.store(data, is_json=is_json_note_file(note.path))
+        entry = self.manifest.get('notes', {}).get(note.uid)
+        if entry and entry['sha1'] == sha1 and self.is_same_mode and self.is_local_copy_current(note.uid, entry):
+            log.debug('Importing %s: already imported and up-to-date', note.path)
+            self.notes[note.uid] = entry
+            return None
+
+        status = self.db.import_extern_note(note.path, self.extern_identifier, is_dry_run, data=data,
+                                            as_reference=self.as_reference)
+        local_path = status[1] if status else self.db.make_extern_note_filename(note.path, self.extern_identifier)
+        exists = os.path.exists(local_path)
+        self.notes[note.uid] = {
+            'original': os.path.relpath(note.path, self.db.path).replace('\\', '/'),
+            'sha1': sha1,
+            'local': os.path.relpath(local_path, self.db.path).replace('\\', '/'),
+            'ghost': bool(self.db.is_ghost(local_path)) if exists else False,
+        }  # (the hash of the local copy is filled in by finish(), all at once)
+        return status
+
+    def finish(self, is_dry_run):
+        '''
+        Deletes the local copies of notes that no longer exist in the extern database, and saves the manifest.
+        Returns the list of GenericSeanoDatabase.delete_note() results.
+        '''
+        deleted = [self.db.delete_note(x.path, is_dry_run=is_dry_run)
+                   for uid, x in self.local_notes.items() if uid not in self.notes]
+        if not is_dry_run and not self.is_current and self.notes:
+            written = [x for x in self.notes.values() if 'local-sha1' not in x]
+            hashes = self.db.hash_local_copies([os.path.join(self.db.path, x['local']) for x in written])
+            for x in written:
+                x['local-sha1'] = hashes.get(os.path.join(self.db.path, x['local']))
+            self.db.write_extern_manifest(self.extern_identifier, {'database-hash': self.db_hash, 'notes': self.notes,
+                                                                    'reference': self.as_reference})
+        return deleted
+
+
 class GenericSeanoDatabase(object):
     def __init__(self, path,
                  # ABK: Not using kwargs here so that we can block non-accepted args
@@ -32,7 +172,7 @@ class GenericSeanoDatabase(object):
         def load_file(cfg, is_failure_suggestive_of_repo_missing):
             try:
                 with open(cfg, 'r', **FILE_ENCODING_KWARGS) as f:
-                    for d in yaml.load_all(f, Loader=yaml.FullLoader):
+                    for d in yaml.load_all(f, Loader=SeanoYamlLoader):
                         # An empty section in yaml yields None here.
                         # Although it's weird (wrong?) to have an empty section
                         # in a yaml file in seano, let's not crash, either.
@@ -56,9 +196,54 @@ class GenericSeanoDatabase(object):
         if not self.config.get('current_version', None):
             self.config['current_version'] = 'HEAD'
 
+        # Built on first use (see get_note_index() and get_note_pack()):
+        self.note_index = None
+        self.note_pack = None
+
     def incrementalHash(self):
         return h_data(h_folder(self.path), str(self.config))
 
+    def contentHash(self):
+        '''
+        Same as incrementalHash(), but based only on the contents of the files in this database, so that it is the
+        same on every machine (and in every clone of the database).  Reads every file in the database.
+        '''
+        h_inputs = []
+        for folder, subfolders, files in os.walk(self.path):
+            subfolders.sort()
+            for name in sorted(files):
+                path = os.path.join(folder, name)
+                h_inputs.extend([os.path.relpath(path, self.path).replace('\\', '/'), h_git_blob(path)])
+        h_inputs.append(str(self.config))
+        return h_data(*h_inputs)
+
+    def get_note_index(self):
+        '''
+        Returns an index of all note files in this database, listed in a single pass over the folder tree the first
+        time it is needed, and shared by everything else that needs to find notes.
+        '''
+        if self.note_index is None:
+            self.note_index = NoteIndex(self.db_objs)
+        return self.note_index
+
+    def invalidate_note_index(self):
+        'Forgets the note index; call after creating or deleting note files.'
+        self.note_index = None
+
+    def get_note_pack(self):
+        'Returns all notes stored in pack files (see pack_notes()), read the first time they are needed.'
+        if self.note_pack is None:
+            self.note_pack = NotePack.from_folder(self.db_objs, os.path.join(self.path, SEANO_DB_PACK_SUBDIR))
+        return self.note_pack
+
+    def list_packed_notes(self, aggregator, pack=None):
+        '''
+        Returns the (path, uid, automatic attributes) of each packed note accepted by the given SeanoDataAggregator,
+        ready to be imported alongside the notes found in note files.
+        '''
+        return [(x.path, x.uid, info) for x in (pack or self.get_note_pack()).entries
+                if aggregator.accepts_note_file(x.path) for info in x.automatic_attributes]
+
     def make_new_note_filename(self):
         return self.make_note_filename_from_uid(uuid.uuid4().hex)
 
@@ -78,6 +263,10 @@ class GenericSeanoDatabase(object):
         seano database currently referenced by this database object results in undefined
         behavior.
         '''
+        note_index = self.note_index
+        if note_index is not None and filename in note_index.by_path:
+            return note_index.by_path[filename].uid
+
         result = os.path.basename(filename)
         result = os.path.splitext(result)[0] # [2]  .yaml
         result = os.path.splitext(result)[0] # [2]  .extern-xxxx (if exists)
@@ -105,7 +294,21 @@ class GenericSeanoDatabase(object):
         # And we're done.  This is the official note template.
         return result
 
-    def import_extern_notes(self, is_dry_run, db_defs):
+    def import_extern_notes(self, is_dry_run, db_defs, from_gitlink=False, as_reference=False, jobs=None,
+                            note_cache=False):
+        '''
+        Imports notes from the given extern databases -- a list of (extern ID, path) pairs -- and deletes the local
+        copies of notes that no longer exist in them.  Returns a list of (A|M|D, path) pairs of touched files.
+
+        Notes are imported by a pool of jobs threads (by default, get_default_thread_count()).
+
+        When from_gitlink is set, each path is the path of a Git submodule, and notes are read from the commit
+        recorded for the submodule in the index (see open_extern_source()), rather than from the working tree.
+
+        When as_reference is set, local copies only point at their originals (see import_extern_note()).  When
+        note_cache is set, too, the originals are also stored in the persistent cache of the ExternReferenceResolver
+        (see open_extern_resolver()), so that queries with note_cache set can resolve them without the extern database.
+        '''
         if not db_defs:
             return [] # No local paths updated
 
@@ -117,65 +320,50 @@ class GenericSeanoDatabase(object):
         if len(set([self.path] + [db_path for _, db_path in db_defs])) != len(db_defs) + 1:
             raise SeanoFatalError('List of extern database paths is not unique.')
 
-        # Construct a list of all full note file extensions we're looking for.
-        # These file extensions will be used to identify extraneous notes.
-        # In particular, we are NOT assuming that the db_defs list is the full
-        # list of all extern modules that exist, which means that NOT all
-        # extern notes are candidates for deletion.  (For example, if a
-        # submodule was deleted, we want to explicitly keep those notes.)
-        extensions_by_id = {
-            id: SEANO_EXTERN_NOTE_EXTENSION_PREFIX + id + SEANO_NOTE_EXTENSION
-            for id, _ in db_defs
-        }
-
-        # Build up a list of note IDs that are candidates for deletion, and
-        # also a list of all the extern identifiers that are currently active:
-        extraneous = {}
-        extern_id_used_previously = {}
-        for root, directories, filenames in os.walk(self.db_objs):
-            for f in filenames:
-                for id, ext in extensions_by_id.items():
-                    if f.endswith(ext):
-                        note_path = os.path.join(root, f)
-                        extraneous[self.extract_uid_from_filename(note_path)] = note_path
-                        extern_id_used_previously[id] = True
-                        break
-
-        # Build up a list of remote paths that need to be copied.
-        # And for each of these paths, remove them from `extraneous`.
-        todo = []
-        extern_id_now_used = {}
-        for other_db_id, other_db_dir in db_defs:
-            other_db_objs = os.path.join(other_db_dir, SEANO_DB_SUBDIR)
-            for root, directories, filenames in os.walk(other_db_objs):
-                for f in filenames:
-                    if f.endswith(SEANO_NOTE_EXTENSION) and SEANO_EXTERN_NOTE_EXTENSION_PREFIX not in f:
-                        full_path = os.path.join(root, f)
-                        todo.append((full_path, other_db_id))
-                        extern_id_now_used[other_db_id] = True
-
-                        # Oh, and don't delete these files:
-                        extraneous[self.extract_uid_from_filename(full_path)] = False
-
-        # Flatten extraneous:
-        extraneous = [v for _, v in extraneous.items() if v]
-
-        # Mine used ids for newly used ids:
-        new_extern_identifiers = [
-            (id, db_path)
-            for id, db_path in db_defs
-            if id in extern_id_now_used and id not in extern_id_used_previously
-        ]
-
-        touched_files = []
-
-        # Import each of the discovered files:
-        for f, id in todo:
-            touched_files.append(self.import_extern_note(f, id, is_dry_run))
-
-        # Delete each extraneous note:
-        for f in extraneous:
-            touched_files.append(self.delete_note(f, is_dry_run=is_dry_run))
+        # Each extern database is handled separately.  We are NOT assuming that the db_defs list is the full list of
+        # all extern modules that exist, which means that NOT all extern notes are candidates for deletion.  (For
+        # example, if a submodule was deleted, we want to explicitly keep those notes.)
+        #
+        # Reading, hashing and writing notes is mostly I/O, so it is spread across a pool of threads, covering all
+        # extern databases at once.  Results are collected in order, so the outcome is the same as a serial import.
+        # Worker threads share a snapshot of the note index (and the note pack, which is read by is_ghost()); the
+        # note index is only invalidated once all of them are finished.
+        note_index = self.get_note_index()
+        self.get_note_pack()
+        sources = []
+        extern_resolver = self.open_extern_resolver(note_cache=True) if as_reference and note_cache else None
+        pool = ThreadPool(min(len(db_defs) * 8, jobs or get_default_thread_count()))
+        try:
+            for _, db_path in db_defs:
+                sources.append(self.open_extern_source(db_path, from_gitlink))
+            imports = pool.map(lambda x: ExternDatabaseImport(self, x[0][0], x[1], note_index,
+                                                              as_reference=as_reference,
+                                                              extern_resolver=extern_resolver),
+                               zip(db_defs, sources))
+            tasks = [(x, note) for x in imports if not x.is_current for note in x.extern_notes]
+            imported_files = pool.map(lambda x: x[0].import_note(x[1], is_dry_run), tasks)
+        finally:
+            pool.close()
+            pool.join()
+            for x in sources:
+                x.close()
+        if any([x and x[0] == 'A' for x in imported_files]) and not is_dry_run:
+            self.invalidate_note_index()
+        new_manifests = [self.get_extern_manifest_file(x.extern_identifier) for x in imports]
+        new_manifests = [x for x in new_manifests if not os.path.exists(x)]
+        deleted_files = [f for x in imports for f in x.finish(is_dry_run)]
+        if extern_resolver is not None:
+            extern_resolver.save()
+
+        if not is_dry_run:
+            # Tell the underlying SCM about all new files at once:
+            self.register_new_notes([f for status, f in [x for x in imported_files if x] if status == 'A']
+                                    + [x for x in new_manifests if os.path.exists(x)])
+
+        new_extern_identifiers = [(x.extern_identifier, x.db_path) for x in imports
+                                  if x.is_used_now() and not x.local_notes]
+
+        touched_files = imported_files + deleted_files
 
         if new_extern_identifiers:
             sys.stderr.write('''
@@ -205,12 +393,85 @@ Ghosting notes now does not impact any notes imported in the future.
         # Return a list of all touched files:
         return [x for x in touched_files if x]
 
-    def import_extern_note(self, extern_note_file, extern_identifier, is_dry_run):
-        # Construct the file path where the imported note will live:
-        id = self.extract_uid_from_filename(extern_note_file)
-        local_path = self.make_note_filename_from_uid(id)
+    def open_extern_source(self, db_path, from_gitlink=False):
+        '''
+        Returns the extern source (see WorkingTreeExternSource) of the notes of the extern database at the given path.
+        '''
+        if from_gitlink:
+            raise SeanoFatalError('Importing notes from a gitlink requires a Git-backed seano database')
+        return WorkingTreeExternSource(db_path)
+
+    def register_new_notes(self, filenames):
+        '''
+        Called after new files (local copies of notes, and manifests) are created by an import, so that SCM-backed
+        databases can start tracking them.
+        '''
+        pass
+
+    def hash_local_copies(self, paths):
+        '''
+        Returns the h_git_blob() of each of the given files that exists, keyed by path.  Used to detect changes to
+        local copies of extern notes.
+        '''
+        return {x: h_git_blob(x) for x in paths if os.path.isfile(x)}
+
+    def get_extern_manifest_file(self, extern_identifier):
+        '''
+        Returns the path of the manifest of notes imported from the given extern database.
+
+        Manifests only describe the contents of files (not their mtimes and such), so they live in the database, and
+        are meant to be committed along with the local copies of the notes they describe.  Every clone of the
+        database then skips unchanged extern databases, too.
+        '''
+        return os.path.join(self.path, SEANO_DB_EXTERN_MANIFEST_SUBDIR, extern_identifier + '.json')
+
+    def read_extern_manifest(self, extern_identifier):
+        '''
+        Returns the manifest written by the last import from the given extern database, or an empty dictionary.
+
+        The manifest contains the contentHash() of the extern database at that time, and for each imported note (keyed
+        by uid): the relative path and sha1 of the original, the relative path, ghost flag and h_git_blob() of the
+        local copy.
+        '''
+        try:
+            with open(self.get_extern_manifest_file(extern_identifier), 'r', **FILE_ENCODING_KWARGS) as f:
+                manifest = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        return manifest if isinstance(manifest, dict) and isinstance(manifest.get('notes'), dict) else {}
+
+    def write_extern_manifest(self, extern_identifier, manifest):
+        manifest_file = self.get_extern_manifest_file(extern_identifier)
+        try:
+            if not os.path.isdir(os.path.dirname(manifest_file)):
+                os.makedirs(os.path.dirname(manifest_file))
+            with open(manifest_file, 'w', **FILE_ENCODING_KWARGS) as f:
+                f.write(coerce_to_str(json.dumps(manifest, sort_keys=True, indent=2, separators=(',', ': '))))
+                f.write('\n')
+        except (IOError, OSError) as e:
+            # The manifest is only an optimization; never fail an import because of it.
+            log.debug('Unable to save extern manifest %s: %s', manifest_file, e)
+
+    def make_extern_note_filename(self, extern_note_file, extern_identifier):
+        'Returns the path where the local copy of the given note from the given extern database lives.'
+        local_path = self.make_note_filename_from_uid(self.extract_uid_from_filename(extern_note_file))
         local_path = os.path.splitext(local_path)
-        local_path = (SEANO_EXTERN_NOTE_EXTENSION_PREFIX + extern_identifier).join(local_path)
+        return (SEANO_EXTERN_NOTE_EXTENSION_PREFIX + extern_identifier).join(local_path)
+
+    def import_extern_note(self, extern_note_file, extern_identifier, is_dry_run, data=None, as_reference=False):
+        '''
+        Imports the given note from the given extern database, and returns (A|M, local path), or None if the local
+        copy is already up-to-date (or is a ghost).
+
+        Normally, the local copy is a complete copy of the original.  When as_reference is set, the local copy only
+        contains the relative path and sha1 of the original, which is read from the extern database (or from a cache)
+        whenever the note is loaded (see ExternReferenceResolver).
+
+        The note index is not invalidated here, even when a new note file is created, because this may be invoked from
+        multiple threads at once (see import_extern_notes()); that is the caller's job.
+        '''
+        # Construct the file path where the imported note will live:
+        local_path = self.make_extern_note_filename(extern_note_file, extern_identifier)
 
         meta = {}
         status = 'A'
@@ -220,26 +481,20 @@ Ghosting notes now does not impact any notes imported in the future.
             # Load its extern metadata (the first hunk in the YAML):
             status = 'M'
 
-            def load_extern_meta():
-                with open(local_path, 'r', **FILE_ENCODING_KWARGS) as f:
-                    for d in yaml.load_all(f, Loader=yaml.FullLoader):
-                        # Skip over any empty sections
-                        if not d: continue
-                        # Return the first non-empty section:
-                        return d
-            meta = load_extern_meta() or {}  # On parse error, pretend note is missing and re-import it
+            meta = load_note_metadata(local_path) or {}  # On parse error, pretend note is missing and re-import it
 
             # If this is a ghost note, then do not overwrite it:
             if meta.get(SEANO_NOTE_KEY_IS_GHOST, False):
                 log.debug('Importing %s: already imported as a ghost', extern_note_file)
                 return None
 
-        with open(extern_note_file, 'r', **FILE_ENCODING_KWARGS) as f:
-            data = f.read()
+        if data is None:
+            with open(extern_note_file, 'r', **FILE_ENCODING_KWARGS) as f:
+                data = f.read()
 
         old_data_hash = meta.get(SEANO_NOTE_KEY_SHA1_OF_ORIGINAL_NOTE)
         if old_data_hash:
-            if old_data_hash == h_data(data):
+            if old_data_hash == h_data(data) and meta.get(SEANO_NOTE_KEY_IS_EXTERN_REFERENCE, False) == as_reference:
                 log.debug('Importing %s: already imported and up-to-date', extern_note_file)
                 return None
 
@@ -248,6 +503,29 @@ Ghosting notes now does not impact any notes imported in the future.
             return status, local_path
 
         log.debug('Importing %s', extern_note_file)
+        if as_reference:
+            write_existing_file(local_path, '\n'.join([
+                '---',
+                '%s: %s' % (
+                    SEANO_NOTE_KEY_RELPATH_TO_ORIGINAL_NOTE,
+                    os.path.relpath(extern_note_file, self.path).replace('\\', '/'),
+                ),
+                '%s: %s' % (
+                    SEANO_NOTE_KEY_SHA1_OF_ORIGINAL_NOTE,
+                    h_data(data),
+                ),
+                '%s: true' % (
+                    SEANO_NOTE_KEY_IS_EXTERN_REFERENCE,
+                ),
+                '',
+                '######## NOTICE ########',
+                '# This note is a *reference* to a note in an external database.',
+                '# Its contents are read from the original, so edit the',
+                '# original instead, and import it again.',
+                '',
+            ]))
+            return status, local_path
+
         write_existing_file(local_path, '\n'.join([
             '---',
             '%s: %s' % (
@@ -263,21 +541,14 @@ Ghosting notes now does not impact any notes imported in the future.
             '# This note is a *copy* of a note from an external database.',
             '# You probably want to edit the original rather than this',
             '# copy, so that other projects inherit your change.',
-            data,
+            # (A Json note is a single Json object, which is also a valid Yaml document; it only needs a separator)
+            ('---\n' if is_json_note_file(extern_note_file) else '') + data,
         ]))
 
         return status, local_path
 
     def get_notes_with_extern_id(self, extern_id):
-        # How do we identify notes with this extern ID?
-        extension = SEANO_EXTERN_NOTE_EXTENSION_PREFIX + extern_id + SEANO_NOTE_EXTENSION
-        # Go find them:
-        results = []
-        for root, directories, filenames in os.walk(self.db_objs):
-            for f in filenames:
-                if f.endswith(extension):
-                    results.append(os.path.join(root, f))
-        return results
+        return [x.path for x in self.get_note_index().list_notes_with_extern_id(extern_id)]
 
     def delete_note(self, note_file, is_dry_run):
         if is_dry_run:
@@ -285,29 +556,20 @@ Ghosting notes now does not impact any notes imported in the future.
             return 'D', note_file
         try:
             os.remove(note_file)
+            self.invalidate_note_index()
             return 'D', note_file
         except FileNotFoundError:
             pass
         return None
 
     def is_ghost(self, note_file):
-        with open(note_file, 'r', **FILE_ENCODING_KWARGS) as f:
-            for d in yaml.load_all(f, Loader=yaml.FullLoader):
-                # Skip over any empty sections
-                if not d: continue
-                # Interrogate the first non-empty section:
-                return d.get(SEANO_NOTE_KEY_IS_GHOST, False)
+        if note_file in self.get_note_pack().by_path:
+            return False  # (ghost notes are never packed)
+        # Interrogate the first non-empty section:
+        return (load_note_metadata(note_file) or {}).get(SEANO_NOTE_KEY_IS_GHOST, False)
 
     def ghost_note(self, note_file, is_dry_run):
-
-        def load_extern_meta(path):
-            with open(path, 'r', **FILE_ENCODING_KWARGS) as f:
-                for d in yaml.load_all(f, Loader=yaml.FullLoader):
-                    # Skip over any empty sections
-                    if not d: continue
-                    # Return the first non-empty section:
-                    return d
-        meta = load_extern_meta(note_file)
+        meta = load_note_metadata(note_file) or {}
 
         if meta.get(SEANO_NOTE_KEY_IS_GHOST, False):
             log.info('Is already a ghost: %s', note_file)
@@ -331,9 +593,122 @@ Ghosting notes now does not impact any notes imported in the future.
 
         return 'M', note_file
 
+    def convert_notes(self, note_files, to_format, is_dry_run):
+        '''
+        Converts the given notes to the given format (`json` or `yaml`), keeping their uid; only the file extension
+        changes.  Returns a list of (A|D, path) pairs of touched files.
+
+        Notes already in that format, and extern notes (which are re-created by `seano import`), are left alone.  Yaml
+        notes are only converted when they contain a single document that Json represents exactly; comments in Yaml
+        notes are not carried over.
+        '''
+        extension = SEANO_JSON_NOTE_EXTENSION if to_format == 'json' else SEANO_NOTE_EXTENSION
+        touched = []
+        for note_file in note_files:
+            if note_file.endswith(extension) or SEANO_EXTERN_NOTE_EXTENSION_PREFIX in os.path.basename(note_file):
+                log.info('Not converting %s', note_file)
+                continue
+            new_file = os.path.splitext(note_file)[0] + extension
+            if os.path.exists(new_file):
+                log.warning('Warning: Not converting %s: %s already exists', note_file, new_file)
+                continue
+
+            documents = [x for x in load_note_file(note_file) if x is not None]
+            if len(documents) > 1 or not all([isinstance(x, dict) for x in documents]):
+                log.warning('Warning: Not converting %s: Json notes contain a single object', note_file)
+                continue
+            d = documents[0] if documents else {}
+
+            if to_format == 'json':
+                try:
+                    data = json.dumps(d, indent=2, sort_keys=True, ensure_ascii=False) + '\n'
+                except (TypeError, ValueError):
+                    data = None
+                if data is None or json.loads(data) != d:
+                    log.warning('Warning: Not converting %s: some values are not representable in Json', note_file)
+                    continue
+            else:
+                data = '---\n' + yaml.safe_dump(d, default_flow_style=False, allow_unicode=True)
+
+            if is_dry_run:
+                log.info('Would convert %s', note_file)
+            else:
+                log.debug('Converting %s', note_file)
+                write_file(new_file, coerce_to_str(data))
+                os.remove(note_file)
+                self.invalidate_note_index()
+            touched.extend([('D', note_file), ('A', new_file)])
+
+        if not is_dry_run:
+            self.register_new_notes([f for status, f in touched if status == 'A'])
+        return touched
+
+    def pack_notes(self, before_release, is_dry_run):
+        '''
+        Moves the notes that only belong to ancestors of the given release out of their note files, and into one pack
+        file per release (see NotePack).  Returns a list of (A|M|D, path) pairs of touched files.
+
+        Packed notes keep their uid, contents and releases, and are read straight out of the pack files by queries.
+        Extern notes (which are managed by `seano import`), ghost notes, and notes that Json cannot represent exactly
+        are not packed.
+        '''
+        s = self.aggregate()
+        releases = {x['name']: x for x in s.dump()}
+        if before_release not in releases:
+            raise SeanoFatalError('Unable to pack notes before release %s: no such release' % (before_release,))
+        ancestors = set()
+        todo = [x['name'] for x in releases[before_release].get('after') or []]
+        while todo:
+            x = todo.pop()
+            if x not in ancestors:
+                ancestors.add(x)
+                todo.extend([y['name'] for y in releases.get(x, {}).get('after') or []])
+
+        packs_dir = os.path.join(self.path, SEANO_DB_PACK_SUBDIR)
+        new_entries = {}  # pack file -> list of PackedNote
+        packed_files = []
+        for x in self.get_note_index().entries:
+            if x.extern_id is not None or x.uid not in s.notes:
+                continue  # (extern note, or ghost note)
+            note_releases = [name for name, _ in s.list_note_releases(x.uid)]
+            if not note_releases or not all([name in ancestors for name in note_releases]):
+                continue
+            documents = load_note_file(x.path)
+            try:
+                is_representable = json.loads(json.dumps(documents)) == documents
+            except (TypeError, ValueError):
+                is_representable = False
+            if not is_representable:
+                log.warning('Warning: Not packing %s: some values are not representable in Json', x.path)
+                continue
+            # Notes are packed with the newest release they belong to:
+            new_entries.setdefault(make_note_pack_filename(packs_dir, note_releases[0]), []).append(
+                PackedNote(x.path, x.uid, s.note_automatic_attributes[x.uid], documents))
+            packed_files.append(x.path)
+
+        pack = self.get_note_pack()
+        touched = []
+        for filename, entries in sorted(new_entries.items()):
+            existing = pack.pack_files.get(filename, [])
+            if is_dry_run:
+                log.info('Would pack %d notes into %s', len(entries), filename)
+            else:
+                log.debug('Packing %d notes into %s', len(entries), filename)
+                pack.write(filename, existing + entries)
+            touched.append(('M' if existing else 'A', filename))
+        for filename in packed_files:
+            if not is_dry_run:
+                os.remove(filename)
+            touched.append(('D', filename))
+        if not is_dry_run:
+            self.invalidate_note_index()
+            self.note_pack = None
+        return touched
+
     def make_new_note(self):
         filename = self.make_new_note_filename()
         write_file(filename, self.get_seano_note_template_contents())
+        self.invalidate_note_index()
         return filename
 
     def make_new_notes(self, count):
@@ -349,6 +724,9 @@ Ghosting notes now does not impact any notes imported in the future.
 
     def get_notes_matching_pattern(self, pattern, include_modified):
         # Even without a repository, we can still search the database for filenames that matches the given pattern.
+        return self.get_notes_matching_id_prefix(pattern)
+
+    def get_notes_matching_id_prefix(self, pattern):
         # ABK: Deliberately accept both Unix and Windows slashes here, because worst case scenario, you may be
         #      on Windows, running git from Git-Bash, but running seano from a Windows command prompt (or vice-versa!)
         #      Thus, just because we *think* we know which slashes to use doesn't mean we should ban the other
@@ -359,29 +737,147 @@ Ghosting notes now does not impact any notes imported in the future.
         pat = m.group(1) + os.sep + m.group(2) + '*' + SEANO_NOTE_EXTENSION
         log.debug('Converted pattern to glob: %s', pat)
         files = glob.glob(os.path.join(self.db_objs, pat))
+        files.extend(glob.glob(os.path.join(self.db_objs, pat[:-len(SEANO_NOTE_EXTENSION)] + SEANO_JSON_NOTE_EXTENSION)))
+        files.extend(sorted([x.path for x in self.get_note_pack().entries if x.uid.startswith(m.group(1) + m.group(2))]))
         if not files:
             return ([], ['No note in the database has a filename like ' + pat])
         return (files, [])
 
-    def query(self):
-        # ABK: The beginning and end of this function should be kept somewhat in sync with the copy in git.py
+    def query(self, stream_releases=False, normalized=False, note_fields=None, note_filters=None,
+              since_release=None, max_releases=None, ancestor_closure=False, jobs=1, note_cache=False):
+        s = self.aggregate(note_fields=note_fields, note_filters=note_filters, since_release=since_release,
+                           max_releases=max_releases, jobs=jobs, note_cache=note_cache)
+        return self.make_query_result(s, self.config, stream_releases=stream_releases, normalized=normalized,
+                                      ancestor_closure=ancestor_closure)
+
+    def query_snapshots(self, snapshots, **query_kwargs):
+        '''
+        Performs one query per (ref, current_version) pair.  Only supported in SCM-backed databases.
+        '''
+        raise SeanoFatalError('Querying snapshots of other refs requires a Git-backed seano database')
+
+    def make_query_result(self, s, config, stream_releases=False, normalized=False, ancestor_closure=False):
+        # Use the main database config file (seano-config.yaml) as a foundation for the query result structure.
+        # Overwrite the entire `releases` member; the SeanoDataAggregator object contains all the juicy metadata contained
+        # in the existing `releases` member in seano-config.yaml, so we're not losing any data by overwriting.
+        # When streaming, `releases` is a generator that builds each release on-demand (see iter_dump()).
+        result = dict(config)
+        if normalized:
+            # Releases only reference notes by ID; each note is stored exactly once in a shared table:
+            result['notes'] = s.dump_note_table()
+        dump = s.iter_dump if stream_releases else s.dump
+        result['releases'] = dump(normalized=normalized, ancestor_closure=ancestor_closure)
+        return result
 
+    def aggregate(self, note_fields=None, note_filters=None, since_release=None, max_releases=None, jobs=1,
+                  note_cache=False):
+        '''
+        Loads the entire database into a new SeanoDataAggregator.
+
+        Long-running tools may hold on to the returned object, feed it individual changes using refresh_note(),
+        and call dump() again, which is much cheaper than performing a new query.
+
+        When since_release and/or max_releases is set, only the releases inside that window (see
+        SeanoDataAggregator.list_release_window()), and the notes attributed to them, are kept.
+
+        When jobs is greater than 1, note files are parsed in parallel, by that many processes.  When note_cache is
+        set, parsed notes are cached on disk between queries (see import_notes()).
+        '''
         # Even without a repository, we can still load everything and hope that all the information we need exists in
         # the band files and in the global config.  This is in fact what a freshly onboarded database looks like; we
         # can't trust the repository for those old versions anyways, so all the version numbers are hard-coded.
         #
         # Note, though, that this implementation doesn't scale well because we are unable to bail early, because there
         # is no sense of time without a repository.  This implementation is basically a glorified demo.
-        s = SeanoDataAggregator(self.config)
-        for root, directories, filenames in os.walk(self.db_objs):
-            for f in filenames:
-                if f.endswith(SEANO_NOTE_EXTENSION):
-                    f = os.path.join(root, f)
-                    s.import_note(path=f, uid=self.extract_uid_from_filename(f))
+        s = SeanoDataAggregator(self.config, note_fields=note_fields, note_filters=note_filters,
+                                extern_resolver=self.open_extern_resolver(note_cache=note_cache))
+        notes = [(x.path, x.uid, {}) for x in self.get_note_index().entries if s.accepts_note_file(x.path)]
+        notes.extend(self.list_packed_notes(s))
+        self.import_notes(s, notes, jobs=jobs, note_cache=note_cache)
+        if since_release is not None or max_releases is not None:
+            s.truncate_releases(s.list_release_window(since_release=since_release, max_releases=max_releases))
+        return s
+
+    def import_notes(self, aggregator, notes, jobs=1, note_cache=False):
+        '''
+        Imports the given notes -- a list of (path, uid, automatic attributes) tuples -- into the given
+        SeanoDataAggregator, in order.
 
-        # Use the main database config file (seano-config.yaml) as a foundation for the query result structure.
-        # Overwrite the entire `releases` member; the SeanoDataAggregator object contains all the juicy metadata contained
-        # in the existing `releases` member in seano-config.yaml, so we're not losing any data by overwriting.
-        result = dict(self.config)
-        result['releases'] = s.dump()
-        return result
+        When jobs is greater than 1, the note files are parsed up front by a pool of that many processes; the
+        results are merged in the same order as a serial import, so the query result is identical.
+
+        When note_cache is set, the parsed notes are read from (and saved to) the persistent cache returned by
+        open_note_cache(), so that only new or changed note files are parsed.
+
+        Packed notes (see pack_notes()) are read from their pack, rather than from their (deleted) note file.
+        '''
+        cache = self.open_note_cache() if note_cache else None
+        pack = self.get_note_pack()
+        unpacked = [x[0] for x in notes if x[0] not in pack.by_path]
+
+        preloaded = {}
+        if jobs > 1 and len(unpacked) > 1:
+            preloaded = preload_note_files([x for x in unpacked if cache is None or cache.lookup(x) is None], jobs)
+
+        def load_note_documents(filename):
+            docs = pack.load(filename)
+            if docs is not None:
+                return docs
+            docs = preloaded.pop(filename, None)
+            if cache is None:
+                return docs if docs is not None else load_note_file(filename)
+            if docs is not None:
+                return cache.store(filename, docs)
+            return cache.load(filename)
+
+        aggregator.note_loader = load_note_documents if preloaded or cache or pack.entries else None
+        try:
+            for path, uid, info in notes:
+                aggregator.import_note(path=path, uid=uid, **info)
+        finally:
+            # Anything loaded later on (such as by refresh_note()) must come from disk:
+            aggregator.note_loader = None
+        if cache is not None:
+            cache.save()
+        if aggregator.extern_resolver is not None:
+            aggregator.extern_resolver.save()
+
+    def open_note_cache(self):
+        'Opens the persistent cache of parsed notes used by import_notes().'
+        return NoteCache(get_default_note_cache_file(self.path), self.path)
+
+    def open_extern_resolver(self, note_cache=False):
+        '''
+        Returns the ExternReferenceResolver that provides the contents of reference-style extern notes.  When
+        note_cache is set, parsed originals are cached on disk.
+        '''
+        return ExternReferenceResolver(self.path, get_default_extern_note_cache_file() if note_cache else None)
+
+    def refresh_note(self, aggregator, note_file):
+        '''
+        Applies the current state on disk of a single note file (created, modified, ghosted, or deleted) to the
+        given SeanoDataAggregator, previously returned by aggregate().
+        '''
+        uid = self.extract_uid_from_filename(note_file)
+        if not os.path.exists(note_file):
+            aggregator.remove_note(uid)
+            return
+        aggregator.update_note(note_file, uid, **self.get_new_note_automatic_attributes(aggregator, uid))
+
+    def find_note_releases(self, note_file):
+        '''
+        Returns the releases that contain the given note, in the order a query lists them, as a list of
+        (release name, is copied from backstory) tuples.  Ghost notes are not in any release.
+
+        Unlike a query, only the given note is loaded.
+        '''
+        uid = self.extract_uid_from_filename(note_file)
+        if note_file in self.get_note_pack().by_path:
+            return self.aggregate().list_note_releases(uid)
+        s = SeanoDataAggregator(self.config, extern_resolver=self.open_extern_resolver())
+        s.import_note(path=note_file, uid=uid)
+        return s.list_note_releases(uid)
+
+    def get_new_note_automatic_attributes(self, aggregator, uid):
+        # Without a repository, notes do not have any automatic attributes.
+        return {}
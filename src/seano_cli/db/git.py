@@ -4,13 +4,21 @@ seano_cli/db/git/git.py
 Reads a git-backed seano database.
 """
 
-from seano_cli.db.common import SeanoDataAggregator
+from seano_cli.db.common import SeanoDataAggregator, is_json_note_file, load_note_stream, may_override_releases, \
+                                note_sets_own_releases, preload_note_data
 from seano_cli.utils import *
 from seano_cli.db.generic import GenericSeanoDatabase
+from seano_cli.db.note_cache import GitBlobNoteCache
+from seano_cli.db.note_index import NoteIndexEntry
+from seano_cli.db.note_pack import NotePack
 from seano_cli.db.release_sorting import semverish_sort_key
+import copy
+import io
 import os
+import posixpath
 import re
 import subprocess
+import threading
 
 log = logging.getLogger(__name__)
 
@@ -42,6 +50,142 @@ DEFAULT_REF_PARSERS = [
 ]
 
 
+class GitCommit(object):
+    def __init__(self, commit_id, parents, refs, releases, raw_name_statuses):
+        self.commit_id = commit_id
+        self.parents = parents
+        self.refs = refs
+        self.releases = releases
+        self.raw_name_statuses = raw_name_statuses
+
+
+class GitBlobReader(object):
+    '''
+    Reads blobs out of the Git object database, using a single long-lived `git cat-file --batch` process.
+    '''
+    def __init__(self, repo, git_dir=None):
+        git = ['git'] + (['--git-dir', git_dir] if git_dir else [])
+        self.p = subprocess.Popen(git + ['cat-file', '--batch'], cwd=repo,
+                                  stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def read(self, blob_id):
+        self.p.stdin.write(coerce_to_ascii_str(blob_id + '\n'))
+        self.p.stdin.flush()
+        header = coerce_to_str(self.p.stdout.readline()).split()
+        if len(header) != 3:
+            raise SeanoFatalError('Unable to read blob %s from Git: %s' % (blob_id, ' '.join(header)))
+        data = self.p.stdout.read(int(header[2]))
+        self.p.stdout.read(1)  # trailing newline
+        return data
+
+    def close(self):
+        self.p.stdin.close()
+        self.p.wait()
+
+
+class GitlinkExternSource(object):
+    '''
+    The notes of an extern database inside a Git submodule, as of the commit recorded for the submodule in the index
+    of the parent repository (the gitlink), read straight out of the submodule's object database.  The submodule does
+    not need to be checked out, and uncommitted changes in it are never imported.
+
+    Same interface as WorkingTreeExternSource.  The paths of the notes are the paths they would have if the submodule
+    was checked out.
+    '''
+    def __init__(self, db, submodule_path):
+        self.submodule_path = os.path.abspath(submodule_path)
+        relpath = os.path.relpath(self.submodule_path, db.repo).replace(os.sep, '/')
+
+        # Which commit of the submodule is recorded in the parent repository?
+        out = coerce_to_str(subprocess.check_output(['git', 'ls-files', '-s', '-z', '--', relpath], cwd=db.repo))
+        gitlinks = [x.partition('\t')[0].split() for x in out.split('\0') if x.endswith('\t' + relpath)]
+        if len(gitlinks) != 1 or gitlinks[0][0] != '160000':
+            raise SeanoFatalError('%s is not a Git submodule' % (submodule_path,))
+        self.commit_id = gitlinks[0][1]
+
+        self.git_dir = self.find_submodule_git_dir(db, relpath)
+        if subprocess.call(['git', '--git-dir', self.git_dir, 'cat-file', '-e', self.commit_id + '^{commit}'],
+                           cwd=db.repo, stderr=subprocess.PIPE) != 0:
+            raise SeanoFatalError('Commit %s of submodule %s is not available in %s; fetch it first (such as with '
+                                  '`git submodule update --init`)' % (self.commit_id, submodule_path, self.git_dir))
+
+        # Where is the seano database inside the submodule?
+        try:
+            dot_seano = coerce_to_str(subprocess.check_output(
+                ['git', '--git-dir', self.git_dir, 'show', self.commit_id + ':' + SEANO_DOTFILE_FILE],
+                cwd=db.repo, stderr=subprocess.PIPE))
+        except subprocess.CalledProcessError:
+            raise SeanoFatalError('Unable to find a seano database in commit %s of submodule %s'
+                                  % (self.commit_id, submodule_path))
+        key, _, path = (dot_seano.splitlines() or [''])[0].partition(':')
+        if key != SEANO_DOTFILE_DB_PATH_KEY:
+            raise SeanoFatalError('Unable to read %s in commit %s of submodule %s: data does not start with `%s`.'
+                                  % (SEANO_DOTFILE_FILE, self.commit_id, submodule_path, SEANO_DOTFILE_DB_PATH_KEY))
+        # (`.seano` files are always written with Unix path separators)
+        self.db_relpath = posixpath.normpath(path.strip())
+        self.db_path = os.path.join(self.submodule_path, *self.db_relpath.split('/'))
+
+        self.db = db
+        self.blob_reader = None
+        self.lock = threading.Lock()
+
+    def find_submodule_git_dir(self, db, relpath):
+        'Returns the Git directory holding the objects of the submodule at the given path.'
+        if os.path.exists(os.path.join(self.submodule_path, '.git')):
+            # Checked out; ask Git where its objects are:
+            return os.path.join(self.submodule_path, coerce_to_str(subprocess.check_output(
+                ['git', 'rev-parse', '--git-dir'], cwd=self.submodule_path)).strip())
+        # Not checked out; absorbed submodules live in the parent's Git directory, under their name:
+        name = relpath
+        try:
+            out = coerce_to_str(subprocess.check_output(['git', 'config', '-f', '.gitmodules', '-z', '--get-regexp',
+                                                         r'^submodule\..*\.path$'], cwd=db.repo))
+        except subprocess.CalledProcessError:
+            out = ''
+        for line in out.split('\0'):
+            key, _, value = line.partition('\n')
+            if value == relpath:
+                name = key[len('submodule.'):-len('.path')]
+        git_dir = coerce_to_str(subprocess.check_output(['git', 'rev-parse', '--git-dir'], cwd=db.repo)).strip()
+        return os.path.join(db.repo, git_dir, 'modules', *name.split('/'))
+
+    def get_hash(self):
+        # Commits are immutable:
+        return 'gitlink:%s:%s' % (self.commit_id, self.db_relpath)
+
+    def list_notes(self):
+        notes_relpath = posixpath.normpath(posixpath.join(self.db_relpath, SEANO_DB_SUBDIR))
+        out = coerce_to_str(subprocess.check_output(
+            ['git', '--git-dir', self.git_dir, 'ls-tree', '-r', '-z', self.commit_id, '--', notes_relpath],
+            cwd=self.db.repo))
+        self.blob_ids = {}
+        result = []
+        for line in out.split('\0'):
+            info, _, path = line.partition('\t')
+            info = info.split()
+            name = posixpath.basename(path)
+            if len(info) != 3 or info[1] != 'blob' or not name.endswith(SEANO_NOTE_EXTENSIONS) \
+                    or SEANO_EXTERN_NOTE_EXTENSION_PREFIX in name:
+                continue
+            path = os.path.join(self.submodule_path, *path.split('/'))
+            self.blob_ids[path] = info[2]
+            result.append(NoteIndexEntry(path, self.db.extract_uid_from_filename(path), None, None))
+        return result
+
+    def read(self, note):
+        with self.lock:
+            if self.blob_reader is None:
+                self.blob_reader = GitBlobReader(self.db.repo, git_dir=self.git_dir)
+            data = self.blob_reader.read(self.blob_ids[note.path])
+        # Same newline handling as reading a text file:
+        return io.StringIO(coerce_to_unicode_str(data), newline=None).read()
+
+    def close(self):
+        if self.blob_reader is not None:
+            self.blob_reader.close()
+            self.blob_reader = None
+
+
 class GitSeanoDatabase(GenericSeanoDatabase):
     def __init__(self, path, **base_kwargs):
         super(GitSeanoDatabase, self).__init__(path, **base_kwargs)
@@ -74,18 +218,70 @@ class GitSeanoDatabase(GenericSeanoDatabase):
         uncommitted_files_query = ['git', 'ls-files', '--modified', '--others', '--exclude-standard', '--', self.path]
         uncommitted_files = coerce_to_str(subprocess.check_output(uncommitted_files_query, cwd=self.repo)).splitlines()
         uncommitted_files = [os.path.join(self.repo, x) for x in uncommitted_files]
+        # The checked-out commit (detached in submodules) and the index aren't covered by the list of refs:
+        head = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.repo).strip()
+        index = subprocess.check_output(['git', 'ls-files', '-s', '--', self.path], cwd=self.repo)
         h_inputs = []
         h_inputs.append(refs_list)
+        h_inputs.append(head)
+        h_inputs.append(index)
         h_inputs.extend([h_file(x) if os.path.exists(x) else 'deleted' for x in uncommitted_files])
         h_inputs.append(self.config)
         return h_data(*h_inputs)
 
-    def import_extern_note(self, extern_note_file, extern_identifier, is_dry_run):
-        status = super(GitSeanoDatabase, self).import_extern_note(extern_note_file, extern_identifier, is_dry_run)
-        # status is a tuple of (A|M|D, path)
-        if status and not is_dry_run and status[0] == 'A':
-            subprocess.check_call(['git', 'add', '-N', status[1]], cwd=self.repo)
-        return status
+    def contentHash(self):
+        # Same as dumb implementation, but faster.  Files that match the index are hashed by Git (using its stat cache)
+        index = subprocess.check_output(['git', 'ls-files', '-s', '--', self.path], cwd=self.repo)
+        h_inputs = [index]
+        for x in self.list_uncommitted_files([self.path]):
+            path = os.path.join(self.repo, *x.split('/'))
+            h_inputs.extend([x, h_git_blob(path) if os.path.isfile(path) else 'deleted'])
+        h_inputs.append(str(self.config))
+        return h_data(*h_inputs)
+
+    def hash_local_copies(self, paths):
+        # Same as dumb implementation, but faster.  Files that match the index are hashed by Git (using its stat cache)
+        blob_ids = {}  # Normalized absolute path -> blob ID in the index
+        for i in range(0, len(paths), 1000):
+            out = coerce_to_str(subprocess.check_output(['git', 'ls-files', '-s', '-z', '--'] + paths[i:i + 1000],
+                                                        cwd=self.repo))
+            for line in out.split('\0'):
+                info, _, path = line.partition('\t')
+                if path:
+                    blob_ids[os.path.join(self.repo, *path.split('/'))] = info.split()[1]
+        for x in self.list_uncommitted_files(paths):
+            blob_ids.pop(os.path.join(self.repo, *x.split('/')), None)
+        result = {}
+        for x in paths:
+            blob_id = blob_ids.get(os.path.abspath(x))
+            if blob_id is not None:
+                result[x] = blob_id
+            elif os.path.isfile(x):
+                result[x] = h_git_blob(x)
+        return result
+
+    def list_uncommitted_files(self, paths):
+        '''
+        Returns the paths (relative to the repository) of the files inside the given paths that are untracked, or
+        differ from the index (including new files that are only marked as intent-to-add).
+        '''
+        result = []
+        for i in range(0, len(paths), 1000):
+            out = coerce_to_str(subprocess.check_output(['git', 'ls-files', '-z', '--modified', '--others',
+                                                         '--exclude-standard', '--'] + paths[i:i + 1000],
+                                                        cwd=self.repo))
+            result.extend([x for x in out.split('\0') if x])
+        return result
+
+    def open_extern_source(self, db_path, from_gitlink=False):
+        if from_gitlink:
+            return GitlinkExternSource(self, db_path)
+        return super(GitSeanoDatabase, self).open_extern_source(db_path)
+
+    def register_new_notes(self, filenames):
+        # Mark new notes as intent-to-add, in batches (to stay clear of command line length limits):
+        for i in range(0, len(filenames), 1000):
+            subprocess.check_call(['git', 'add', '-N', '--'] + filenames[i:i + 1000], cwd=self.repo)
 
     def make_new_note(self):
         filename = super(GitSeanoDatabase, self).make_new_note()
@@ -140,8 +336,14 @@ class GitSeanoDatabase(GenericSeanoDatabase):
             err = "git did not provide any commits for the pattern '%s'" % (pattern,)
             return (prior_files, prior_errors + [err])
         log.debug('Searching for notes added%s in %s', '/modified' if include_modified else '', commits_remaining)
-        files = []
-        for thing in self.scan_git_seano_db(include_modified):
+
+        # Packed notes are no longer in the commit graph, but remember their commits:
+        packed = [x for x in self.get_note_pack().entries
+                  if any([c in commits_remaining for info in x.automatic_attributes for c in info.get('commits') or []])]
+        files = [x.path for x in packed]
+        commits_remaining -= set([c for x in packed for info in x.automatic_attributes for c in info.get('commits') or []])
+
+        for thing in self.scan_git_seano_db(include_modified) if commits_remaining else []:
             notes = thing.get('notes', None)
             if notes:
                 # filter the paths by the commit that created/modified the note.  Note that notes can override the
@@ -164,27 +366,342 @@ class GitSeanoDatabase(GenericSeanoDatabase):
         return (prior_files + files, prior_errors)
 
 
-    def query(self):
-        # ABK: The beginning and end of this function should be kept somewhat in sync with the copy in generic.py
-        s = SeanoDataAggregator(self.config)
-        for thing in self.scan_git_seano_db(False):
+    def aggregate(self, note_fields=None, note_filters=None, since_release=None, max_releases=None, jobs=1,
+                  note_cache=False):
+        s = SeanoDataAggregator(self.config, note_fields=note_fields, note_filters=note_filters,
+                                extern_resolver=self.open_extern_resolver(note_cache=note_cache))
+        notes = []  # (path, uid, automatic attributes) of each note to import, in the order they were discovered
+        seen = set()  # Paths of all notes discovered by the scanner, imported or not
+        outside = []  # (path, uid, automatic attributes) of each note attributed to releases outside of the window
+        is_bounded = since_release is not None or max_releases is not None
+        scanned_releases = set()  # Names of the releases whose commit the scanner has found so far
+        window = None  # Names of the releases inside the release window, once it is settled
+        is_truncated = False  # Whether the scanner stopped before reaching the end of the history
+        if max_releases is not None:
+            # Which releases are the most recent ones depends on the sort order of the entire release graph, which
+            # can't be known until the entire commit graph is read (releases on parallel branches are found in no
+            # particular order).  Reading the commit graph without any file changes is cheap; do that first:
+            window = self.list_release_window(since_release=since_release, max_releases=max_releases)
+        for thing in self.scan_git_seano_db(False, track_pending_releases=is_bounded):
+
+            # Stop scanning as soon as no remaining commit can contain a note inside the release window:
+            pending_releases = thing.get('pending-releases', None)
+            if pending_releases is not None:
+                # (every release newer than since_release is found before it, along with its ancestry links)
+                if window is None and since_release in scanned_releases:
+                    window = s.list_release_window(since_release=since_release, candidates=scanned_releases)
+                if window is not None and not (pending_releases & window):
+                    log.debug('Release window %s is complete; no longer scanning', sorted(window))
+                    is_truncated = True
+                    break
+                continue
 
             # Forward discovered notes into the note set:
             for filename, info in thing.get('notes', {}).items():
                 f = os.path.join(self.repo, filename)
-                s.import_note(path=f, uid=self.extract_uid_from_filename(f), **info)
+                seen.add(f)
+                if not s.accepts_note_file(filename):
+                    continue
+                if window is not None and not (info['releases'] & window):
+                    outside.append((f, self.extract_uid_from_filename(f), info))
+                    continue
+                notes.append((f, self.extract_uid_from_filename(f), info))
 
             # Forward discovered releases into the note set:
             for name, info in thing.get('releases', {}).items():
+                if 'commit' in info:
+                    scanned_releases.add(name)
                 s.import_release_info(name, **info)
 
-        # Use the main database config file (seano-config.yaml) as a foundation for the query result structure.
-        # Overwrite the entire `releases` member; the SeanoDataAggregator object contains all the juicy metadata contained
-        # in the existing `releases` member in seano-config.yaml, so we're not losing any data by overwriting.
-        result = dict(self.config)
-        result['releases'] = s.dump()
+        # Notes attributed to releases outside of the window are skipped, unless they set their own releases (which
+        # may be inside the window).  The same goes for notes created in history that was not scanned.  Such notes
+        # are rare; they are found without reading most note files (see find_notes_setting_own_releases()), and only
+        # they need their creating commit looked up:
+        unseen = [x for x in self.get_note_index().entries if x.path not in seen and s.accepts_note_file(x.path)] \
+            if is_truncated else []
+        overrides = self.find_notes_setting_own_releases([x[0] for x in outside] + [x.path for x in unseen])
+        notes.extend([x for x in outside if x[0] in overrides])
+        notes.extend([(x.path, x.uid, {'commits': [self.find_note_creating_commit(x.path)]})
+                      for x in unseen if x.path in overrides])
+
+        # Packed notes are no longer in the commit graph (their note files are deleted), but remember their releases:
+        pack = self.get_note_pack()
+        notes.extend([x for x in self.list_packed_notes(s, pack)
+                      if window is None or x[2].get('releases', frozenset()) & window
+                      or any([isinstance(d, dict) and 'releases' in d for d in pack.by_path[x[0]].documents])])
+
+        self.import_notes(s, notes, jobs=jobs, note_cache=note_cache)
+
+        if is_bounded:
+            if window is None:
+                # The scanner ran out of history before the window settled; consider everything we know about:
+                window = s.list_release_window(since_release=since_release, max_releases=max_releases)
+            s.truncate_releases(window)
+
+        return s
+
+    def list_release_window(self, since_release=None, max_releases=None):
+        '''
+        Returns the names of the releases inside the given release window (see
+        SeanoDataAggregator.list_release_window()), based on the entire commit graph, but without reading any note.
+        '''
+        s = SeanoDataAggregator(self.config)
+        for thing in self.scan_git_seano_db(False, commits=list(self.iter_commits(name_status=False))):
+            for name, info in thing.get('releases', {}).items():
+                s.import_release_info(name, **info)
+        return s.list_release_window(since_release=since_release, max_releases=max_releases)
+
+    def find_note_releases(self, note_file):
+        # Same as dumb implementation, but only scans the commits that descend from the one that created the note.
+        uid = self.extract_uid_from_filename(note_file)
+        if note_file in self.get_note_pack().by_path:
+            return self.aggregate().list_note_releases(uid)
+        created_in = self.find_note_creating_commit(note_file)
+        log.debug('Note %s was created in %s', uid, created_in or 'the working directory')
+
+        # If the note manually moves itself into a release outside of the scanned commits, then the release
+        # ancestry we know about is incomplete; fall back to scanning the entire commit graph:
+        for since_commit in [created_in or 'HEAD', None]:
+            s = SeanoDataAggregator(self.config, extern_resolver=self.open_extern_resolver())
+            for thing in self.scan_git_seano_db(False, since_commit=since_commit):
+                for filename, info in thing.get('notes', {}).items():
+                    if self.extract_uid_from_filename(filename) == uid:
+                        s.import_note(path=note_file, uid=uid, **info)
+                for name, info in thing.get('releases', {}).items():
+                    s.import_release_info(name, **info)
+            if uid not in s.note_automatic_attributes:
+                s.import_note(path=note_file, uid=uid, **self.get_new_note_automatic_attributes(s, uid))
+            if uid not in s.notes:
+                return []  # ghost note
+            if all([x in s.releases for x in s.notes[uid].get('releases') or []]):
+                break
+        return s.list_note_releases(uid)
+
+    def find_notes_setting_own_releases(self, note_files):
+        '''
+        Returns the set of the given note files that set their own releases (see note_sets_own_releases()).
+
+        Most notes don't, and most notes match the index: a single `git grep` over the blobs in the index finds the
+        committed notes that mention releases at all (see may_override_releases()), without reading any note file
+        here.  Only notes that differ from the index are searched one by one, and only notes that mention releases
+        are parsed.
+        '''
+        if not note_files:
+            return set()
+        uncommitted = set([os.path.join(self.repo, *x.split('/')) for x in self.list_uncommitted_files([self.db_objs])])
+        p = subprocess.Popen(['git', 'grep', '--cached', '-l', '-z', '-E',
+                              '-e', r'''releases["']?[[:space:]]*:''', '-e', SEANO_NOTE_KEY_IS_EXTERN_REFERENCE,
+                              '--', self.db_objs], cwd=self.repo, stdout=subprocess.PIPE)
+        out, _ = p.communicate()
+        if p.returncode not in [0, 1]:  # (1 means that nothing matched)
+            raise SeanoFatalError('Unable to search note files with git grep')
+        mentions = set([os.path.join(self.repo, *x.split('/')) for x in coerce_to_str(out).split('\0') if x])
+        def mentions_releases(x):
+            x = os.path.abspath(x)
+            return may_override_releases(x) if x in uncommitted else x in mentions
+        return set([x for x in note_files if mentions_releases(x) and note_sets_own_releases(x)])
+
+    def find_note_creating_commit(self, note_file):
+        '''
+        Returns the ID of the commit that created the given note file, or None if it was never committed.
+
+        Renames are followed the same way as scan_git_seano_db() follows them, including conversions between note
+        formats (see convert_notes()), which `git log --follow` does not recognize, because the contents change.
+        '''
+        path, rev = os.path.relpath(note_file, self.repo).replace('\\', '/'), 'HEAD'
+        while True:
+            out = [x for x in coerce_to_str(subprocess.check_output(
+                ['git', 'log', '-M100%', '--follow', '--diff-filter=A', '--format=%H', '--name-only', rev, '--',
+                 path], cwd=self.repo)).splitlines() if x]
+            if out:
+                # A note converted to another format is created by the same commit that deletes the original:
+                created_in, path = out[0], out[1]
+                before, is_gone = created_in + '^', lambda x: not self.is_committed_note_file(created_in, x)
+            else:
+                # The note was created in the working directory, possibly by converting a committed note:
+                created_in, before, is_gone = None, rev, lambda x: not os.path.exists(os.path.join(self.repo, x))
+            converted_from = [x for x in [posixpath.splitext(path)[0] + ext for ext in SEANO_NOTE_EXTENSIONS]
+                              if x != path and self.is_committed_note_file(before, x) and is_gone(x)]
+            if not converted_from:
+                return created_in
+            path, rev = converted_from[0], before
+
+    def is_committed_note_file(self, rev, path):
+        'Returns whether the given note file (relative to the repository) exists in the given commit.'
+        return 0 == subprocess.call(['git', 'cat-file', '-e', '%s:%s' % (rev, path)], cwd=self.repo,
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def query_snapshots(self, snapshots, stream_releases=False, normalized=False, note_fields=None, note_filters=None,
+                        since_release=None, max_releases=None, ancestor_closure=False, jobs=1, note_cache=False):
+        '''
+        Same as query(), except that a query result is returned for each of the given (ref, current_version) pairs,
+        as if the query was performed with the ref checked out (in a clean working directory), and with
+        current_version configured to the given value.  seano-config.yaml is always read from the working directory.
+
+        All snapshots share a single read of the commit graph, and each distinct version of each note file is only
+        parsed once.  When jobs is greater than 1, the distinct versions of the note files of all snapshots are parsed
+        up front by a pool of that many processes.  When note_cache is set, parsed notes are read from (and saved to)
+        the same persistent cache as query() (see open_note_cache()).
+        '''
+        heads = []
+        for ref, current_version in snapshots:
+            try:
+                commit_id = coerce_to_str(subprocess.check_output(['git', 'rev-parse', '--verify', ref + '^{commit}'],
+                                                                  cwd=self.repo, stderr=subprocess.PIPE)).strip()
+            except subprocess.CalledProcessError:
+                raise SeanoFatalError('Unable to resolve snapshot ref: %s' % (ref,))
+            heads.append((intern_str(commit_id), current_version))
+
+        # Read the commit graph once, for all snapshots:
+        commits = list(self.iter_commits(sorted(set([x for x, _ in heads]))))
+        commits_by_id = {x.commit_id: x for x in commits}
+
+        documents = {}  # blob ID -> list of Yaml documents
+        blob_reader = GitBlobReader(self.repo)
+        # (Originals of reference-style extern notes are read from the working directory, unless cached:)
+        extern_resolver = self.open_extern_resolver(note_cache=note_cache)
+        cache = self.open_note_cache() if note_cache else None
+        results = []
+        try:
+            note_blobs = {commit_id: self.list_note_blobs(commit_id) for commit_id, _ in heads}
+
+            preloaded = {}
+            if jobs > 1:
+                is_json_blob = {}  # blob ID -> whether the blob is a Json note
+                for blobs in note_blobs.values():
+                    for filename, blob_id in blobs.items():
+                        is_json_blob[blob_id] = is_json_note_file(filename)
+                todo = sorted([x for x in is_json_blob if cache is None or cache.lookup_blob(x) is None])
+                if len(todo) > 1:
+                    preloaded = preload_note_data([(x, coerce_to_unicode_str(blob_reader.read(x)), is_json_blob[x])
+                                                   for x in todo], jobs)
+
+            for commit_id, current_version in heads:
+                # Only the history of this snapshot's commit is part of this snapshot:
+                reachable = set()
+                todo = [commit_id]
+                while todo:
+                    x = todo.pop()
+                    if x not in reachable and x in commits_by_id:
+                        reachable.add(x)
+                        todo.extend(commits_by_id[x].parents)
+
+                pack = self.read_committed_note_pack(commit_id, blob_reader)
+
+                def load_note_documents(filename, blobs=note_blobs[commit_id], pack=pack):
+                    if filename in pack.by_path:
+                        return copy.deepcopy(pack.load(filename))
+                    blob_id = blobs[filename]
+                    if blob_id not in documents:
+                        docs = cache.lookup_blob(blob_id) if cache is not None else None
+                        if docs is None:
+                            docs = preloaded.pop(blob_id, None)
+                            if docs is None:
+                                data = coerce_to_unicode_str(blob_reader.read(blob_id))
+                                docs = load_note_stream(io.StringIO(data), is_json=is_json_note_file(filename))
+                            if cache is not None:
+                                docs = cache.store_blob(blob_id, docs)
+                        documents[blob_id] = docs
+                    # The same parsed documents are shared by all snapshots; hand out copies:
+                    return copy.deepcopy(documents[blob_id])
+
+                config = dict(self.config)
+                config['current_version'] = current_version
+                s = SeanoDataAggregator(config, note_fields=note_fields, note_filters=note_filters,
+                                        note_loader=load_note_documents, extern_resolver=extern_resolver)
+                for thing in self.scan_git_seano_db(False, commits=[x for x in commits if x.commit_id in reachable],
+                                                    current_version=current_version):
+                    for filename, info in thing.get('notes', {}).items():
+                        if s.accepts_note_file(filename):
+                            f = os.path.join(self.repo, filename)
+                            s.import_note(path=f, uid=self.extract_uid_from_filename(f), **info)
+                    for name, info in thing.get('releases', {}).items():
+                        s.import_release_info(name, **info)
+                for path, uid, info in self.list_packed_notes(s, pack):
+                    s.import_note(path=path, uid=uid, **info)
+
+                if since_release is not None or max_releases is not None:
+                    s.truncate_releases(s.list_release_window(since_release=since_release, max_releases=max_releases))
+
+                results.append(self.make_query_result(s, config, stream_releases=stream_releases, normalized=normalized,
+                                                      ancestor_closure=ancestor_closure))
+        finally:
+            blob_reader.close()
+        if cache is not None:
+            cache.save()
+        extern_resolver.save()
+        return results
+
+    def list_note_blobs(self, commit_id):
+        '''
+        Returns the blob ID of each note file in the given commit, keyed by the absolute path of the note file.
+        '''
+        out = coerce_to_str(subprocess.check_output(
+            ['git', 'ls-tree', '-r', '-z', commit_id, '--', os.path.relpath(self.db_objs, self.repo)], cwd=self.repo))
+        result = {}
+        for line in out.split('\0'):
+            info, _, path = line.partition('\t')
+            info = info.split()
+            if len(info) == 3 and info[1] == 'blob':
+                # (git outputs these paths with forward slashes on all platforms!)
+                result[os.path.join(self.repo, *path.split('/'))] = info[2]
         return result
 
+    def read_committed_note_pack(self, commit_id, blob_reader):
+        'Returns the NotePack of the pack files in the given commit, read using the given GitBlobReader.'
+        packs_dir = os.path.join(self.path, SEANO_DB_PACK_SUBDIR)
+        out = coerce_to_str(subprocess.check_output(
+            ['git', 'ls-tree', '-r', '-z', commit_id, '--', os.path.relpath(packs_dir, self.repo)], cwd=self.repo))
+        pack_files = []
+        for line in out.split('\0'):
+            info, _, path = line.partition('\t')
+            info = info.split()
+            if len(info) == 3 and info[1] == 'blob' and path.endswith(SEANO_NOTE_PACK_EXTENSION):
+                # (git outputs these paths with forward slashes on all platforms!)
+                pack_files.append((os.path.join(self.repo, *path.split('/')), coerce_to_str(blob_reader.read(info[2]))))
+        return NotePack(self.db_objs, pack_files)
+
+    def list_clean_note_blobs(self):
+        '''
+        Returns the blob ID of each note file in the index whose working copy is unmodified, keyed by the absolute
+        path of the note file.
+        '''
+        # -t tags each entry: H means cached, C means modified in the working directory (or deleted, or intent-to-add):
+        out = coerce_to_str(subprocess.check_output(
+            ['git', 'ls-files', '-s', '-t', '-c', '-m', '-z', '--', os.path.relpath(self.db_objs, self.repo)],
+            cwd=self.repo))
+        blobs = {}
+        modified = set()
+        for line in out.split('\0'):
+            info, _, path = line.partition('\t')
+            info = info.split()
+            if len(info) != 4:
+                continue
+            # (git outputs these paths with forward slashes on all platforms!)
+            path = os.path.join(self.repo, *path.split('/'))
+            if info[0] == 'H' and info[3] == '0':
+                blobs[path] = info[2]
+            else:
+                modified.add(path)
+        return {k: v for k, v in blobs.items() if k not in modified}
+
+    def open_note_cache(self):
+        '''
+        Opens a persistent cache of parsed notes keyed by blob ID, stored in the Git common directory, so that all
+        worktrees, branches and clones of the repository share parse results.
+        '''
+        common_dir = coerce_to_str(subprocess.check_output(['git', 'rev-parse', '--git-common-dir'],
+                                                           cwd=self.repo)).strip()
+        cache_file = os.path.join(self.repo, common_dir, 'seano', 'note-cache.pickle')
+        return GitBlobNoteCache(cache_file, self.list_clean_note_blobs())
+
+    def get_new_note_automatic_attributes(self, aggregator, uid):
+        if uid in aggregator.note_automatic_attributes:
+            # Previously discovered by the Git scanner; keep what the scanner said.
+            return {}
+        # A note that the Git scanner has not seen yet is, by definition, uncommitted:
+        return dict(commits=[None], releases=[self.config['current_version']])
+
     _cached_ref_parsers = None
     def get_ref_parsers(self):
         '''
@@ -210,9 +727,12 @@ class GitSeanoDatabase(GenericSeanoDatabase):
                     m = self.regex().search(ref)
                     if not m: return None
                     subs = m.groupdict()
-                    return {
+                    result = {
                         k: v.format(**subs) if isinstance(v, str) else v for k, v in self.release.items()
                     }
+                    # Release names are repeated on every note in the release; share one copy:
+                    result['name'] = intern_str(result['name'])
+                    return result
 
             def make_parsers():
                 for idx, cfg in enumerate(self.config.get('ref_parsers') or DEFAULT_REF_PARSERS):
@@ -296,13 +816,110 @@ class GitSeanoDatabase(GenericSeanoDatabase):
         return sorted(releases, key=lambda d: semverish_sort_key(d.get('comparable-name') or d['name']))
 
 
-    def scan_git_seano_db(self, include_modified):
+    def iter_commits(self, revisions=None, name_status=True):
+        '''
+        Reads the commit graph reachable from the given revisions (git log arguments; defaults to HEAD), and yields
+        a GitCommit object for each commit, in topological order (newest first).  Release tags are parsed using
+        parse_refs().  Unless name_status is set, the files changed by each commit are not read (which is much
+        faster), and GitCommit.raw_name_statuses is empty.
+        '''
+        def yield_commit_info_hunks():
+
+            # Fire up the massive commit graph dump.  Example output:
+            #
+            # 1     a8dc74cb0fca0405ce4f9ecc8f2718b2accb6dc6 7b936ed3b4116e2615c6fdf1c119823f6c2a8e9c (tag: refs/tags/v1.2.3, refs/remotes/origin/master, refs/remotes/origin/HEAD)
+            # 2     A       docs/seano-db/v1/60/8bb47a848f6e8949c5f2545b0d0056.yaml
+            # 3     R100    mac/docs/seano-db/v1/ae/55628fcf4f49975d7c949c52be8bc7.yaml       docs/seano-db/v1/42/713c898b24a0220133cc9696f990ab.yaml
+            # 4     D       mac/docs/seano-db/v1/ef/9a7df3ab58c8583a42f258ac8cf0b1.yaml
+            # 5     M       some/other/file.txt
+            #
+            #   1. Commit hash; parent hashes (missing if none); refs (missing if none)
+            #   2. Added files (ding ding ding!  report this note)
+            #   3. Renamed files (track rename in `heap`)
+            #   4. Deleted files (ban this file from ever being reported)
+            #   5. Modified files (report this note iff `include_modified`)
+            #
+            # ABK: WARNING: The slashes in the paths are ALWAYS forward slashes (/), even on Windows.
+            #      More on that later.
+
+            # ABK: For performance reasons, slurp stdout instead of loading the entire Git history all at once.
+            #      Because we're yielding results instead of returning a final list, the caller can deallocate
+            #      our generator before we finish reading the entire Git history.  (Assuming this syntax is
+            #      correct, of course)
+            p = subprocess.Popen(
+                ['git', 'log', '--topo-order', '--decorate=full'] + (['--name-status', '-M100%'] if name_status else [])
+                + ['--pretty=format:%H %P%d'] + list(revisions or []),
+                cwd=self.repo, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                bufsize=4096, # hopefully large enough to capture any possible stderr without blocking
+            )
+            p.stdin.close()
+
+            def possibly_dump_stderr():
+                if p.poll() is not None and p.returncode != 0:
+                    raise SeanoFatalError('unable to read commit graph: %s' % (p.stderr.read().strip(),))
+
+            accumulator = []
+            commit_begin_regex = re.compile('^[0-9a-f]{6,}')
+
+            possibly_dump_stderr()
+            for line in iter(p.stdout.readline, ""):
+                possibly_dump_stderr()
+                if not line:
+                    # Normally, all read lines include the EOL.
+                    # If we read literally nothing, then the pipe has been closed,
+                    # which may mean the app has exited.  Well?  Has the app exited?
+                    if p.poll() is not None:
+                        break # app has exited; bail on the read loop
+                line = coerce_to_str(line.strip())
+                if accumulator and commit_begin_regex.match(line):
+                    yield accumulator
+                    accumulator = []
+                if line: # ignore empty lines
+                    accumulator.append(line)
+            yield accumulator
+
+        ws_split = re.compile(r'(\s+)').split
+        ref_split = re.compile(r'(?:HEAD \->|tags?:|\(|\)|,|\s)+').split
+
+        for hunk in yield_commit_info_hunks():
+            header, changes = hunk[0], hunk[1:]
+
+            hashes, _, refs = header.partition('(')
+
+            hashes = [intern_str(x) for x in ws_split(hashes)]
+            commit_id, parents = hashes[0], hashes[1:]
+
+            refs = ref_split(refs)
+
+            parents = [x for x in parents if x]
+            refs = [x for x in refs if x]
+
+            releases = self.parse_refs(refs)
+
+            yield GitCommit(
+                commit_id = commit_id,
+                parents = parents,
+                refs = refs,
+                releases = releases,
+                raw_name_statuses = changes,
+            )
+
+
+    def scan_git_seano_db(self, include_modified, track_pending_releases=False, since_commit=None, commits=None,
+                          current_version=None):
         '''
         Uses Git to read the local seano database (as opposed to reading the filesystem).  In a nutshell, this means
         that we report note files in reverse order of creation date, and we can parse tags to deduce releases.
 
         Args:
             include_modified (bool-ish): change sort order of note files from A (added) to AM (added || modified)
+            track_pending_releases (bool-ish): after each commit, also yield the set of releases that notes in
+                                               not-yet-scanned commits may still be attributed to
+            since_commit (str): only scan the commits between the given commit and HEAD (the releases and
+                                release ancestry found there are complete; older history is never read)
+            commits (list): scan these commits (see iter_commits()) instead of the history of HEAD and the working
+                            directory; the first commit is treated as HEAD
+            current_version (str): the name of the release at HEAD; defaults to the configured current_version
 
         Yields:
             Dictionaries of juicy info
@@ -334,6 +951,12 @@ class GitSeanoDatabase(GenericSeanoDatabase):
                 }
             }
 
+            # The releases that notes in not-yet-scanned commits may still be attributed to:
+            # (only yielded when track_pending_releases is Trueish, once after each commit)
+            {
+                'pending-releases' : set([<name>, ...])
+            }
+
         This function does NOT read note files from disk.  This is important to understand, namely because a note file
         may explicitly override its list of releases.  If a note file is to be read from disk (such as what happens
         during a query), it is expected that the caller will take the partial note created by this function, which
@@ -368,14 +991,6 @@ class GitSeanoDatabase(GenericSeanoDatabase):
 
         def yield_commits():
 
-            class Commit(object):
-                def __init__(self, commit_id, parents, refs, releases, raw_name_statuses):
-                    self.commit_id = commit_id
-                    self.parents = parents
-                    self.refs = refs
-                    self.releases = releases
-                    self.raw_name_statuses = raw_name_statuses
-
             diff_opts = [
                 '-M100%',
                 '--name-status',
@@ -410,7 +1025,7 @@ class GitSeanoDatabase(GenericSeanoDatabase):
             # (by pretending that this is a commit, we simplify the algorithm later)
 
             if uncommitted_changes:
-                yield Commit(
+                yield GitCommit(
                     commit_id = None,
                     parents = [coerce_to_str(subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.repo)).strip()],
                     refs = [],
@@ -418,91 +1033,23 @@ class GitSeanoDatabase(GenericSeanoDatabase):
                     raw_name_statuses = uncommitted_changes,
                 )
 
-            def yield_commit_info_hunks():
-
-                # Fire up the massive commit graph dump.  Example output:
-                #
-                # 1     a8dc74cb0fca0405ce4f9ecc8f2718b2accb6dc6 7b936ed3b4116e2615c6fdf1c119823f6c2a8e9c (tag: refs/tags/v1.2.3, refs/remotes/origin/master, refs/remotes/origin/HEAD)
-                # 2     A       docs/seano-db/v1/60/8bb47a848f6e8949c5f2545b0d0056.yaml
-                # 3     R100    mac/docs/seano-db/v1/ae/55628fcf4f49975d7c949c52be8bc7.yaml       docs/seano-db/v1/42/713c898b24a0220133cc9696f990ab.yaml
-                # 4     D       mac/docs/seano-db/v1/ef/9a7df3ab58c8583a42f258ac8cf0b1.yaml
-                # 5     M       some/other/file.txt
-                #
-                #   1. Commit hash; parent hashes (missing if none); refs (missing if none)
-                #   2. Added files (ding ding ding!  report this note)
-                #   3. Renamed files (track rename in `heap`)
-                #   4. Deleted files (ban this file from ever being reported)
-                #   5. Modified files (report this note iff `include_modified`)
-                #
-                # ABK: WARNING: The slashes in the paths are ALWAYS forward slashes (/), even on Windows.
-                #      More on that later.
-
-                # ABK: For performance reasons, slurp stdout instead of loading the entire Git history all at once.
-                #      Because we're yielding results instead of returning a final list, the caller can deallocate
-                #      our generator before we finish reading the entire Git history.  (Assuming this syntax is
-                #      correct, of course)
-                p = subprocess.Popen(
-                    ['git', 'log', '--topo-order', '--decorate=full', '--name-status', '-M100%',
-                     '--pretty=format:%H %P%d'],
-                    cwd=self.repo, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
-                    bufsize=4096, # hopefully large enough to capture any possible stderr without blocking
-                )
-                p.stdin.close()
-
-                def possibly_dump_stderr():
-                    if p.poll() is not None and p.returncode != 0:
-                        raise SeanoFatalError('unable to read commit graph: %s' % (p.stderr.read().strip(),))
+            revisions = []
+            bottoms = [] if since_commit is None else coerce_to_str(subprocess.check_output(
+                ['git', 'rev-parse', since_commit + '^@'], cwd=self.repo)).split()
+            if bottoms:
+                # Every descendant of the parents of since_commit that is also an ancestor of HEAD:
+                # (a root commit has no parents, in which case everything is an ancestor of HEAD anyways)
+                revisions = ['--ancestry-path', 'HEAD'] + ['^' + x for x in bottoms]
+            for commit in self.iter_commits(revisions):
+                yield commit
 
-                accumulator = []
-                commit_begin_regex = re.compile('^[0-9a-f]{6,}')
+        if current_version is None:
+            current_version = self.config['current_version']
 
-                possibly_dump_stderr()
-                for line in iter(p.stdout.readline, ""):
-                    possibly_dump_stderr()
-                    if not line:
-                        # Normally, all read lines include the EOL.
-                        # If we read literally nothing, then the pipe has been closed,
-                        # which may mean the app has exited.  Well?  Has the app exited?
-                        if p.poll() is not None:
-                            break # app has exited; bail on the read loop
-                    line = coerce_to_str(line.strip())
-                    if accumulator and commit_begin_regex.match(line):
-                        yield accumulator
-                        accumulator = []
-                    if line: # ignore empty lines
-                        accumulator.append(line)
-                yield accumulator
-
-            ws_split = re.compile(r'(\s+)').split
-            ref_split = re.compile(r'(?:HEAD \->|tags?:|\(|\)|,|\s)+').split
-
-            for hunk in yield_commit_info_hunks():
-                header, changes = hunk[0], hunk[1:]
-
-                hashes, _, refs = header.partition('(')
-
-                hashes = ws_split(hashes)
-                commit_id, parents = hashes[0], hashes[1:]
-
-                refs = ref_split(refs)
-
-                parents = [x for x in parents if x]
-                refs = [x for x in refs if x]
-
-                releases = self.parse_refs(refs)
-
-                yield Commit(
-                    commit_id = commit_id,
-                    parents = parents,
-                    refs = refs,
-                    releases = releases,
-                    raw_name_statuses = changes,
-                )
-
-        # Declare self.config['current_version'] as a release, to help downstream systems more
+        # Declare current_version as a release, to help downstream systems more
         # easily get release sort order correct:
         yield {'releases' : {
-            self.config['current_version'] : {}, # no info; just declare that it exists
+            current_version : {}, # no info; just declare that it exists
         }}
 
         # Prepare to traverse the commit graph
@@ -528,7 +1075,7 @@ class GitSeanoDatabase(GenericSeanoDatabase):
             # Within the v1 folder, allow any non-empty file/folder...
             '.+',
             # ... so long as it ends with the correct file extension.
-            re.escape(SEANO_NOTE_EXTENSION),
+            '(' + '|'.join(map(re.escape, SEANO_NOTE_EXTENSIONS)) + ')',
             '$',
         ])
         log.debug('pattern used to detect new notes is %s', primary_note_pattern)
@@ -538,7 +1085,7 @@ class GitSeanoDatabase(GenericSeanoDatabase):
         current_releases = {}  # Dictionary of sets of release *names*, organized per-commit
         distant_releases = {}  # Dictionary of sets of release *names*, organized per-commit
 
-        for commit in yield_commits():
+        for commit in (yield_commits() if commits is None else commits):
             log.debug('Investigating commit %s', commit.commit_id)
 
             if is_first_iteration:
@@ -551,14 +1098,14 @@ class GitSeanoDatabase(GenericSeanoDatabase):
                 # We should report the commit ID of the HEAD release:
 
                 yield {'releases' : {
-                    self.config['current_version'] : {
+                    current_version : {
                         'commit' : commit.commit_id,
                     },
                 }}
 
                 # Next, seed our tracking structures:
 
-                if self.config['current_version'] in [x['name'] for x in commit.releases]:
+                if current_version in [x['name'] for x in commit.releases]:
                     # If the git scanner (i.e., the `yield_commits()` method)
                     # found a release that is identical to the current product
                     # version, then that means we're building on a tag.  Because
@@ -570,7 +1117,7 @@ class GitSeanoDatabase(GenericSeanoDatabase):
                     current_releases[commit.commit_id] = set()
                     distant_releases[commit.commit_id] = set()
                 else:
-                    local_current_releases.append(self.config['current_version'])
+                    local_current_releases.append(current_version)
                     current_releases[commit.commit_id] = set(local_current_releases)
                     distant_releases[commit.commit_id] = set()
 
@@ -647,10 +1194,21 @@ class GitSeanoDatabase(GenericSeanoDatabase):
             if sys.platform in ['win32']:
                 dirsep_patch_func = lambda s: os.path.join(*s.split('/'))
 
+            # Converting a note between Yaml and Json (see `seano convert`) deletes it and adds it with another file
+            # extension, in the same commit.  Git does not consider that a rename (the contents changed), but we do:
+            changes = [x.split('\t') for x in commit.raw_name_statuses]
+            deleted_note_stems = {os.path.splitext(x[1])[0]: x[1] for x in changes
+                                  if x[0] == 'D' and x[1].endswith(SEANO_NOTE_EXTENSIONS)}
+            conversions = {x[1]: deleted_note_stems[os.path.splitext(x[1])[0]] for x in changes
+                           if x[0] == 'A' and os.path.splitext(x[1])[0] in deleted_note_stems}
+
             # Identify any reportable note files:
             notes_to_report = []
-            for change in commit.raw_name_statuses:
-                change = change.split('\t')
+            for change in changes:
+                if change[0] == 'A' and change[1] in conversions:
+                    change = ['R100', conversions[change[1]], change[1]]
+                elif change[0] == 'D' and change[1] in conversions.values():
+                    continue
                 code = change[0]
                 if code == 'A' or (include_modified and code == 'M'):
                     fname = change[1]
@@ -683,11 +1241,20 @@ class GitSeanoDatabase(GenericSeanoDatabase):
             notes_to_report = [x for x in notes_to_report if not x.get('delete', False)]
 
             if notes_to_report:
+                # All notes in this hunk share the same (immutable) set of releases:
+                releases = frozenset(current_releases[commit.commit_id])
                 # Report notes:
                 yield dict(notes={
                     n['path'] : dict(
                         commits=[commit.commit_id],
-                        releases=current_releases[commit.commit_id],
+                        releases=releases,
                     )
                     for n in notes_to_report
                 })
+
+            if track_pending_releases:
+                # This commit is done.  Every commit we have not visited yet is an ancestor of a commit still
+                # listed in current_releases, so its notes can only be attributed to releases listed there:
+                del current_releases[commit.commit_id]
+                del distant_releases[commit.commit_id]
+                yield {'pending-releases' : set().union(*current_releases.values())}
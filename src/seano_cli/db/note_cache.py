@@ -0,0 +1,306 @@
+"""
+seano_cli/db/note_cache.py
+
+Persistent cache of parsed note files, so that a query only needs to parse the notes that changed since the last query
+"""
+
+from seano_cli.db.common import is_json_note_file, load_note_file, load_note_stream
+from seano_cli.db.schema_upgrade import upgrade_note_schema
+from seano_cli.utils import *
+import copy
+import hashlib
+import io
+import logging
+import os
+import pickle
+import tempfile
+import time
+
+log = logging.getLogger(__name__)
+
+# Bump this whenever the structure of cache entries, or the way notes are parsed or upgraded, changes:
+NOTE_CACHE_FORMAT = 1
+
+# A file modified within this many seconds of being read might be modified again without its size or mtime changing
+# (mtime resolution is coarse on some filesystems).  Such files are not cached until they settle down:
+NOTE_CACHE_RACY_SECONDS = 2
+
+
+def get_default_note_cache_file(db_path):
+    '''
+    Returns the path of the note cache file to use for the seano database located at the given path.
+
+    Cache files live in the user's cache directory, so that they never show up in the working directory.
+    '''
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    name = hashlib.sha1(coerce_to_ascii_str(os.path.abspath(db_path))).hexdigest()
+    return os.path.join(cache_dir, 'seano', 'notes-' + name + '.pickle')
+
+
+def get_default_extern_note_cache_file():
+    '''
+    Returns the path of the cache of parsed extern notes used by ExternReferenceResolver.
+
+    Entries are keyed by the sha1 of each note, so a single cache is shared by all databases.
+    '''
+    cache_dir = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(cache_dir, 'seano', 'extern-notes.pickle')
+
+
+def read_cache_file(cache_file):
+    'Returns the entries stored in the given cache file, or an empty dictionary if it is missing or unusable.'
+    try:
+        with open(cache_file, 'rb') as f:
+            version, entries = pickle.load(f)
+        if version == NOTE_CACHE_FORMAT:
+            return entries
+    except Exception as e:
+        # A missing, outdated or corrupt cache is simply empty; it gets replaced next time it is saved.
+        log.debug('Not using note cache %s: %s', cache_file, e)
+    return {}
+
+
+def write_cache_file(cache_file, entries):
+    'Replaces the given cache file with the given entries.  Returns True on success.'
+    cache_dir = os.path.dirname(cache_file)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        fd, tmp = tempfile.mkstemp(prefix='.notes-', dir=cache_dir)
+        with os.fdopen(fd, 'wb') as f:
+            pickle.dump((NOTE_CACHE_FORMAT, entries), f, pickle.HIGHEST_PROTOCOL)
+        # Replace the old cache atomically, so that concurrent queries never see a partially written file:
+        getattr(os, 'replace', os.rename)(tmp, cache_file)
+    except (IOError, OSError) as e:
+        # The cache is only an optimization; never fail a query because of it.
+        log.debug('Unable to save note cache %s: %s', cache_file, e)
+        return False
+    return True
+
+
+def hash_git_blob(data, hash_name='sha1'):
+    'Returns the Git blob ID of the given bytes.'
+    return hashlib.new(hash_name, coerce_to_ascii_str('blob %d\0' % (len(data),)) + data).hexdigest()
+
+
+def upgrade_note_documents(documents):
+    'Returns a copy of the given Yaml documents from a note file, with the schema of each key upgraded.'
+    return [{k: upgrade_note_schema(k, v) for k, v in d.items()} if isinstance(d, dict) else d for d in documents]
+
+
+class NoteCache(object):
+    '''
+    A persistent cache of the parsed and schema-upgraded Yaml documents in note files.
+
+    Entries are keyed by the path of each note relative to the database, and are validated with a single stat() of
+    the note file; an entry is only used when the size, mtime and inode of the file are all unchanged.  Everything
+    else is parsed from disk (and cached for next time).
+    '''
+    def __init__(self, cache_file, root):
+        self.cache_file = cache_file
+        self.root = root
+        self.entries = {}  # relative path -> (size, mtime_ns, inode, documents)
+        self.used = set()  # relative paths looked up since the cache was opened
+        self.entries.update(read_cache_file(cache_file))
+        self.is_dirty = False
+
+    def stat(self, filename):
+        'Returns the (size, mtime_ns, inode) key of the given file, and its mtime.'
+        st = os.stat(filename)
+        return (st.st_size, st.st_mtime_ns, st.st_ino), st.st_mtime
+
+    def lookup(self, filename):
+        'Returns the cached documents of the given note file, or None if the file is new or changed.'
+        relpath = os.path.relpath(filename, self.root)
+        self.used.add(relpath)
+        entry = self.entries.get(relpath)
+        if entry is None:
+            return None
+        try:
+            key, _ = self.stat(filename)
+        except OSError:
+            return None
+        return entry[3] if entry[:3] == key else None
+
+    def store(self, filename, documents, stat=None):
+        '''
+        Caches the given (freshly parsed) Yaml documents of the given note file, and returns the upgraded documents.
+
+        If the file has been stat'ed before it was parsed, pass that result; otherwise, the file is stat'ed now.
+        '''
+        documents = upgrade_note_documents(documents)
+        key, mtime = stat or self.stat(filename)
+        if time.time() - mtime >= NOTE_CACHE_RACY_SECONDS:
+            self.entries[os.path.relpath(filename, self.root)] = key + (documents,)
+            self.is_dirty = True
+        return documents
+
+    def load(self, filename):
+        'Returns the Yaml documents of the given note file, parsing the file only if it is not cached.'
+        documents = self.lookup(filename)
+        if documents is None:
+            stat = self.stat(filename)
+            documents = self.store(filename, load_note_file(filename), stat=stat)
+        return documents
+
+    def save(self):
+        '''
+        Writes the cache back to disk, if anything changed.
+
+        Entries of notes that were not looked up are kept only if their file still exists, so that partial queries
+        (such as filtered or windowed queries) don't evict anything.
+        '''
+        for relpath in [x for x in self.entries if x not in self.used]:
+            if not os.path.exists(os.path.join(self.root, relpath)):
+                del self.entries[relpath]
+                self.is_dirty = True
+        if self.is_dirty and write_cache_file(self.cache_file, self.entries):
+            self.is_dirty = False
+
+
+class GitBlobNoteCache(object):
+    '''
+    A persistent cache of the parsed and schema-upgraded Yaml documents in note files, keyed by Git blob ID.
+
+    Blob IDs address contents, so entries are valid no matter which branch, worktree or clone a note file is read
+    from.  The blob IDs of note files whose working copy matches the index are provided up front (see
+    GitSeanoDatabase.list_clean_note_blobs()), so looking up those notes does not open any file at all.  Other note
+    files (untracked, or modified in the working directory) are hashed the way Git would hash them.
+    '''
+    def __init__(self, cache_file, blob_ids):
+        self.cache_file = cache_file
+        self.blob_ids = blob_ids  # absolute path -> blob ID
+        self.hash_name = 'sha256' if any([len(x) == 64 for x in blob_ids.values()]) else 'sha1'
+        self.entries = read_cache_file(cache_file)  # blob ID -> documents
+        self.used = set()  # blob IDs looked up since the cache was opened
+        self.is_dirty = False
+
+    def read(self, filename):
+        'Returns the blob ID of the given note file, plus its contents if they had to be read to compute the ID.'
+        blob_id = self.blob_ids.get(filename)
+        if blob_id is not None:
+            return blob_id, None
+        with open(filename, 'rb') as f:
+            data = f.read()
+        return hash_git_blob(data, self.hash_name), data
+
+    def lookup(self, filename):
+        'Returns the cached documents of the given note file, or None if its contents have not been parsed before.'
+        try:
+            blob_id, _ = self.read(filename)
+        except (IOError, OSError):
+            return None
+        return self.lookup_blob(blob_id)
+
+    def lookup_blob(self, blob_id):
+        'Returns the cached documents of the given blob, or None if it has not been parsed before.'
+        self.used.add(blob_id)
+        return self.entries.get(blob_id)
+
+    def store_blob(self, blob_id, documents):
+        'Caches the given (freshly parsed) Yaml documents of the given blob, and returns the upgraded documents.'
+        documents = upgrade_note_documents(documents)
+        self.entries[blob_id] = documents
+        self.used.add(blob_id)
+        self.is_dirty = True
+        return documents
+
+    def store(self, filename, documents, stat=None):
+        '''
+        Caches the given (freshly parsed) Yaml documents of the given note file, and returns the upgraded documents.
+
+        Only files whose blob ID is known up front are cached here; the contents of other files might have changed
+        since they were parsed.  (load() caches those, because it hashes and parses the very same bytes.)
+        '''
+        blob_id = self.blob_ids.get(filename)
+        if blob_id is not None:
+            return self.store_blob(blob_id, documents)
+        return upgrade_note_documents(documents)
+
+    def load(self, filename):
+        'Returns the Yaml documents of the given note file, parsing the file only if its blob is not cached.'
+        blob_id, data = self.read(filename)
+        self.used.add(blob_id)
+        documents = self.entries.get(blob_id)
+        if documents is None:
+            if data is None:
+                documents = load_note_file(filename)
+            else:
+                # Parse the same bytes that were hashed, with the same newline handling as reading a text file:
+                documents = load_note_stream(io.StringIO(coerce_to_unicode_str(data), newline=None),
+                                             is_json=is_json_note_file(filename))
+            documents = upgrade_note_documents(documents)
+            self.entries[blob_id] = documents
+            self.is_dirty = True
+        return documents
+
+    def save(self):
+        '''
+        Writes the cache back to disk, if anything changed.
+
+        Entries of blobs that are neither in the index nor were looked up are kept for the sake of other branches and
+        worktrees, until they outnumber the entries in use.
+        '''
+        live = self.used | set(self.blob_ids.values())
+        stale = [x for x in self.entries if x not in live]
+        if len(stale) > len(self.entries) - len(stale):
+            for x in stale:
+                del self.entries[x]
+            self.is_dirty = True
+        if self.is_dirty and write_cache_file(self.cache_file, self.entries):
+            self.is_dirty = False
+
+
+class ExternReferenceResolver(object):
+    '''
+    Resolves the contents of reference-style extern notes (see GenericSeanoDatabase.import_extern_note()).
+
+    A reference-style extern note only contains the relative path and sha1 of its original; the original is read from
+    the extern database when the note is loaded.  When a cache file is given, parsed originals are cached by sha1, so
+    each version of each original is only parsed once, and remains available even after the extern database moves on
+    (or is no longer checked out).
+    '''
+    def __init__(self, db_path, cache_file=None):
+        self.db_path = db_path
+        self.cache_file = cache_file
+        self.entries = read_cache_file(cache_file) if cache_file else {}  # sha1 -> documents
+        self.is_dirty = False
+
+    def store(self, data, is_json=False):
+        'Parses and caches the given contents of an original note.  Returns the sha1 of the contents.'
+        sha1 = h_data(data)
+        if sha1 not in self.entries:
+            self.entries[sha1] = load_note_stream(io.StringIO(coerce_to_unicode_str(data), newline=None),
+                                                  is_json=is_json)
+            self.is_dirty = True
+        return sha1
+
+    def contains(self, sha1):
+        'Returns whether the original with the given sha1 is cached.'
+        return sha1 in self.entries
+
+    def resolve(self, filename, meta):
+        '''
+        Returns the Yaml documents of the original of the given reference-style extern note, whose first (metadata)
+        document is given.
+        '''
+        sha1 = meta.get(SEANO_NOTE_KEY_SHA1_OF_ORIGINAL_NOTE)
+        if sha1 not in self.entries:
+            original = os.path.join(self.db_path, *meta.get(SEANO_NOTE_KEY_RELPATH_TO_ORIGINAL_NOTE, '').split('/'))
+            try:
+                with open(original, 'r', **FILE_ENCODING_KWARGS) as f:
+                    data = f.read()
+            except (IOError, OSError) as e:
+                raise SeanoFatalError('Unable to read %s, the original of the extern note %s: %s\n'
+                                      'Is the extern database checked out?' % (original, filename, e))
+            if h_data(data) != sha1:
+                raise SeanoFatalError('%s has changed since it was imported as the extern note %s\n'
+                                      'Run `seano import` to update it.' % (original, filename))
+            self.store(data, is_json=is_json_note_file(original))
+        # The cached documents may be handed out again; hand out copies:
+        return copy.deepcopy(self.entries[sha1])
+
+    def save(self):
+        'Writes the cache back to disk, if anything changed.'
+        if self.cache_file and self.is_dirty and write_cache_file(self.cache_file, self.entries):
+            self.is_dirty = False
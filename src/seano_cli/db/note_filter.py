@@ -0,0 +1,79 @@
+"""
+seano_cli/db/note_filter.py
+
+Parses and evaluates the note filters used by ``seano query --where``.
+"""
+
+from seano_cli.utils import SeanoFatalError, ascii_str_type, unicode_str_type
+import logging
+import re
+import yaml
+
+log = logging.getLogger(__name__)
+
+
+class NoteFilter(object):
+    '''
+    A single predicate on the keys of a note.  Supported expressions are:
+
+    - ``key``: the note has the key, and its value is not empty (or False)
+    - ``!key``: the opposite of ``key``
+    - ``key=value``: the value of the key equals the given value, or, when the value of the key is a list, contains it
+    - ``key!=value``: the opposite of ``key=value``
+
+    The given value is compared both as a raw string and as a Yaml scalar, so that ``risk=high``,
+    ``x-seano-is-ghost=true``, and ``priority=3`` all do what you'd expect.
+    '''
+    _comparison_regex = re.compile(r'^(?P<key>[^!=]+?)\s*(?P<op>!?=)\s*(?P<value>.*)$')
+    _existence_regex = re.compile(r'^(?P<op>!?)\s*(?P<key>[^!=]+?)\s*$')
+
+    def __init__(self, expression):
+        self.expression = expression
+        m = self._comparison_regex.match(expression)
+        if m:
+            self.key = m.group('key')
+            self.is_negated = m.group('op') == '!='
+            self.values = [m.group('value')]
+            try:
+                value = yaml.safe_load(m.group('value'))
+            except yaml.YAMLError:
+                value = None
+            if value is not None and value not in self.values:
+                self.values.append(value)
+            return
+        m = self._existence_regex.match(expression)
+        if m:
+            self.key = m.group('key')
+            self.is_negated = m.group('op') == '!'
+            self.values = None
+            return
+        raise SeanoFatalError('Unable to parse note filter: "%s" (expected one of key, !key, key=value, or key!=value)'
+                              % (expression,))
+
+    def __repr__(self):
+        return 'NoteFilter(%r)' % (self.expression,)
+
+    def matches_value(self, value):
+        '''
+        Returns whether or not a note with the given value (or None, if the key is missing) matches this filter.
+        '''
+        if self.values is None:
+            result = bool(value)
+        elif isinstance(value, (list, set, frozenset)):
+            result = any([self.is_equal(x) for x in value])
+        else:
+            result = value is not None and self.is_equal(value)
+        return result != self.is_negated
+
+    def is_equal(self, value):
+        if isinstance(value, (ascii_str_type, unicode_str_type)):
+            return value in self.values
+        return any([value == x and type(value) == type(x) for x in self.values])
+
+    def matches(self, note):
+        return self.matches_value(note.get(self.key))
+
+
+def parse_note_filters(expressions):
+    'Parses a list of note filter expressions (strings) into a list of NoteFilter objects.'
+    return [x if isinstance(x, NoteFilter) else NoteFilter(x) for x in (expressions or [])]
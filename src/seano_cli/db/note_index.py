@@ -0,0 +1,71 @@
+"""
+seano_cli/db/note_index.py
+
+Index of the note files inside a seano database folder, built with a single pass over the folder tree
+"""
+
+from seano_cli.constants import *
+import os
+import re
+
+_extern_id_regex = re.compile(r'\.extern\-(?P<name>.+)\.(yaml|json)$')
+
+
+def scandir(path):
+    '''
+    Returns a list of (name, is_dir, is_symlink, entry) tuples of the given folder.  entry is the os.DirEntry (which
+    caches the result of stat()).
+    '''
+    return [(x.name, x.is_dir(), x.is_symlink(), x) for x in os.scandir(path)]
+
+
+class NoteIndexEntry(object):
+    def __init__(self, path, uid, extern_id, dir_entry):
+        self.path = path
+        self.uid = uid
+        self.extern_id = extern_id
+        self.dir_entry = dir_entry
+
+    def stat(self):
+        return self.dir_entry.stat() if self.dir_entry is not None else os.stat(self.path)
+
+
+class NoteIndex(object):
+    '''
+    Lists every note file inside the given notes folder (SEANO_DB_SUBDIR), along with its uid and extern ID.
+
+    Notes are listed in the same order as os.walk() would find them.  The uid of each note is derived from the path
+    of its folder relative to the notes folder (see GenericSeanoDatabase.extract_uid_from_filename()), which is
+    computed once per folder, rather than once per note.
+    '''
+    def __init__(self, db_objs):
+        self.db_objs = db_objs
+        self.entries = []
+        if os.path.isdir(db_objs):
+            self.scan(db_objs, '')
+
+        self.by_path = {x.path: x for x in self.entries}
+        self.by_uid = {}
+        self.by_extern_id = {}
+        for x in self.entries:
+            self.by_uid.setdefault(x.uid, []).append(x)
+            self.by_extern_id.setdefault(x.extern_id, []).append(x)
+
+    def scan(self, folder, uid_prefix):
+        subfolders = []
+        for name, is_dir, is_symlink, dir_entry in scandir(folder):
+            if is_dir:
+                if not is_symlink:  # (os.walk() does not follow symlinks, either)
+                    subfolders.append(name)
+            elif name.endswith(SEANO_NOTE_EXTENSIONS):
+                m = _extern_id_regex.search(name)
+                uid = uid_prefix + os.path.splitext(os.path.splitext(name)[0])[0]
+                self.entries.append(NoteIndexEntry(os.path.join(folder, name), uid, m.group('name') if m else None,
+                                                   dir_entry))
+        # Same as os.walk(): all files in a folder come before the files in its subfolders:
+        for name in subfolders:
+            self.scan(os.path.join(folder, name), uid_prefix + name)
+
+    def list_notes_with_extern_id(self, extern_id):
+        'Returns the index entries of all notes imported from the extern database with the given ID.'
+        return self.by_extern_id.get(extern_id, [])
@@ -0,0 +1,109 @@
+"""
+seano_cli/db/note_pack.py
+
+Packs of old notes: many notes from fully released history, merged into a single archive file
+"""
+
+from seano_cli.utils import *
+import json
+import logging
+import os
+import re
+
+log = logging.getLogger(__name__)
+
+# Bump this whenever the structure of pack files changes:
+NOTE_PACK_FORMAT = 1
+
+
+def make_note_pack_filename(packs_dir, release_name):
+    'Returns the path of the pack file of the notes of the given release.'
+    return os.path.join(packs_dir, re.sub(r'[^a-zA-Z0-9._-]', '_', release_name) + SEANO_NOTE_PACK_EXTENSION)
+
+
+class PackedNote(object):
+    '''
+    A note stored inside a pack file.
+
+    path is the path the note file had before it was packed; the note is still addressed by that path (and its uid)
+    everywhere, even though the file no longer exists.  automatic_attributes is the list of automatic attributes the
+    note was imported with when it was packed (see SeanoDataAggregator.import_note()), which are frozen, because the
+    history the note came from is fully released.
+    '''
+    def __init__(self, path, uid, automatic_attributes, documents):
+        self.path = path
+        self.uid = uid
+        self.automatic_attributes = automatic_attributes
+        self.documents = documents
+
+    def dump(self, db_objs):
+        'Returns the line that stores this note inside a pack file.'
+        return coerce_to_str(json.dumps({
+            'id': self.uid,
+            'file': os.path.relpath(self.path, db_objs).replace('\\', '/'),
+            'automatic-attributes': [{k: sorted(v) if isinstance(v, (set, frozenset)) else v for k, v in x.items()}
+                                     for x in self.automatic_attributes],
+            'documents': self.documents,
+        }, sort_keys=True))
+
+
+class NotePack(object):
+    '''
+    All notes stored inside the pack files of a database.
+
+    Pack files contain one Json object per line: a header ({"seano-pack": NOTE_PACK_FORMAT}), followed by one
+    PackedNote per line, in uid order.  Parsing Json is cheap, so all packs are read up front, with a single open()
+    per pack file.
+    '''
+    def __init__(self, db_objs, pack_files=()):
+        self.db_objs = db_objs
+        self.entries = []
+        self.pack_files = {}  # pack file -> list of PackedNote
+        for filename, data in pack_files:
+            self.pack_files[filename] = self.parse(filename, data)
+            self.entries.extend(self.pack_files[filename])
+        self.by_path = {x.path: x for x in self.entries}
+        self.by_uid = {x.uid: x for x in self.entries}
+
+    @classmethod
+    def from_folder(cls, db_objs, packs_dir):
+        'Reads all pack files inside the given folder.'
+        pack_files = []
+        if os.path.isdir(packs_dir):
+            for name in sorted(os.listdir(packs_dir)):
+                if name.endswith(SEANO_NOTE_PACK_EXTENSION):
+                    with open(os.path.join(packs_dir, name), 'r', **FILE_ENCODING_KWARGS) as f:
+                        pack_files.append((os.path.join(packs_dir, name), f.read()))
+        return cls(db_objs, pack_files)
+
+    def parse(self, filename, data):
+        lines = data.splitlines()
+        try:
+            header = json.loads(lines[0]) if lines else None
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get('seano-pack') != NOTE_PACK_FORMAT:
+            raise SeanoFatalError('Unable to read %s: not a seano note pack, or written by another version of seano'
+                                  % (filename,))
+        result = []
+        for line in lines[1:]:
+            if not line.strip():
+                continue
+            d = json.loads(line)
+            # The Git scanner provides the releases of notes as sets; so do packs:
+            automatic_attributes = [{k: frozenset(v) if k == 'releases' else v for k, v in x.items()}
+                                    for x in d['automatic-attributes']]
+            result.append(PackedNote(os.path.join(self.db_objs, *d['file'].split('/')), d['id'], automatic_attributes,
+                                     d['documents']))
+        return result
+
+    def load(self, filename):
+        'Returns the Yaml documents of the given packed note, or None if the note is not packed.'
+        entry = self.by_path.get(filename)
+        return entry.documents if entry is not None else None
+
+    def write(self, filename, entries):
+        'Writes a pack file containing the given PackedNote objects.'
+        entries = sorted(entries, key=lambda x: x.uid)
+        write_existing_file(filename, '\n'.join([json.dumps({'seano-pack': NOTE_PACK_FORMAT})]
+                                                + [x.dump(self.db_objs) for x in entries]) + '\n')
@@ -5,41 +5,88 @@ As it turns out, sorting a list of releases is hard.
 To improve readability and testability, the algorithm is isolated to here.
 """
 
+from functools import lru_cache
+import heapq
 import itertools
 import logging
 import re
-import sys
 
 log = logging.getLogger(__name__)
 
-if sys.hexversion < 0x3000000:
-    range = xrange
-
 
 alpha_or_numeric_regex = re.compile(r'(\d+|[a-zA-Z]+)')
 numeric_regex = re.compile(r'(\d+)')
+release_prefix_regex = re.compile(r'^[0-9\.]+')
 
+@lru_cache(maxsize=4096)
 def semverish_sort_key(version_string):
     """
     Returns an opaque, comparable value representing the given string.  The
     nuances of the comparable value are engineered to be desirable, assuming
     that the string is some kind of version string.  This algorithm is
     compatible with most common versioning patterns, including SemVer.
+
+    The returned value is a (hashable) tuple.  Results are cached, because the
+    same version strings tend to be sorted over and over again.
     """
     prerelease, _, build = version_string.partition('+')
-    try: release = re.search(r'^[0-9\.]+', prerelease).group(0)
-    except: release = ''
+    m = release_prefix_regex.search(prerelease)
+    release = m.group(0) if m else ''
     prerelease = prerelease[len(release):]
 
-    release    = filter(alpha_or_numeric_regex.match, alpha_or_numeric_regex.split(release))
-    prerelease = filter(alpha_or_numeric_regex.match, alpha_or_numeric_regex.split(prerelease))
-    build      = filter(alpha_or_numeric_regex.match, alpha_or_numeric_regex.split(build))
+    def tokenize(s):
+        return tuple([int(x) if numeric_regex.match(x) else x[0] for x in alpha_or_numeric_regex.findall(s)])
+
+    return (tokenize(release), tokenize(prerelease), tokenize(build))
 
-    release    = [int(x) if numeric_regex.match(x) else x[0] for x in release]
-    prerelease = [int(x) if numeric_regex.match(x) else x[0] for x in prerelease]
-    build      = [int(x) if numeric_regex.match(x) else x[0] for x in build]
 
-    return [release, prerelease, build]
+def semverish_sorted(version_strings, reverse=False):
+    """
+    Returns a new list containing the given version strings, sorted using
+    semverish_sort_key().  The sort key of each distinct string is only
+    computed once, even when the list contains many duplicates.
+    """
+    version_strings = list(version_strings)
+    keys = {x: semverish_sort_key(x) for x in set(version_strings)}
+    return sorted(version_strings, key=keys.__getitem__, reverse=reverse)
+
+
+def get_reachability_closures(release_dicts, bits, key):
+    '''
+    Returns, for each release, the bitset (see the given release name -> bit map) of all the releases reachable by
+    repeatedly following the given ancestry key (`after` for all ancestors; `before` for all descendants).  Computed
+    iteratively, so that long release chains don't hit the recursion limit.
+
+    In a cycle, the closure of the release where the walk entered the cycle is complete, but the closures of the
+    other releases in the cycle may lack some of the releases reachable through it.
+    '''
+    def neighbors(node):
+        return [x['name'] for x in release_dicts[node].get(key, []) if x['name'] in bits]
+
+    result = {}
+    in_progress = set()
+    for root in sorted(release_dicts.keys()):
+        if root in result:
+            continue
+        # Depth-first, post-order, so that the closures of all neighbors are known before they are needed:
+        in_progress.add(root)
+        stack = [(root, iter(neighbors(root)))]
+        while stack:
+            node, todo_neighbors = stack[-1]
+            for x in todo_neighbors:
+                if x not in result and x not in in_progress:
+                    in_progress.add(x)
+                    stack.append((x, iter(neighbors(x))))
+                    break
+            else:
+                stack.pop()
+                in_progress.remove(node)
+                closure = 0
+                for x in neighbors(node):
+                    # (in a cycle, a neighbor may still be in progress; it contributes only itself)
+                    closure |= bits[x] | result.get(x, 0)
+                result[node] = closure
+    return result
 
 
 def sorted_release_names_from_releases(release_dicts):
@@ -53,46 +100,33 @@ def sorted_release_names_from_releases(release_dicts):
     #      everything in order, despite the concept of non-linear graph flattening being
     #      somewhat non-trivial.
 
-    # Keep track of the nodes we have remaining to print:
-    todo = set(release_dicts.keys())
-
-    def list_nodes_eligible_for_printing():
-
-        # Nodes eligible for printing is defined as:
-
-        result = [x for x in todo                           # Any release in todo...
-                  if all([                                      # Where all...
-                          y['name'] not in todo                         # have been printed
-                          for y in release_dicts[x]['before']])]    # of its descendants...
-
+    # Ancestries are analyzed using bitsets: each release is assigned a bit, and a set of releases is the bitwise OR
+    # of their bits.  Unions and membership tests on bitsets are single integer operations, no matter how many
+    # releases there are.
+    bits = {x: 1 << idx for idx, x in enumerate(sorted(release_dicts.keys()))}  # release name -> bit
+
+    _closures = {}
+    def get_closures(key):
+        'Same as get_reachability_closures(), but computed only once per key.'
+        if key not in _closures:
+            _closures[key] = get_reachability_closures(release_dicts, bits, key)
+        return _closures[key]
+
+    def remove_transitive_releases(names):
+        '''
+        Returns the given list of release names, minus the ones that are an ancestor of any other one.
+        '''
+        ancestors = get_closures('after')
+        result = []
+        for candidate in names:
+            others = 0
+            for x in names:
+                if x != candidate:
+                    others |= ancestors[x]
+            if not bits[candidate] & others:
+                result.append(candidate)
         return result
 
-    _ancestors = {}
-    def get_ancestors(node):
-        try:
-            return _ancestors[node]
-        except KeyError:
-            result = set()
-            for r in release_dicts[node]['after']:
-                r = r['name']
-                result.add(r)
-                result = result | get_ancestors(r)
-            _ancestors[node] = result
-            return result
-
-    _descendants = {}
-    def get_descendants(node):
-        try:
-            return _descendants[node]
-        except KeyError:
-            result = set()
-            for r in release_dicts[node]['before']:
-                r = r['name']
-                result.add(r)
-                result = result | get_descendants(r)
-            _descendants[node] = result
-            return result
-
     def human_graph_sort_order(node):
 
         # An edge delta is used to predict which nodes in the graph are the most pleasing
@@ -102,19 +136,11 @@ def sorted_release_names_from_releases(release_dicts):
 
         release = release_dicts[node]
 
-        # List all descendants:
-        before = [x['name'] for x in release['before']]
-        # Remove transitive descendants:
-        for candidate in list(before):
-            if candidate in set().union(*[get_ancestors(x) for x in before if x != candidate]):
-                before.remove(candidate)
+        # List all descendants, and remove transitive descendants:
+        before = remove_transitive_releases([x['name'] for x in release['before']])
 
-        # List all ancestors:
-        after = [x['name'] for x in release['after']]
-        # Remove transitive ancestors:
-        for candidate in list(after):
-            if candidate in set().union(*[get_ancestors(x) for x in after if x != candidate]):
-                after.remove(candidate)
+        # List all ancestors, and remove transitive ancestors:
+        after = remove_transitive_releases([x['name'] for x in release['after']])
 
         # And here's our edge delta:
         edge_delta = len(after) - len(before)
@@ -139,7 +165,7 @@ def sorted_release_names_from_releases(release_dicts):
         # arbitrary and does not have a solid grounding in graph theory, so it may need
         # reworking in the future.  For now, it's a decent way to help keep the sort order
         # stable.
-        num_of_descendants = len(get_descendants(node))
+        num_of_descendants = bin(get_closures('before')[node]).count('1')
         # Make it negative, so that it sorts in the same direction as the edge delta:
         num_of_descendants = 0 - num_of_descendants
 
@@ -147,46 +173,80 @@ def sorted_release_names_from_releases(release_dicts):
 
         return edge_delta, node_index, num_of_descendants
 
+    # This is a Kahn-style topological sort: a release is eligible for printing once all of its descendants have been
+    # printed.  Eligible releases wait in a heap, ordered by human_graph_sort_order(), so that picking the next
+    # release to print never requires re-scanning the releases that remain.
+
+    # Keep track of the nodes we have remaining to print:
+    todo = set(release_dicts.keys())
+
+    # For each release, the number of its descendants that have not been printed yet, and the reverse mapping:
+    num_of_unprinted_descendants = {}
+    waiting_on = {}  # release name -> list of the releases that are waiting for it to be printed
+    for x, release in release_dicts.items():
+        before = [y['name'] for y in release['before'] if y['name'] in todo]
+        num_of_unprinted_descendants[x] = len(before)
+        for y in before:
+            waiting_on.setdefault(y, []).append(x)
+
+    candidates = []  # heap of (sort value, release name)
+    candidates_by_sort_value = {}  # sort value -> set of the names of the candidates with that sort value
+    lone_candidate = []  # a single candidate, while there is no need to compute sort values
+
+    def add_candidate(node):
+        if not candidates and not lone_candidate:
+            lone_candidate.append(node)
+            return
+        for x in lone_candidate + [node]:
+            sort_value = human_graph_sort_order(x)
+            heapq.heappush(candidates, (sort_value, x))
+            candidates_by_sort_value.setdefault(sort_value, set()).add(x)
+        del lone_candidate[:]
+
+    def mark_as_printed(node):
+        todo.remove(node)
+        for x in waiting_on.get(node, []):
+            num_of_unprinted_descendants[x] = num_of_unprinted_descendants[x] - 1
+            if num_of_unprinted_descendants[x] == 0 and x in todo:
+                add_candidate(x)
+
+    for x in sorted(todo):
+        if not num_of_unprinted_descendants[x]:
+            add_candidate(x)
+
     while todo:
 
-        candidates = list_nodes_eligible_for_printing()
+        if lone_candidate:
+            node = lone_candidate.pop()
+            yield node
+            mark_as_printed(node)
+            continue
 
         if not candidates:
             # If we don't have any explicit candidates, then pick a node at random,
             # and warn the user that this is happening.
-            for x in sorted(todo):
-                log.warn('Having trouble flattening ancestry history: %s might be in the wrong position.', x)
-                yield x
-                todo.remove(x)
-                break
+            x = sorted(todo)[0]
+            log.warning('Having trouble flattening ancestry history: %s might be in the wrong position.', x)
+            yield x
+            mark_as_printed(x)
             continue
 
-        if len(candidates) > 1:
-            # If we have more than one candidate, try to sort them.  The human_graph_sort_order()
-            # function (above) tries to generate a sortable value for any given node that we can
-            # use to identify which node is best to print next, but it's not perfect.
-            #
-            # Pre-load the sort order values (because we'll be analyzing them in a moment):
-            candidates = [(c, human_graph_sort_order(c)) for c in candidates]
-
-            # Sort by our magical sort values:
-            candidates.sort(key=lambda x: x[1])
-
-            # Identify duplicate sort values.  Duplicate sort values indicate scenarios where the
-            # sort order function is not smart enough.  When duplicate sort values are found, warn
-            # the user.
-            #
-            # Note that we don't actually care if there are *any* duplicates *anywhere* -- we only
-            # care if there is an N-way tie for first place.
-            nondeterministic_conflicts = [x[0] for x in candidates if x[1] == candidates[0][1]]
-            if len(nondeterministic_conflicts) > 1:
-                log.warn("Having trouble flattening ancestry history: can't decide which of %s should come first." % (
-                         ' or '.join(nondeterministic_conflicts),))
-
-            # Convert the candidates list back to its original schema (strip out the sort values).
-            # We will arbitrarily pick the one at the beginning of the list.
-            candidates = [x[0] for x in candidates]
-
-        # Pick the candidate that is deemed the most desirable by our magical sort algorithm:
-        yield candidates[0]
-        todo.remove(candidates[0])
+        # Pick the candidate that is deemed the most desirable by our magical sort algorithm.  The
+        # human_graph_sort_order() function (above) tries to generate a sortable value for any given node that we
+        # can use to identify which node is best to print next, but it's not perfect.
+        sort_value, node = heapq.heappop(candidates)
+        ties = candidates_by_sort_value.pop(sort_value)
+
+        # Identify duplicate sort values.  Duplicate sort values indicate scenarios where the sort order function is
+        # not smart enough.  When duplicate sort values are found, warn the user.
+        #
+        # Note that we don't actually care if there are *any* duplicates *anywhere* -- we only care if there is an
+        # N-way tie for first place.  Ties are broken by name, so that the result is at least deterministic.
+        if len(ties) > 1:
+            log.warning("Having trouble flattening ancestry history: can't decide which of %s should come first.",
+                        ' or '.join(sorted(ties)))
+            ties.remove(node)
+            candidates_by_sort_value[sort_value] = ties
+
+        yield node
+        mark_as_printed(node)
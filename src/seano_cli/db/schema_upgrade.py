@@ -36,6 +36,12 @@ def upgrade_note_schema(key, value):
         if isinstance(value, set):
             # This is the correct, modern type, but we still have to validate the contents.
             return set([validate_is_string_or_none(x) for x in value])
+        if isinstance(value, frozenset):
+            # Immutable sets are shared between notes (see SeanoDataAggregator.intern_identifier_set()),
+            # so validate the contents, but hand back the very same object to preserve the sharing.
+            for x in value:
+                validate_is_string_or_none(x)
+            return value
         raise SeanoFatalError('unsupported data type for %s list: %s' % (key, value))
     return value
 
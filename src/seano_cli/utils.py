@@ -12,6 +12,7 @@ import os
 import shlex
 import subprocess
 import sys
+import yaml
 
 ascii_str_type = bytes if sys.hexversion >= 0x3000000 else str
 unicode_str_type = str if sys.hexversion >= 0x3000000 else unicode
@@ -19,6 +20,13 @@ unicode_str_type = str if sys.hexversion >= 0x3000000 else unicode
 log = logging.getLogger(__name__)
 FILE_ENCODING_KWARGS = {'encoding': 'utf-8'} if sys.hexversion >= 0x3000000 else {}
 
+# The Yaml loader used for all seano data.  Prefer the libyaml-backed loader when PyYAML was built with it; it yields
+# the same data as the pure-Python loader, only much faster:
+try:
+    from yaml import CFullLoader as SeanoYamlLoader
+except ImportError:
+    from yaml import FullLoader as SeanoYamlLoader
+
 
 class SeanoFatalError(Exception):
     '''
@@ -64,6 +72,13 @@ def coerce_to_unicode_str(s):
     return unicode_str_type(s)
 
 
+def intern_str(s):
+    'Interns the given value if it is a string, so that equal strings share a single object in memory.'
+    if isinstance(s, str):
+        return sys.intern(s)
+    return s
+
+
 def get_unencrypted_shell_input(prompt_text):
     'Fetches a value from the user on the command-line.'
     # ABK: Manually writing the prompt because the stock implementation doesn't write to stderr.
@@ -86,7 +101,7 @@ def write_existing_file(filename, contents):
     except IOError as e:
         if e.errno != errno.ENOENT:
             raise SeanoFatalError("cannot write new file: %s" % (e,))
-    os.makedirs(os.path.dirname(filename))
+    os.makedirs(os.path.dirname(filename), exist_ok=True)  # (other threads may be creating it, too)
     with open(filename, "w", **FILE_ENCODING_KWARGS) as f:
         f.write(contents)
 
@@ -118,6 +133,16 @@ def h_file(*files):
     return m.hexdigest()
 
 
+def h_git_blob(f):
+    'Returns the ID Git would give to the contents of the given file (without applying any of its filters).'
+    with open(f, 'rb') as fh:
+        data = fh.read()
+    m = hashlib.sha1()
+    m.update(coerce_to_ascii_str('blob %d\0' % (len(data),)))
+    m.update(data)
+    return m.hexdigest()
+
+
 def h_folder(*folders):
     def h(f):
         if os.path.isdir(f):
@@ -0,0 +1,29 @@
+# query_test.py
+#
+# Automated unit tests for the seano CLI
+#   - in particular, the serialization of query results
+import io
+import json
+import unittest
+
+from seano_cli.cmd.query_repo import write_query_output
+
+
+class SeanoQueryTest(unittest.TestCase):
+    def testStreamedOutputMatchesJsonDumps(self):
+        data = {
+            'current_version': '1.2.3',
+            'project_name': {'en-US': 'Example'},
+            'zzz': ['after the releases'],
+            'releases': [
+                {'name': '1.2.3', 'notes': [{'id': 'abc', 'foo': 'bär'}], 'before': [], 'after': []},
+                {'name': '1.2.2', 'notes': [], 'before': [], 'after': []},
+            ],
+        }
+        f = io.StringIO()
+        write_query_output(f, dict(data, releases=iter(data['releases'])))
+        self.assertEqual(json.dumps(data, sort_keys=True) + '\n', f.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,360 @@
+# data_aggregator_test.py
+#
+# Automated unit tests for the SeanoDataAggregator class
+#   - in particular, the behavior not easily reachable through a database query
+from seano_cli.db.common import SeanoDataAggregator, load_note_file, load_note_metadata
+from seano_cli.utils import SeanoFatalError
+import os
+import shutil
+import tempfile
+import unittest
+
+rmrf = shutil.rmtree
+
+
+class DataAggregatorTest(unittest.TestCase):
+    maxDiff = None # Always display full diffs, even with large structures
+
+    class TempDir(object):
+        def __enter__(self):
+            self.workdir = tempfile.mkdtemp(prefix='zarf_seano_data_aggregator_test_')
+            return self.workdir
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            rmrf(self.workdir)
+
+    def write_notes(self, workdir, notes):
+        result = {}
+        for uid, data in notes.items():
+            path = os.path.join(workdir, uid + '.yaml')
+            with open(path, 'w') as f:
+                f.write(data)
+            result[uid] = path
+        return result
+
+    def testIdentifierSetsAreShared(self):
+        with self.TempDir() as workdir:
+            paths = self.write_notes(workdir, {
+                'abc': '---\nfoo: bar\n',
+                'def': '---\nfoo: fish\n',
+                'ghi': '---\nreleases: 1.2.3\n',
+            })
+            s = SeanoDataAggregator({'current_version': '1.2.3'})
+            for uid, path in sorted(paths.items()):
+                # Deliberately construct new (equal) strings and sets for every note:
+                s.import_note(path=path, uid=uid, commits=[''.join(['0123', 'abcd'])], releases=set(['1.2.' + '3']))
+
+            abc, def_, ghi = s.notes['abc'], s.notes['def'], s.notes['ghi']
+
+            self.assertIs(abc['releases'], def_['releases'])
+            self.assertIs(abc['commits'], def_['commits'])
+            self.assertIs(abc['commits'], ghi['commits'])
+            # Manually set (on-disk) values are shared, too:
+            self.assertIs(abc['releases'], ghi['releases'])
+
+            # Sharing must not leak into the output:
+            self.assertEqual(['1.2.3'], s.dump()[0]['notes'][0]['releases'])
+
+    def testSharedIdentifierSetsAreNotMutatedByMerges(self):
+        with self.TempDir() as workdir:
+            paths = self.write_notes(workdir, {
+                'abc': '---\nfoo: bar\n',
+                'def': '---\nfoo: fish\n',
+            })
+            s = SeanoDataAggregator({'current_version': '1.2.3'})
+            s.import_note(path=paths['abc'], uid='abc', releases=['1.2.3'])
+            s.import_note(path=paths['def'], uid='def', releases=['1.2.3'])
+            s.import_note(path=paths['def'], uid='def', releases=['1.2.4'])
+
+            self.assertEqual(frozenset(['1.2.3']), s.notes['abc']['releases'])
+            self.assertEqual(frozenset(['1.2.3', '1.2.4']), s.notes['def']['releases'])
+
+    def testIterDumpMatchesDump(self):
+        with self.TempDir() as workdir:
+            paths = self.write_notes(workdir, {
+                'abc': '---\nfoo: bar\n',
+                'def': '---\nreleases: 1.2.2\n',
+                'ghi': '---\nreleases: 1.2.2\nrelative-sort-string: a\n',
+            })
+            s = SeanoDataAggregator({
+                'current_version': '1.2.3',
+                'releases': [
+                    {'name': '1.2.3', 'after': [{'name': '1.2.2', 'is-backstory': True}]},
+                    {'name': '1.2.2'},
+                ],
+            })
+            for uid, path in sorted(paths.items()):
+                s.import_note(path=path, uid=uid)
+
+            releases = s.iter_dump()
+            self.assertFalse(isinstance(releases, list))
+            releases = list(releases)
+            self.assertEqual(s.dump(), releases)
+            self.assertEqual(['1.2.3', '1.2.2'], [x['name'] for x in releases])
+            self.assertEqual([('ghi', True), ('abc', None), ('def', True)],
+                             [(x['id'], x.get('is-copied-from-backstory')) for x in releases[0]['notes']])
+
+    def testIncrementalUpdatesMatchFullReload(self):
+        config = {
+            'current_version': '1.2.3',
+            'releases': [
+                {'name': '1.2.3', 'after': [{'name': '1.2.2', 'is-backstory': True}]},
+                {'name': '1.2.2', 'after': [{'name': '1.2.1'}]},
+                {'name': '1.2.1'},
+            ],
+        }
+        notes = {
+            'abc': '---\nfoo: bar\n',
+            'def': '---\nreleases: 1.2.2\n',
+            'ghi': '---\nreleases: 1.2.1\n',
+        }
+
+        def full_reload(workdir):
+            s = SeanoDataAggregator(config)
+            for uid, path in sorted(self.write_notes(workdir, notes).items()):
+                s.import_note(path=path, uid=uid)
+            return s
+
+        with self.TempDir() as workdir:
+            s = full_reload(workdir)
+            s.dump()
+
+            # Edit a note:
+            notes['abc'] = '---\nfoo: fish\nrelative-sort-string: z\n'
+            path = self.write_notes(workdir, {'abc': notes['abc']})['abc']
+            s.update_note(path, 'abc')
+            self.assertIsNotNone(s.dump_cache)
+            self.assertEqual(full_reload(workdir).dump(), s.dump())
+
+            # Move a note into a backstory:
+            notes['ghi'] = '---\nreleases: 1.2.2\n'
+            path = self.write_notes(workdir, {'ghi': notes['ghi']})['ghi']
+            s.update_note(path, 'ghi')
+            self.assertEqual(full_reload(workdir).dump(), s.dump())
+
+            # Turn the backstory into an ordinary release link, and then back again:
+            s.unlink_releases('1.2.3', '1.2.2')
+            s.link_releases('1.2.3', '1.2.2')
+            self.assertEqual(['1.2.3', '1.2.2', '1.2.1'], [x['name'] for x in s.dump()])
+            self.assertEqual(['abc'], [x['id'] for x in s.dump()[0]['notes']])
+            s.unlink_releases('1.2.3', '1.2.2')
+            s.link_releases('1.2.3', '1.2.2', **{'is-backstory': True})
+            self.assertEqual(['def', 'ghi', 'abc'], [x['id'] for x in s.dump()[0]['notes']])
+            self.assertEqual(full_reload(workdir).dump(), s.dump())
+
+            # Ghost a note:
+            notes['def'] = '---\nx-seano-is-ghost: true\n'
+            path = self.write_notes(workdir, {'def': notes['def']})['def']
+            s.update_note(path, 'def')
+            self.assertEqual(full_reload(workdir).dump(), s.dump())
+
+            # Delete a note:
+            del notes['ghi']
+            os.remove(os.path.join(workdir, 'ghi.yaml'))
+            s.remove_note('ghi')
+            self.assertEqual(full_reload(workdir).dump(), s.dump())
+
+            # Removing an unknown note (or the same note twice) changes nothing:
+            s.remove_note('ghi')
+            s.remove_note('xyz')
+            self.assertIsNotNone(s.dump_cache)
+            self.assertEqual(full_reload(workdir).dump(), s.dump())
+
+            # A dump cache that is out of sync with the notes is dropped, rather than losing other notes:
+            s.dump_cache['notes']['1.2.3'] = [x for x in s.dump_cache['notes']['1.2.3'] if x[3] != 'abc']
+            s.remove_note('abc')
+            self.assertIsNone(s.dump_cache)
+            del notes['abc']
+            os.remove(os.path.join(workdir, 'abc.yaml'))
+            self.assertEqual(full_reload(workdir).dump(), s.dump())
+
+    def testNoteFieldProjection(self):
+        with self.TempDir() as workdir:
+            paths = self.write_notes(workdir, {
+                'abc': '---\nrisk: low\ntickets: [foo]\nrelative-sort-string: b\nlong: blob\n',
+                'def': '---\nrisk: high\nrelative-sort-string: a\n---\nlong: blob\n',
+            })
+            for config, note_fields in [({'query_note_fields': ['risk', 'tickets']}, None),
+                                        ({'query_note_fields': ['long']}, 'risk,tickets'.split(','))]:
+                config['current_version'] = '1.2.3'
+                s = SeanoDataAggregator(config, note_fields=note_fields)
+                for uid, path in sorted(paths.items()):
+                    s.import_note(path=path, uid=uid, commits=['0123abcd'])
+
+                # Unwanted keys are never loaded:
+                self.assertNotIn('long', s.notes['abc'])
+
+                # Notes are still sorted by relative-sort-string, even though it is not output:
+                self.assertEqual([
+                    {'id': 'def', 'commits': ['0123abcd'], 'releases': ['1.2.3'], 'risk': 'high'},
+                    {'id': 'abc', 'commits': ['0123abcd'], 'releases': ['1.2.3'], 'risk': 'low', 'tickets': ['foo']},
+                ], s.dump()[0]['notes'])
+
+    def testNoteFilters(self):
+        with self.TempDir() as workdir:
+            paths = self.write_notes(workdir, {
+                'abc': '---\nrisk: high\n',
+                'def': '---\nrisk: low\n',
+                'ghi.extern-foo': '---\nrisk: high\n',
+                'jkl.extern-bar': 'this file should never be opened: [',
+            })
+            s = SeanoDataAggregator({'current_version': '1.2.3'}, note_fields=['tickets'],
+                                    note_filters=['risk=high', 'x-seano-extern-identifier!=bar'])
+            for uid, path in sorted(paths.items()):
+                if s.accepts_note_file(path):
+                    s.import_note(path=path, uid=uid)
+
+            self.assertEqual([
+                {'id': 'abc', 'releases': ['1.2.3']},
+                {'id': 'ghi.extern-foo', 'releases': ['1.2.3']},
+            ], s.dump()[0]['notes'])
+
+    def testNoteFiltersOnAutomaticKeys(self):
+        with self.TempDir() as workdir:
+            paths = self.write_notes(workdir, {
+                'abc': '---\nrisk: high\n',
+                'def': '---\nrisk: high\n',
+                'ghi': '---\nrisk: low\n',
+                'jkl': '---\nrisk: high\n',
+            })
+            # (The Git scanner imports the same note once per commit that touches it, in no particular order)
+            imports = [
+                ('abc', dict(commits=['c2'], releases=['1.2.3'])),
+                ('def', dict(commits=['c2'], releases=['1.2.3'])),
+                ('ghi', dict(commits=['c1'], releases=['1.2.2'])),
+                ('abc', dict(commits=['c1'], releases=['1.2.2'])),
+                ('ghi', dict(commits=['c2'], releases=['1.2.3'])),
+                ('jkl', {}),
+            ]
+            for order in [imports, list(reversed(imports))]:
+                loaded = []
+                def note_loader(filename):
+                    loaded.append(os.path.basename(filename))
+                    return load_note_file(filename)
+
+                config = {'current_version': '1.2.3', 'parent_versions': ['1.2.2'], 'releases': [{'name': '1.2.2'}]}
+                s = SeanoDataAggregator(config, note_filters=['releases=1.2.2', 'risk=high'], note_loader=note_loader)
+                for uid, info in order:
+                    s.import_note(path=paths[uid], uid=uid, **info)
+
+                # Filters on automatic keys see all automatic attributes, no matter the import order:
+                self.assertEqual([('1.2.3', ['abc']), ('1.2.2', ['abc'])],
+                                 [(x['name'], [y['id'] for y in x['notes']]) for x in s.dump()])
+                self.assertEqual(['1.2.2', '1.2.3'], s.dump()[0]['notes'][0]['releases'])
+                # Notes rejected by other filters are only loaded once:
+                self.assertEqual(['abc.yaml', 'def.yaml', 'ghi.yaml', 'jkl.yaml'], sorted(loaded))
+
+            # Notes without releases are part of the current version:
+            s = SeanoDataAggregator({'current_version': '1.2.3'}, note_filters=['releases=1.2.3'])
+            s.import_note(path=paths['jkl'], uid='jkl')
+            self.assertEqual(['jkl'], [x['id'] for x in s.dump()[0]['notes']])
+
+    def testGhostNotesAreNotParsedFully(self):
+        with self.TempDir() as workdir:
+            paths = self.write_notes(workdir, {
+                'abc': '---\nx-seano-is-ghost: true\n---\nthis document should never be parsed: [\n',
+                'def': '%YAML 1.1\n---\n---\n# comment\nx-seano-relpath-to-original: a/b.yaml\n'
+                       'x-seano-sha1-of-original: cafe\nfoo: |\n  ---x\n...\nthis document should never be parsed: [\n',
+                'ghi': 'foo: bar\n',
+            })
+            s = SeanoDataAggregator({'current_version': '1.2.3'})
+            s.import_note(path=paths['abc'], uid='abc')
+            self.assertEqual({}, s.notes)
+
+            self.assertEqual({'x-seano-is-ghost': True}, load_note_metadata(paths['abc']))
+            self.assertEqual({'x-seano-relpath-to-original': 'a/b.yaml', 'x-seano-sha1-of-original': 'cafe',
+                              'foo': '---x\n'}, load_note_metadata(paths['def']))
+            self.assertEqual({'foo': 'bar'}, load_note_metadata(paths['ghi']))
+
+    def testReleaseWindow(self):
+        with self.TempDir() as workdir:
+            paths = self.write_notes(workdir, {
+                'abc': '---\nreleases: [1.2.1, 1.2.3]\n',
+                'def': '---\nreleases: 1.2.1\n',
+                'ghi': '---\nfoo: bar\n',
+            })
+            s = SeanoDataAggregator({
+                'current_version': '1.3.0',
+                'releases': [
+                    {'name': '1.3.0', 'after': [{'name': '1.2.3'}, {'name': '1.2.2-beta', 'is-backstory': True}]},
+                    {'name': '1.2.2-beta', 'after': [{'name': '1.2.1'}]},
+                    {'name': '1.2.3', 'after': [{'name': '1.2.1'}]},
+                    {'name': '1.2.1'},
+                ],
+            })
+            for uid, path in sorted(paths.items()):
+                s.import_note(path=path, uid=uid)
+
+            self.assertEqual(set(['1.3.0', '1.2.3', '1.2.2-beta']), s.list_release_window(max_releases=3))
+            self.assertEqual(set(['1.3.0', '1.2.3']), s.list_release_window(since_release='1.2.3'))
+            self.assertEqual(set(['1.3.0']), s.list_release_window(since_release='1.2.3', max_releases=1))
+            with self.assertRaises(SeanoFatalError):
+                s.list_release_window(since_release='1.0.0')
+
+            s.truncate_releases(s.list_release_window(since_release='1.2.3'))
+            releases = s.dump()
+            self.assertEqual([
+                ('1.3.0', [], [{'name': '1.2.3'}], ['ghi']),
+                ('1.2.3', [{'name': '1.3.0'}], [], ['abc']),
+            ], [(x['name'], x['before'], x['after'], [y['id'] for y in x['notes']]) for x in releases])
+            self.assertEqual(['1.2.3'], releases[1]['notes'][0]['releases'])
+
+    def testAncestorClosure(self):
+        s = SeanoDataAggregator({
+            'current_version': '1.3.0',
+            'releases': [
+                {'name': '1.3.0', 'after': [{'name': '1.2.3'}, {'name': '1.2.2-beta', 'is-backstory': True}]},
+                {'name': '1.2.2-beta', 'after': [{'name': '1.2.1'}]},
+                {'name': '1.2.3', 'after': [{'name': '1.2.1'}]},
+                {'name': '1.2.1', 'after': [{'name': '1.2.0'}]},
+                {'name': '1.2.0'},
+            ],
+        })
+        self.assertNotIn('ancestor-closure', s.dump()[0])
+
+        releases = s.dump(ancestor_closure=True)
+        names = [x['name'] for x in releases]
+        self.assertEqual(['1.3.0', '1.2.2-beta', '1.2.3', '1.2.1', '1.2.0'], names)
+
+        def decode(release):
+            mask = int(release['ancestor-closure'], 16)
+            return set([x for idx, x in enumerate(names) if mask & (1 << idx)])
+
+        self.assertEqual(set(['1.2.3', '1.2.2-beta', '1.2.1', '1.2.0']), decode(releases[0]))
+        self.assertEqual(set(['1.2.1', '1.2.0']), decode(releases[2]))
+        self.assertEqual(set(['1.2.0']), decode(releases[3]))
+        self.assertEqual(set(), decode(releases[4]))
+        self.assertEqual('0', releases[4]['ancestor-closure'])
+
+    def testAncestorClosureWithCycles(self):
+        # (a release graph with a cycle can't be sorted topologically, so the dump order can't be relied upon)
+        s = SeanoDataAggregator({
+            'current_version': '1.3.0',
+            'releases': [
+                {'name': '1.3.0', 'after': [{'name': '1.2.0'}]},
+                {'name': '1.2.0', 'after': [{'name': '1.1.0'}]},
+                {'name': '1.1.0', 'after': [{'name': '1.2.0'}, {'name': '1.0.0'}]},
+                {'name': '1.0.0', 'after': [{'name': '0.9.0'}]},
+                {'name': '0.9.0'},
+            ],
+        })
+        releases = s.dump(ancestor_closure=True)
+        names = [x['name'] for x in releases]
+
+        def decode(release):
+            mask = int(release['ancestor-closure'], 16)
+            return set([x for idx, x in enumerate(names) if mask & (1 << idx)])
+
+        ancestry = {x['name']: [y['name'] for y in x['after']] for x in releases}
+        for release in releases:
+            expected, todo = set(), list(ancestry[release['name']])
+            while todo:
+                x = todo.pop()
+                if x not in expected:
+                    expected.add(x)
+                    todo.extend(ancestry[x])
+            self.assertEqual(expected, decode(release), release['name'])
+        self.assertEqual(set(['1.2.0', '1.1.0', '1.0.0', '0.9.0']), decode(releases[names.index('1.3.0')]))
+
+if __name__ == '__main__':
+    unittest.main()
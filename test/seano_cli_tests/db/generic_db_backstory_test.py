@@ -23,7 +23,7 @@ class GenericDbBackstoryTest(unittest.TestCase):
         def __exit__(self, exc_type, exc_val, exc_tb):
             rmrf(self.workdir)
 
-    def run_test(self, seano_config_data=None, seano_notes_data=None, check_query=None):
+    def run_test(self, seano_config_data=None, seano_notes_data=None, check_query=None, query_kwargs=None):
         '''
         ABK: This test does not stress the config annex because, conceptually, it's just an
         annex of seano-config.yaml, and for the sake of unit tests, there's no reason to not
@@ -48,12 +48,12 @@ class GenericDbBackstoryTest(unittest.TestCase):
 
             if isinstance(check_query, type) and issubclass(check_query, Exception):
                 try:
-                    query = db.query()
+                    query = db.query(**(query_kwargs or {}))
                 except check_query as e:
                     return # Good (expected) exception
                 self.fail('While opening a GenericSeanoDatabase: expected %s but found %s' % (
                           check_query.__name__, db))
-            query = db.query()
+            query = db.query(**(query_kwargs or {}))
 
             if check_query is not None:
                 check_query(query)
@@ -366,6 +366,67 @@ releases:
         self.run_test(seano_config_data=config, seano_notes_data=notes,
                       check_query=lambda found: self.assertEqual(expected, found))
 
+    def testNormalizedOutput(self):
+        config = '''---
+current_version: 1.2.3
+
+releases:
+- name:  1.2.3
+  after: 1.2.2
+- name:  1.2.2
+  auto-wrap-in-backstory: true
+  after: 1.2.1
+- name:  1.2.1
+'''
+        notes = {
+            '123': '---\nreleases: 1.2.3\n',
+            '456': '---\nreleases: 1.2.2\n',
+            '789': '---\nreleases: 1.2.1\n',
+        }
+        expected = {
+            'current_version': '1.2.3',
+            'notes': {
+                '123': {
+                    'id': '123',
+                    'releases': ['1.2.3'],
+                },
+                '456': {
+                    'id': '456',
+                    'releases': ['1.2.2'],
+                },
+                '789': {
+                    'id': '789',
+                    'releases': ['1.2.1'],
+                },
+            },
+            'releases': [
+                {
+                    'name': '1.2.3',
+                    'before': [],
+                    'after': [{'name': '1.2.1'}, {'name': '1.2.2', 'is-backstory': True}],
+                    'notes': [
+                        {'id': '123'},
+                        {'id': '456', 'is-copied-from-backstory': True},
+                    ],
+                },
+                {
+                    'name': '1.2.2',
+                    'auto-wrap-in-backstory': True,
+                    'before': [{'name': '1.2.3'}],
+                    'after': [{'name': '1.2.1'}],
+                    'notes': [{'id': '456'}],
+                },
+                {
+                    'name': '1.2.1',
+                    'before': [{'name': '1.2.2'}, {'name': '1.2.3'}],
+                    'after': [],
+                    'notes': [{'id': '789'}],
+                },
+            ],
+        }
+        self.run_test(seano_config_data=config, seano_notes_data=notes, query_kwargs={'normalized': True},
+                      check_query=lambda found: self.assertEqual(expected, found))
+
 
 if __name__ == '__main__':
     unittest.main()
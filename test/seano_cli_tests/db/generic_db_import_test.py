@@ -2,13 +2,16 @@
 #
 # Automated unit tests for the GenericSeanoDatabase class
 #   - in particular, the behavior related to importing notes from an extern database
+from seano_cli.constants import SEANO_DB_EXTERN_MANIFEST_SUBDIR
 from seano_cli.db.generic import GenericSeanoDatabase
-from seano_cli.utils import write_existing_file
+from seano_cli.db.note_cache import ExternReferenceResolver
+from seano_cli.utils import SeanoFatalError, write_existing_file
 import os
 import shutil
 import subprocess
 import sys
 import tempfile
+import threading
 import unittest
 
 mkdir = os.mkdir
@@ -30,9 +33,11 @@ def cat_tree(path):
     '''
     Returns a human-readable string describing an entire folder tree on disk.
     Allows us to "assert" that a folder contains the correct data.
+    Extern manifests are left out (see testUnchangedExternDatabasesAreSkipped).
     '''
     result = []
     for root, directories, filenames in os.walk(path):
+        directories[:] = [x for x in directories if x != SEANO_DB_EXTERN_MANIFEST_SUBDIR]
         for f in filenames:
             filepath = os.path.join(root, f)
             # ABK: Deliberately circumventing Python's "Universal Newline" logic
@@ -215,5 +220,158 @@ key: value4
 '''), cat_tree(dstdbp))
 
 
+    def testUnchangedExternDatabasesAreSkipped(self):
+        with self.TempDir() as workdir:
+
+            srcdbp = os.path.join(workdir, 'src')
+            dstdbp = os.path.join(workdir, 'dst')
+
+            fw([srcdbp, 'seano-config.yaml'], '---\n')
+            fw([srcdbp, 'v1', 'abc.yaml'], '---\nkey: value1\n')
+            fw([srcdbp, 'v1', 'def.yaml'], '---\nkey: value2\n')
+
+            fw([dstdbp, 'seano-config.yaml'], '---\n')
+            mkdir(os.path.join(dstdbp, 'v1'))
+
+            def open_db():
+                db = GenericSeanoDatabase(dstdbp)
+                return db
+
+            db = open_db()
+            self.assertEqual(['A', 'A'], [x for x, _ in db.import_extern_notes(False, [('s', srcdbp)])])
+            manifest = db.read_extern_manifest('s')
+            self.assertEqual(['abc', 'def'], sorted(manifest['notes'].keys()))
+            self.assertEqual({'original': '../src/v1/abc.yaml', 'local': 'v1/ab/c.extern-s.yaml', 'ghost': False},
+                             {k: v for k, v in manifest['notes']['abc'].items() if k in ['original', 'local', 'ghost']})
+
+            # Nothing changed; no note is even looked at:
+            def explode(*args, **kwargs):
+                raise AssertionError('Unexpectedly imported a note')
+            db = open_db()
+            db.import_extern_note = explode
+            self.assertEqual([], db.import_extern_notes(False, [('s', srcdbp)]))
+
+            # Only changed notes are imported; local copies matching the manifest are not read:
+            fw([srcdbp, 'v1', 'def.yaml'], '---\nkey: value3\n')
+            fw([srcdbp, 'v1', 'ghi.yaml'], '---\nkey: value4\n')
+            os.remove(os.path.join(srcdbp, 'v1', 'abc.yaml'))
+            db = open_db()
+            self.assertEqual([('A', os.path.join(dstdbp, 'v1', 'gh', 'i.extern-s.yaml')),
+                              ('D', os.path.join(dstdbp, 'v1', 'ab', 'c.extern-s.yaml')),
+                              ('M', os.path.join(dstdbp, 'v1', 'de', 'f.extern-s.yaml'))],
+                             sorted(db.import_extern_notes(False, [('s', srcdbp)])))
+            self.assertEqual(['def', 'ghi'], sorted(db.read_extern_manifest('s')['notes'].keys()))
+
+            # Local copies that changed are re-checked:
+            db = open_db()
+            db.ghost_note(os.path.join(dstdbp, 'v1', 'de', 'f.extern-s.yaml'), False)
+            os.remove(os.path.join(dstdbp, 'v1', 'gh', 'i.extern-s.yaml'))
+            self.assertEqual([('A', os.path.join(dstdbp, 'v1', 'gh', 'i.extern-s.yaml'))],
+                             db.import_extern_notes(False, [('s', srcdbp)]))
+            self.assertTrue(db.read_extern_manifest('s')['notes']['def']['ghost'])
+
+    def testReferenceStyleImport(self):
+        with self.TempDir() as workdir:
+
+            srcdbp = os.path.join(workdir, 'src')
+            copydbp = os.path.join(workdir, 'copy')
+            refdbp = os.path.join(workdir, 'ref')
+
+            fw([srcdbp, 'seano-config.yaml'], '---\n')
+            fw([srcdbp, 'v1', 'abc.yaml'], '---\nkey: value1\n---\nother: value2\n')
+            fw([srcdbp, 'v1', 'def.yaml'], '---\nkey: value3\n')
+            for path in [copydbp, refdbp]:
+                fw([path, 'seano-config.yaml'], '---\n')
+                mkdir(os.path.join(path, 'v1'))
+
+            def open_db(path):
+                db = GenericSeanoDatabase(path)
+                resolver_cache_file = os.path.join(workdir, 'extern-notes.pickle')
+                db.open_extern_resolver = lambda note_cache=False: \
+                    ExternReferenceResolver(path, resolver_cache_file if note_cache else None)
+                return db
+
+            open_db(copydbp).import_extern_notes(False, [('s', srcdbp)])
+            db = open_db(refdbp)
+            self.assertEqual(['A', 'A'], [x for x, _ in db.import_extern_notes(False, [('s', srcdbp)], as_reference=True)])
+
+            # Originals are only cached when asked to:
+            self.assertFalse(os.path.exists(os.path.join(workdir, 'extern-notes.pickle')))
+            db = open_db(refdbp)
+            self.assertEqual([], db.import_extern_notes(False, [('s', srcdbp)], as_reference=True, note_cache=True))
+            self.assertTrue(os.path.exists(os.path.join(workdir, 'extern-notes.pickle')))
+
+            # Only a reference to the original is stored; the query result is the same as with a complete copy:
+            with open(os.path.join(refdbp, 'v1', 'ab', 'c.extern-s.yaml'), 'r') as f:
+                data = f.read()
+            self.assertIn('x-seano-extern-reference: true\n', data)
+            self.assertNotIn('value1', data)
+            expected = open_db(copydbp).query()
+            self.assertEqual(expected, open_db(refdbp).query())
+            self.assertEqual(expected, open_db(refdbp).query(note_cache=True))
+
+            # References never silently resolve to a different version of the original:
+            with open(os.path.join(srcdbp, 'v1', 'def.yaml'), 'r') as f:
+                original = f.read()
+            fw([srcdbp, 'v1', 'def.yaml'], '---\nkey: changed\n')
+            with self.assertRaises(SeanoFatalError):
+                open_db(refdbp).query()
+            fw([srcdbp, 'v1', 'def.yaml'], original)
+
+            # Originals are cached by sha1, so references resolve even if the extern database is gone:
+            rmrf(srcdbp)
+            self.assertEqual(expected, open_db(refdbp).query(note_cache=True))
+            with self.assertRaises(SeanoFatalError):
+                open_db(refdbp).query()
+
+            # Ghosting works the same way as with complete copies:
+            db = open_db(refdbp)
+            db.ghost_note(os.path.join(refdbp, 'v1', 'de', 'f.extern-s.yaml'), False)
+            self.assertEqual(['value1'], [x['key'] for x in db.query(note_cache=True)['releases'][0]['notes']])
+
+    def testThreadedImportIntoSharedShardFolders(self):
+        with self.TempDir() as workdir:
+
+            dstdbp = os.path.join(workdir, 'dst')
+            fw([dstdbp, 'seano-config.yaml'], '---\n')
+            mkdir(os.path.join(dstdbp, 'v1'))
+            db_defs = []
+            for extern_id in ['s1', 's2', 's3', 's4']:
+                srcdbp = os.path.join(workdir, extern_id)
+                fw([srcdbp, 'seano-config.yaml'], '---\n')
+                for uid in ['abc', 'abd', 'abe', 'xyz']:
+                    fw([srcdbp, 'v1', uid + '.yaml'], '---\nkey: %s\n' % (uid,))
+                db_defs.append((extern_id, srcdbp))
+
+            # Local copies of notes from all extern databases share the same (new) shard folders:
+            result = GenericSeanoDatabase(dstdbp).import_extern_notes(False, db_defs, jobs=16)
+            self.assertEqual(16, len([x for x, _ in result if x == 'A']))
+            self.assertEqual(sorted(['ab', 'xy']), sorted(os.listdir(os.path.join(dstdbp, 'v1'))))
+
+            # Make every thread create the same folder at the same time:
+            barrier = threading.Barrier(8, timeout=10)
+            original_makedirs = os.makedirs
+            def makedirs(*args, **kwargs):
+                barrier.wait()
+                return original_makedirs(*args, **kwargs)
+            errors = []
+            def write(i):
+                try:
+                    write_existing_file(os.path.join(workdir, 'new', '%d.yaml' % (i,)), '---\n')
+                except Exception as e:
+                    errors.append(e)
+            os.makedirs = makedirs
+            try:
+                threads = [threading.Thread(target=write, args=(i,)) for i in range(8)]
+                for x in threads:
+                    x.start()
+                for x in threads:
+                    x.join()
+            finally:
+                os.makedirs = original_makedirs
+            self.assertEqual([], errors)
+            self.assertEqual(8, len(os.listdir(os.path.join(workdir, 'new'))))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -3,6 +3,7 @@
 # Automated unit tests for the GenericSeanoDatabase class
 #   - in particular, the behavior related to querying a database
 from seano_cli.db.generic import GenericSeanoDatabase
+import json
 import os
 import shutil
 import tempfile
@@ -441,5 +442,65 @@ releases:
         self.run_test(seano_config_data=config, check_query=lambda found: self.assertEqual(expected, found))
 
 
+    def testNoteIndex(self):
+        with self.TempDir() as workdir:
+            with open(os.path.join(workdir, 'seano-config.yaml'), 'w') as f:
+                f.write('---\ncurrent_version: 1.2.3\n')
+            for path in [['ab', 'c.yaml'], ['ab', 'd.extern-foo.yaml'], ['ab', 'readme.txt'], ['ef', 'gh', 'i.yaml'],
+                         ['ef', 'j.extern-bar.yaml']]:
+                folder = os.path.join(workdir, 'v1', *path[:-1])
+                if not os.path.isdir(folder):
+                    os.makedirs(folder)
+                with open(os.path.join(folder, path[-1]), 'w') as f:
+                    f.write('---\nfoo: bar\n')
+
+            db = GenericSeanoDatabase(path=workdir)
+            walked = [os.path.join(root, f) for root, _, filenames in os.walk(db.db_objs) for f in filenames
+                      if f.endswith('.yaml')]
+            index = db.get_note_index()
+            self.assertEqual(walked, [x.path for x in index.entries])
+            self.assertEqual([db.extract_uid_from_filename(x) for x in walked], [x.uid for x in index.entries])
+            self.assertEqual(['abc', 'abd', 'efghi', 'efj'], sorted(index.by_uid.keys()))
+            self.assertEqual([os.path.join(db.db_objs, 'ab', 'd.extern-foo.yaml')], db.get_notes_with_extern_id('foo'))
+            self.assertEqual([], db.get_notes_with_extern_id('baz'))
+            self.assertIs(index, db.get_note_index())
+
+            # Creating a note invalidates the index:
+            uid = db.extract_uid_from_filename(db.make_new_note())
+            self.assertIn(uid, db.get_note_index().by_uid)
+
+    def testJsonNotes(self):
+        with self.TempDir() as workdir:
+            with open(os.path.join(workdir, 'seano-config.yaml'), 'w') as f:
+                f.write('---\ncurrent_version: 1.2.3\n')
+            for path, data in [(['ab', 'c.yaml'], '---\nrisk: low\ntickets: [foo]\n'),
+                               (['de', 'f.yaml'], '---\n# A comment\nrisk: high\nemployee-short-loc-hlist-md:\n'
+                                                  '  en-US:\n  - Did a thing\n'),
+                               (['gh', 'i.yaml'], '---\nrisk: low\n---\nrisk: high\n'),
+                               (['jk', 'l.extern-foo.yaml'], '---\nrisk: medium\n')]:
+                os.makedirs(os.path.join(workdir, 'v1', path[0]))
+                with open(os.path.join(workdir, 'v1', *path), 'w') as f:
+                    f.write(data)
+
+            db = GenericSeanoDatabase(path=workdir)
+            expected = db.query()
+            self.assertEqual([('D', os.path.join(db.db_objs, 'ab', 'c.yaml')),
+                              ('A', os.path.join(db.db_objs, 'ab', 'c.json')),
+                              ('D', os.path.join(db.db_objs, 'de', 'f.yaml')),
+                              ('A', os.path.join(db.db_objs, 'de', 'f.json'))],
+                             db.convert_notes(sorted(db.get_note_index().by_path), 'json', False))
+            with open(os.path.join(db.db_objs, 'ab', 'c.json'), 'r') as f:
+                self.assertEqual({'risk': 'low', 'tickets': ['foo']}, json.load(f))
+
+            # Json notes have the same uid and contents as the Yaml notes they came from:
+            self.assertEqual(['abc', 'def', 'ghi', 'jkl'], sorted(db.get_note_index().by_uid.keys()))
+            self.assertEqual(expected, db.query())
+            self.assertEqual(expected, GenericSeanoDatabase(path=workdir).query(jobs=2))
+            self.assertEqual([os.path.join(db.db_objs, 'ab', 'c.json')], db.get_notes_matching_pattern('abc', False)[0])
+
+            # ... and back:
+            self.assertEqual(4, len(db.convert_notes(sorted(db.get_note_index().by_path), 'yaml', False)))
+            self.assertEqual(expected, db.query())
+
 if __name__ == '__main__':
     unittest.main()
@@ -4,6 +4,8 @@
 #   - in particular, the behavior related to querying a database
 from seano_cli.db.git import GitSeanoDatabase
 from seano_cli.utils import SeanoFatalError, coerce_to_str, write_existing_file
+import seano_cli.db.git as git_module
+import seano_cli.db.note_cache as note_cache_module
 import errno
 import os
 import shutil
@@ -367,6 +369,464 @@ parent_versions:
                 ],
             })
 
+            # Parsing notes in parallel does not change the result:
+            db = GitSeanoDatabase(path=workdir)
+            self.assertEqual(db.query(), db.query(jobs=2))
+
+    def testReleaseWindow(self):
+        with self.TempDir() as workdir:
+            setup_repo(workdir)
+            putfile(os.path.join(workdir, 'seano-config.yaml'), '''---
+current_version: 1.2.4d1
+''')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            shcall(['git', 'tag', 'v1.2.1'], cwd=workdir)
+
+            # A bounded query must never parse notes outside of the window:
+            putfile(os.path.join(workdir, 'v1', 'abc.yaml'), 'this file should never be opened: [')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            shcall(['git', 'tag', 'v1.2.2'], cwd=workdir)
+
+            putfile(os.path.join(workdir, 'v1', 'def.yaml'), '---\nfoo: fish\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            shcall(['git', 'tag', 'v1.2.3'], cwd=workdir)
+            commit_123 = shgeto(['git', 'rev-parse', 'HEAD'], cwd=workdir)
+
+            putfile(os.path.join(workdir, 'v1', 'ghi.yaml'), '---\nfoo: cat\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            commit_head = shgeto(['git', 'rev-parse', 'HEAD'], cwd=workdir)
+
+            expected = {
+                'current_version': '1.2.4d1',
+                'releases': [
+                    {
+                        'name': '1.2.4d1',
+                        'commit': commit_head,
+                        'before': [],
+                        'after': [{'name': '1.2.3'}],
+                        'notes': [
+                            {
+                                'id': 'ghi',
+                                'commits': [commit_head],
+                                'releases': ['1.2.4d1'],
+                                'foo': 'cat',
+                            },
+                        ],
+                    },
+                    {
+                        'name': '1.2.3',
+                        'commit': commit_123,
+                        'before': [{'name': '1.2.4d1'}],
+                        'after': [],
+                        'notes': [
+                            {
+                                'id': 'def',
+                                'commits': [commit_123],
+                                'releases': ['1.2.3'],
+                                'foo': 'fish',
+                            },
+                        ],
+                    },
+                ],
+            }
+            db = GitSeanoDatabase(path=workdir)
+            self.assertEqual(expected, db.query(since_release='1.2.3'))
+            self.assertEqual(expected, db.query(max_releases=2))
+            self.assertEqual(expected, db.query(since_release='1.2.3', max_releases=5))
+
+    def testNonlinearReleaseWindow(self):
+        with self.TempDir() as workdir:
+            setup_repo(workdir)
+            putfile(os.path.join(workdir, 'seano-config.yaml'), '---\ncurrent_version: 2.0.0d1\n')
+
+            def commit(uid, data=None, tag=None):
+                putfile(os.path.join(workdir, 'v1', uid + '.yaml'), data or '---\nfoo: %s\n' % (uid,))
+                shcall(['git', 'add', '-A', '.'], cwd=workdir)
+                shcall(['git', 'commit', '-m', uid], cwd=workdir)
+                if tag:
+                    shcall(['git', 'tag', tag], cwd=workdir)
+
+            # The topic branch is scanned before the trunk, but sorts after it:
+            commit('def', data='---\nreleases: [1.1.0]\nfoo: def\n')
+            commit('abc', data='---\nfoo: "releases: not a key"\n', tag='v1.0.0')
+            shcall(['git', 'checkout', '-b', 'topic'], cwd=workdir)
+            commit('ghi', tag='v1.0.1')
+            commit('jkl', tag='v1.0.2')
+            shcall(['git', 'checkout', 'master'], cwd=workdir)
+            commit('mno', tag='v1.1.0')
+            shcall(['git', 'merge', '--no-ff', 'topic', '-m', 'merge'], cwd=workdir)
+            commit('pqr')
+
+            db = GitSeanoDatabase(path=workdir)
+            for max_releases in range(1, 6):
+                s = db.aggregate()
+                s.truncate_releases(s.list_release_window(max_releases=max_releases))
+                self.assertEqual(db.make_query_result(s, db.config), db.query(max_releases=max_releases))
+
+            # Notes created before the window that move themselves into the window are included:
+            self.assertEqual([('2.0.0d1', ['pqr']), ('1.1.0', ['def', 'mno'])],
+                             [(x['name'], [y['id'] for y in x['notes']]) for x in db.query(max_releases=2)['releases']])
+            self.assertEqual([('2.0.0d1', ['pqr']), ('1.1.0', ['def', 'mno'])],
+                             [(x['name'], [y['id'] for y in x['notes']])
+                              for x in db.query(since_release='1.1.0')['releases']])
+
+            # Only notes that mention releases are parsed, and only notes that set them have their history searched:
+            calls = []
+            def spy(name, func):
+                def wrapper(path, *args, **kwargs):
+                    calls.append((name, os.path.basename(path)))
+                    return func(path, *args, **kwargs)
+                return wrapper
+            originals = git_module.may_override_releases, git_module.note_sets_own_releases
+            git_module.may_override_releases = spy('read', originals[0])
+            git_module.note_sets_own_releases = spy('parse', originals[1])
+            try:
+                db = GitSeanoDatabase(path=workdir)
+                db.find_note_creating_commit = spy('log', db.find_note_creating_commit)
+                db.query(max_releases=2)
+                self.assertEqual([('log', 'def.yaml'), ('parse', 'abc.yaml'), ('parse', 'def.yaml')], sorted(calls))
+
+                # Notes that differ from the index are searched one by one:
+                del calls[:]
+                putfile(os.path.join(workdir, 'v1', 'ghi.yaml'), '---\nfoo: ghi2\n')
+                db = GitSeanoDatabase(path=workdir)
+                db.find_note_creating_commit = spy('log', db.find_note_creating_commit)
+                db.query(max_releases=2)
+                self.assertEqual([('log', 'def.yaml'), ('parse', 'abc.yaml'), ('parse', 'def.yaml'),
+                                  ('read', 'ghi.yaml')], sorted(calls))
+            finally:
+                git_module.may_override_releases, git_module.note_sets_own_releases = originals
+
+    def testFindNoteReleases(self):
+        with self.TempDir() as workdir:
+            setup_repo(workdir)
+            putfile(os.path.join(workdir, 'seano-config.yaml'), '''---
+current_version: 1.2.3d1
+''')
+            putfile(os.path.join(workdir, 'v1', 'ab', 'c.yaml'), '---\nfoo: bar\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            shcall(['git', 'tag', 'v1.2.1'], cwd=workdir)
+
+            putfile(os.path.join(workdir, 'v1', 'de', 'f.yaml'), '---\nfoo: fish\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            shcall(['git', 'tag', 'v1.2.2b1'], cwd=workdir)
+
+            # Renames are followed:
+            shcall(['git', 'mv', os.path.join('v1', 'ab', 'c.yaml'), os.path.join('v1', 'ab', 'cd.yaml')], cwd=workdir)
+            putfile(os.path.join(workdir, 'v1', 'gh', 'i.yaml'), '---\nfoo: cat\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            shcall(['git', 'tag', 'v1.2.2'], cwd=workdir)
+
+            putfile(os.path.join(workdir, 'v1', 'jk', 'l.yaml'), '---\nfoo: bird\n')
+            putfile(os.path.join(workdir, 'v1', 'mn', 'o.yaml'), '---\nx-seano-is-ghost: true\n')
+
+            db = GitSeanoDatabase(path=workdir)
+            self.assertEqual([('1.2.1', False)], db.find_note_releases(os.path.join(db.db_objs, 'ab', 'cd.yaml')))
+            self.assertEqual([('1.2.2', True), ('1.2.2b1', False)],
+                             db.find_note_releases(os.path.join(db.db_objs, 'de', 'f.yaml')))
+            self.assertEqual([('1.2.2', False)], db.find_note_releases(os.path.join(db.db_objs, 'gh', 'i.yaml')))
+            self.assertEqual([('1.2.3d1', False)], db.find_note_releases(os.path.join(db.db_objs, 'jk', 'l.yaml')))
+            self.assertEqual([], db.find_note_releases(os.path.join(db.db_objs, 'mn', 'o.yaml')))
+
+            # Same answers as a full query:
+            for release in db.query()['releases']:
+                for note in release['notes']:
+                    self.assertIn((release['name'], note.get('is-copied-from-backstory', False)),
+                                  db.find_note_releases(db.make_note_filename_from_uid(note['id'])))
+
+            # Converting a note to Json does not change the releases it belongs to, committed or not:
+            db.convert_notes([os.path.join(db.db_objs, 'ab', 'cd.yaml'), os.path.join(db.db_objs, 'gh', 'i.yaml')],
+                             'json', False)
+            for cmd in [None, ['git', 'commit', '-m', 'wip']]:
+                if cmd:
+                    shcall(['git', 'add', '-A', os.path.join('v1', 'ab'), os.path.join('v1', 'gh')], cwd=workdir)
+                    shcall(cmd, cwd=workdir)
+                db = GitSeanoDatabase(path=workdir)
+                self.assertEqual([('1.2.1', False)],
+                                 db.find_note_releases(os.path.join(db.db_objs, 'ab', 'cd.json')))
+                self.assertEqual([('1.2.2', False)], db.find_note_releases(os.path.join(db.db_objs, 'gh', 'i.json')))
+
+    def testQuerySnapshots(self):
+        with self.TempDir() as workdir:
+            setup_repo(workdir)
+            putfile(os.path.join(workdir, 'seano-config.yaml'), '''---
+current_version: 1.2.3d1
+''')
+            putfile(os.path.join(workdir, 'v1', 'abc.yaml'), '---\nfoo: bar\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            shcall(['git', 'tag', 'v1.2.1'], cwd=workdir)
+            commit_121 = shgeto(['git', 'rev-parse', 'HEAD'], cwd=workdir)
+
+            putfile(os.path.join(workdir, 'v1', 'abc.yaml'), '---\nfoo: BAR\n')
+            putfile(os.path.join(workdir, 'v1', 'def.yaml'), '---\nfoo: fish\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            shcall(['git', 'tag', 'v1.2.2'], cwd=workdir)
+            commit_122 = shgeto(['git', 'rev-parse', 'HEAD'], cwd=workdir)
+
+            putfile(os.path.join(workdir, 'v1', 'ghi.yaml'), '---\nfoo: cat\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+
+            db = GitSeanoDatabase(path=workdir)
+            results = db.query_snapshots([('v1.2.1', '1.2.2d1'), ('v1.2.2', '1.2.2'), ('HEAD', '1.2.3d1')])
+
+            def summarize(result):
+                return (result['current_version'],
+                        [(x['name'], x['commit'], [y['name'] for y in x['after']],
+                          [(y['id'], y['foo']) for y in x['notes']]) for x in result['releases']])
+
+            # Notes are read as of each snapshot:
+            self.assertEqual(('1.2.2d1', [
+                ('1.2.2d1', commit_121, ['1.2.1'], []),
+                ('1.2.1', commit_121, [], [('abc', 'bar')]),
+            ]), summarize(results[0]))
+            self.assertEqual(('1.2.2', [
+                ('1.2.2', commit_122, ['1.2.1'], [('def', 'fish')]),
+                ('1.2.1', commit_121, [], [('abc', 'BAR')]),
+            ]), summarize(results[1]))
+            self.assertEqual(db.query(), results[2])
+
+            # Parallel parsing and the note cache (cold, then warm) do not change the result:
+            for _ in range(2):
+                self.assertEqual(results, db.query_snapshots([('v1.2.1', '1.2.2d1'), ('v1.2.2', '1.2.2'),
+                                                              ('HEAD', '1.2.3d1')], jobs=2, note_cache=True))
+
+            # Note fields and filters apply to each snapshot:
+            filtered = db.query_snapshots([('v1.2.2', '1.2.2'), ('HEAD', '1.2.3d1')], note_fields=['id'],
+                                          note_filters=['foo!=fish'])
+            self.assertEqual([[('1.2.2', []), ('1.2.1', ['abc'])], [('1.2.3d1', ['ghi']), ('1.2.2', []), ('1.2.1', ['abc'])]],
+                             [[(x['name'], [y['id'] for y in x['notes'] if 'foo' not in y]) for x in r['releases']]
+                              for r in filtered])
+            self.assertEqual(db.query(note_fields=['id'], note_filters=['foo!=fish']), filtered[1])
+
+            with self.assertRaises(SeanoFatalError):
+                db.query_snapshots([('v9.9.9', '9.9.9')])
+
+    def testNoteCache(self):
+        with self.TempDir() as workdir:
+            setup_repo(workdir)
+            putfile(os.path.join(workdir, 'seano-config.yaml'), '---\ncurrent_version: 1.2.3d1\n')
+            putfile(os.path.join(workdir, 'v1', 'ab', 'c.yaml'), '---\nfoo: bar\n')
+            putfile(os.path.join(workdir, 'v1', 'de', 'f.yaml'), '---\nfoo: fish\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            shcall(['git', 'tag', 'v1.2.2'], cwd=workdir)
+            putfile(os.path.join(workdir, 'v1', 'de', 'f.yaml'), '---\nfoo: cat\r\nbar: |\r\n  x\r\n  y\r\n')
+            putfile(os.path.join(workdir, 'v1', 'gh', 'i.yaml'), '---\nfoo: bird\n')
+
+            db = GitSeanoDatabase(path=workdir)
+            expected = db.query()
+            self.assertEqual(expected, db.query(note_cache=True))
+
+            # Blobs are cached by ID, in the Git common directory:
+            cache = db.open_note_cache()
+            self.assertTrue(cache.cache_file.startswith(os.path.join(workdir, '.git')))
+            blob_ids = [shgeto(['git', 'hash-object', os.path.join('v1', x)], cwd=workdir)
+                        for x in [os.path.join('ab', 'c.yaml'), os.path.join('de', 'f.yaml'), os.path.join('gh', 'i.yaml')]]
+            self.assertEqual(sorted(blob_ids), sorted(cache.entries.keys()))
+            self.assertEqual([os.path.join(db.db_objs, 'ab', 'c.yaml')], list(cache.blob_ids.keys()))
+
+            # Now that everything is cached, no note needs to be parsed:
+            def explode(filename):
+                raise AssertionError('Unexpectedly parsed %s' % (filename,))
+            original_load_note_file = note_cache_module.load_note_file
+            note_cache_module.load_note_file = explode
+            try:
+                self.assertEqual(expected, db.query(note_cache=True))
+            finally:
+                note_cache_module.load_note_file = original_load_note_file
+
+    def testImportFromGitlink(self):
+        with self.TempDir() as workdir:
+            libdir = os.path.join(workdir, 'lib')
+            appdir = os.path.join(workdir, 'app')
+            mkdir(libdir)
+            mkdir(appdir)
+
+            setup_repo(libdir)
+            putfile(os.path.join(libdir, '.seano'), 'seano-db: ./docs/seano-db\n')
+            putfile(os.path.join(libdir, 'docs', 'seano-db', 'seano-config.yaml'), '---\n')
+            putfile(os.path.join(libdir, 'docs', 'seano-db', 'v1', 'ab', 'c.yaml'), '---\nfoo: bar\r\n')
+            putfile(os.path.join(libdir, 'docs', 'seano-db', 'v1', 'de', 'f.yaml'), '---\nfoo: fish\n')
+            shcall(['git', 'add', '-A', '.'], cwd=libdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=libdir)
+
+            setup_repo(appdir)
+            putfile(os.path.join(appdir, 'seano-config.yaml'), '---\ncurrent_version: 1.0.0\n')
+            mkdir(os.path.join(appdir, 'v1'))
+            shcall(['git', '-c', 'protocol.file.allow=always', 'submodule', 'add', libdir, 'lib'], cwd=appdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=appdir)
+
+            # Newer commits in the submodule are not imported until the gitlink is updated:
+            putfile(os.path.join(libdir, 'docs', 'seano-db', 'v1', 'gh', 'i.yaml'), '---\nfoo: bird\n')
+            shcall(['git', 'add', '-A', '.'], cwd=libdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=libdir)
+
+            # The submodule does not need to be checked out:
+            shcall(['git', 'submodule', 'deinit', '-f', 'lib'], cwd=appdir)
+            self.assertFalse(os.path.exists(os.path.join(appdir, 'lib', '.seano')))
+
+            db = GitSeanoDatabase(path=appdir)
+            self.assertEqual([('A', os.path.join(db.db_objs, 'ab', 'c.extern-lib.yaml')),
+                              ('A', os.path.join(db.db_objs, 'de', 'f.extern-lib.yaml'))],
+                             sorted(db.import_extern_notes(False, [('lib', os.path.join(appdir, 'lib'))],
+                                                           from_gitlink=True)))
+            with open(os.path.join(db.db_objs, 'ab', 'c.extern-lib.yaml'), 'r') as f:
+                data = f.read()
+            self.assertIn('x-seano-relpath-to-original: lib/docs/seano-db/v1/ab/c.yaml\n', data)
+            self.assertTrue(data.endswith('\n---\nfoo: bar\n'))
+            self.assertEqual(['bar', 'fish'], sorted([x['foo'] for x in db.query()['releases'][0]['notes']]))
+            self.assertEqual([], db.import_extern_notes(False, [('lib', os.path.join(appdir, 'lib'))],
+                                                        from_gitlink=True))
+
+            with self.assertRaises(SeanoFatalError):
+                db.import_extern_notes(False, [('x', os.path.join(appdir, 'v1'))], from_gitlink=True)
+
+    def testThreadedExternImport(self):
+        with self.TempDir() as workdir:
+            libdir = os.path.join(workdir, 'lib')
+            appdir = os.path.join(workdir, 'app')
+            putfile(os.path.join(libdir, 'seano-config.yaml'), '---\n')
+            # (notes share shard folders, which are created by whichever thread gets there first)
+            uids = ['%02xabc%02d' % (i % 4, i) for i in range(40)]
+            for uid in uids:
+                putfile(os.path.join(libdir, 'v1', uid[:2], uid[2:] + '.yaml'), '---\nfoo: %s\n' % (uid,))
+
+            mkdir(appdir)
+            setup_repo(appdir)
+            putfile(os.path.join(appdir, 'seano-config.yaml'), '---\ncurrent_version: 1.0.0\n')
+            putfile(os.path.join(appdir, 'v1', 'zz', 'z.yaml'), '---\nfoo: local\n')
+            shcall(['git', 'add', '-A', '.'], cwd=appdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=appdir)
+
+            db = GitSeanoDatabase(path=appdir)
+            self.assertEqual(['zzz'], [x.uid for x in db.get_note_index().entries])
+
+            git_adds = []
+            original_check_call = subprocess.check_call
+            def check_call(args, **kwargs):
+                if args[:2] == ['git', 'add']:
+                    git_adds.append(args)
+                return original_check_call(args, **kwargs)
+            subprocess.check_call = check_call
+            try:
+                result = db.import_extern_notes(False, [('lib', libdir)], jobs=8)
+            finally:
+                subprocess.check_call = original_check_call
+
+            expected_files = sorted([os.path.join(db.db_objs, uid[:2], uid[2:] + '.extern-lib.yaml') for uid in uids])
+            self.assertEqual([('A', x) for x in expected_files], sorted(result))
+
+            # All new notes (and the new manifest) are marked as intent-to-add at once:
+            manifest_file = os.path.join(appdir, 'extern-manifests', 'lib.json')
+            self.assertEqual(1, len(git_adds))
+            self.assertEqual(sorted(expected_files + [manifest_file]), sorted(git_adds[0][4:]))
+            staged = shgeto(['git', 'ls-files', '--', 'v1'], cwd=appdir).splitlines()
+            self.assertEqual(sorted([os.path.relpath(x, appdir).replace('\\', '/') for x in expected_files]
+                                    + ['v1/zz/z.yaml']), sorted(staged))
+
+            # The note index is refreshed once the import is finished:
+            self.assertEqual(sorted(uids + ['zzz']), sorted([x.uid for x in db.get_note_index().entries]))
+            self.assertEqual(sorted(uids + ['zzz']), sorted([n['id'] for n in db.query()['releases'][0]['notes']]))
+
+            # The manifest is committed along with the notes; fresh clones skip the unchanged extern database, too:
+            shcall(['git', 'commit', '-a', '-m', 'wip'], cwd=appdir)
+            shcall(['git', 'clone', '-q', appdir, os.path.join(workdir, 'clone')], cwd=workdir)
+            def explode(*args, **kwargs):
+                raise AssertionError('Unexpectedly imported a note')
+            db = GitSeanoDatabase(path=os.path.join(workdir, 'clone'))
+            db.import_extern_note = explode
+            self.assertEqual([], db.import_extern_notes(False, [('lib', libdir)]))
+
+    def testJsonNoteConversionTracking(self):
+        with self.TempDir() as workdir:
+            setup_repo(workdir)
+            putfile(os.path.join(workdir, 'seano-config.yaml'), '---\ncurrent_version: 1.2.3\n')
+            putfile(os.path.join(workdir, 'v1', 'ab', 'c.yaml'), '---\nfoo: bar\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            shcall(['git', 'tag', 'v1.2.2'], cwd=workdir)
+            putfile(os.path.join(workdir, 'v1', 'de', 'f.yaml'), '---\nfoo: fish\n')
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+
+            def notes_per_release(query):
+                return [(r['name'], [(n['id'], n['commits'], n['foo']) for n in r['notes']]) for r in query['releases']]
+
+            db = GitSeanoDatabase(path=workdir)
+            expected = notes_per_release(db.query())
+            self.assertEqual(4, len(db.convert_notes(sorted(db.get_note_index().by_path), 'json', False)))
+
+            # Converting a note is not considered to be the creation of a new note, committed or not:
+            self.assertEqual(expected, notes_per_release(GitSeanoDatabase(path=workdir).query()))
+            shcall(['git', 'add', '-A', '.'], cwd=workdir)
+            self.assertEqual(expected, notes_per_release(GitSeanoDatabase(path=workdir).query()))
+            shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+            self.assertEqual(expected, notes_per_release(GitSeanoDatabase(path=workdir).query()))
+
+    def testPackedNotes(self):
+        with self.TempDir() as workdir:
+            setup_repo(workdir)
+            putfile(os.path.join(workdir, 'seano-config.yaml'), '---\ncurrent_version: 1.2.0\n')
+            for version, uids in [('1.0.0', ['abc', 'abd']), ('1.1.0', ['def']), (None, ['ghi'])]:
+                for uid in uids:
+                    putfile(os.path.join(workdir, 'v1', uid[:2], uid[2:] + '.yaml'), '---\nfoo: %s\n' % (uid,))
+                shcall(['git', 'add', '-A', '.'], cwd=workdir)
+                shcall(['git', 'commit', '-m', 'wip'], cwd=workdir)
+                if version:
+                    shcall(['git', 'tag', 'v' + version], cwd=workdir)
+            first_commit = shgeto(['git', 'rev-list', '--max-parents=0', 'HEAD'], cwd=workdir)
+
+            def summarize(query):
+                return [(r['name'], [(n['id'], n['commits'], n['foo']) for n in r['notes']]) for r in query['releases']]
+
+            db = GitSeanoDatabase(path=workdir)
+            expected = summarize(db.query())
+            expected_snapshot = summarize(db.query_snapshots([('v1.1.0', '1.1.0')])[0])
+            expected_window = summarize(db.query(since_release='1.0.0'))
+            packs_dir = os.path.join(workdir, 'packs')
+            self.assertEqual([('A', os.path.join(packs_dir, '1.0.0.jsonl')),
+                              ('D', os.path.join(db.db_objs, 'ab', 'c.yaml')),
+                              ('D', os.path.join(db.db_objs, 'ab', 'd.yaml'))],
+                             sorted(db.pack_notes('1.1.0', False)))
+            self.assertEqual(['1.0.0.jsonl'], os.listdir(packs_dir))
+
+            # Packed notes are read transparently, committed or not:
+            for cmd in [None, ['git', 'add', '-A', '.'], ['git', 'commit', '-m', 'pack']]:
+                if cmd:
+                    shcall(cmd, cwd=workdir)
+                db = GitSeanoDatabase(path=workdir)
+                self.assertEqual(expected, summarize(db.query()))
+                self.assertEqual(expected, summarize(db.query(note_cache=True, jobs=2)))
+            self.assertEqual(expected_snapshot, summarize(db.query_snapshots([('v1.1.0', '1.1.0')])[0]))
+            self.assertEqual(expected_window, summarize(db.query(since_release='1.0.0')))
+
+            # Packed notes are still addressable by ID and by commit:
+            packed_file = os.path.join(db.db_objs, 'ab', 'c.yaml')
+            self.assertEqual([packed_file], db.get_notes_matching_pattern('abc', False)[0])
+            self.assertEqual(sorted([packed_file, os.path.join(db.db_objs, 'ab', 'd.yaml')]),
+                             sorted(db.get_notes_matching_pattern(first_commit, False)[0]))
+            self.assertEqual([('1.0.0', False)], db.find_note_releases(packed_file))
+            self.assertFalse(db.is_ghost(packed_file))
+
+            # Packing again adds to the existing packs:
+            self.assertEqual([], db.pack_notes('1.1.0', False))
+            self.assertEqual([('A', os.path.join(packs_dir, '1.1.0.jsonl')),
+                              ('D', os.path.join(db.db_objs, 'de', 'f.yaml'))],
+                             sorted(db.pack_notes('1.2.0', False)))
+            self.assertEqual(expected, summarize(GitSeanoDatabase(path=workdir).query()))
+            with self.assertRaises(SeanoFatalError):
+                db.pack_notes('9.9.9', False)
+
     def testNoteRenameOneWayTracking(self):
         with self.TempDir() as workdir:
             setup_repo(workdir)
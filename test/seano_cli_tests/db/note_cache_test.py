@@ -0,0 +1,79 @@
+# note_cache_test.py
+#
+# Automated unit tests for the NoteCache class
+from seano_cli.db.generic import GenericSeanoDatabase
+from seano_cli.db.note_cache import NoteCache
+import os
+import shutil
+import tempfile
+import unittest
+
+rmrf = shutil.rmtree
+
+
+class NoteCacheTest(unittest.TestCase):
+    maxDiff = None # Always display full diffs, even with large structures
+
+    class TempDir(object):
+        def __enter__(self):
+            self.workdir = tempfile.mkdtemp(prefix='zarf_seano_note_cache_test_')
+            return self.workdir
+
+        def __exit__(self, exc_type, exc_val, exc_tb):
+            rmrf(self.workdir)
+
+    def write_note(self, path, data, mtime=1000000000):
+        with open(path, 'r+' if os.path.exists(path) else 'w') as f:
+            f.seek(0)
+            f.write(data)
+            f.truncate()
+        # Pretend the note was written long ago, so that it is not considered racy:
+        os.utime(path, (mtime, mtime))
+
+    def testUnchangedNotesAreNotParsed(self):
+        with self.TempDir() as workdir:
+            note = os.path.join(workdir, 'abc.yaml')
+            cache_file = os.path.join(workdir, 'cache', 'notes.pickle')
+            self.write_note(note, '---\nrisk: low\ntickets: foo\n')
+
+            cache = NoteCache(cache_file, workdir)
+            self.assertEqual([{'risk': 'low', 'tickets': set(['foo'])}], cache.load(note))
+            cache.save()
+            self.assertTrue(os.path.exists(cache_file))
+
+            # Same size, mtime and inode; if the file was parsed again, the parser would explode:
+            self.write_note(note, '---\nrisk: [[[[[\n[[[[[[[[[[\n')
+            cache = NoteCache(cache_file, workdir)
+            self.assertEqual([{'risk': 'low', 'tickets': set(['foo'])}], cache.load(note))
+
+            # A different mtime invalidates the entry:
+            self.write_note(note, '---\nrisk: highhh\ntickets: []\n', mtime=1000000001)
+            self.assertEqual([{'risk': 'highhh', 'tickets': set()}], cache.load(note))
+
+            # Entries of deleted notes are dropped:
+            os.remove(note)
+            cache = NoteCache(cache_file, workdir)
+            cache.save()
+            self.assertEqual({}, NoteCache(cache_file, workdir).entries)
+
+    def testCachedQueryMatchesUncachedQuery(self):
+        with self.TempDir() as workdir:
+            with open(os.path.join(workdir, 'seano-config.yaml'), 'w') as f:
+                f.write('---\ncurrent_version: 1.2.3\n')
+            os.mkdir(os.path.join(workdir, 'v1'))
+            for uid, data in [('abc', '---\nrisk: low\n'), ('def', '---\nreleases: 1.2.3\ntickets: [foo]\n')]:
+                self.write_note(os.path.join(workdir, 'v1', uid + '.yaml'), data)
+
+            db = GenericSeanoDatabase(path=workdir)
+            cache_file = os.path.join(workdir, 'cache', 'notes.pickle')
+            db.open_note_cache = lambda: NoteCache(cache_file, db.path)
+
+            expected = db.query()
+            self.assertEqual(expected, db.query(note_cache=True))
+            self.assertEqual(2, len(NoteCache(cache_file, workdir).entries))
+            self.assertEqual(expected, db.query(note_cache=True))
+            self.assertEqual(expected, db.query(note_cache=True, jobs=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,39 @@
+# note_filter_test.py
+#
+# Automated unit tests for the note filters used by `seano query --where`
+from seano_cli.db.note_filter import NoteFilter
+from seano_cli.utils import SeanoFatalError
+import unittest
+
+
+class NoteFilterTest(unittest.TestCase):
+    def testExistence(self):
+        self.assertTrue(NoteFilter('tickets').matches({'tickets': set(['foo'])}))
+        self.assertFalse(NoteFilter('tickets').matches({'tickets': set()}))
+        self.assertFalse(NoteFilter('tickets').matches({}))
+        self.assertTrue(NoteFilter('!tickets').matches({}))
+
+    def testEquality(self):
+        self.assertTrue(NoteFilter('risk=high').matches({'risk': 'high'}))
+        self.assertFalse(NoteFilter('risk=high').matches({'risk': 'low'}))
+        self.assertFalse(NoteFilter('risk=high').matches({}))
+        self.assertTrue(NoteFilter('risk!=high').matches({}))
+        self.assertTrue(NoteFilter('risk != high').matches({'risk': 'low'}))
+
+    def testTypedEquality(self):
+        self.assertTrue(NoteFilter('x-seano-is-ghost=true').matches({'x-seano-is-ghost': True}))
+        self.assertFalse(NoteFilter('x-seano-is-ghost=true').matches({'x-seano-is-ghost': 1}))
+        self.assertTrue(NoteFilter('priority=3').matches({'priority': 3}))
+        self.assertTrue(NoteFilter('name=3').matches({'name': '3'}))
+
+    def testMembership(self):
+        self.assertTrue(NoteFilter('tickets=foo').matches({'tickets': set(['foo', 'bar'])}))
+        self.assertFalse(NoteFilter('tickets=baz').matches({'tickets': ['foo', 'bar']}))
+
+    def testInvalidExpression(self):
+        self.assertRaises(SeanoFatalError, lambda: NoteFilter('=foo'))
+        self.assertRaises(SeanoFatalError, lambda: NoteFilter(''))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+# release_sorting_test.py
+#
+# Automated unit tests for the release sorting logic in seano
+from seano_cli.db.release_sorting import semverish_sort_key, semverish_sorted, sorted_release_names_from_releases
+import unittest
+
+
+def make_release_dicts(links):
+    '''
+    Builds a doubly-linked release graph from a dictionary of release name -> list of names of its parents.
+    '''
+    result = {x: {'name': x, 'before': [], 'after': []} for x in links.keys()}
+    for name, parents in links.items():
+        for parent in parents:
+            result[name]['after'].append({'name': parent})
+            result[parent]['before'].append({'name': name})
+    return result
+
+
+class ReleaseSortingTest(unittest.TestCase):
+    def testSemverishSortKey(self):
+        self.assertEqual(((1, 2, 3), ('b', 4), (5,)), semverish_sort_key('1.2.3beta4+5'))
+        self.assertEqual(hash(semverish_sort_key('1.2.3')), hash(((1, 2, 3), (), ())))
+        versions = ['1.10.0', '1.2.3', '1.2.3rc1', '1.2', '1.2.3b2', '1.2.3b10', '1.2.3', '1.2.3+build.1']
+        expected = ['1.2', '1.2.3', '1.2.3', '1.2.3+build.1', '1.2.3b2', '1.2.3b10', '1.2.3rc1', '1.10.0']
+        self.assertEqual(expected, sorted(versions, key=semverish_sort_key))
+        self.assertEqual(expected, semverish_sorted(versions))
+        self.assertEqual(list(reversed(expected)), semverish_sorted(versions, reverse=True))
+
+    def testLinearHistory(self):
+        releases = make_release_dicts({'1.0': [], '1.1': ['1.0'], '1.2': ['1.1'], '2.0': ['1.2']})
+        self.assertEqual(['2.0', '1.2', '1.1', '1.0'], list(sorted_release_names_from_releases(releases)))
+
+    def testTrunkLineageComesFirst(self):
+        # 1.2 merges the 1.1.1 topic lineage (second parent) into the trunk (first parent):
+        releases = make_release_dicts({'1.0': [], '1.1': ['1.0'], '1.1.1': ['1.1'], '1.1.2': ['1.1.1'],
+                                       '1.2a': ['1.1'], '1.2': ['1.2a', '1.1.2']})
+        self.assertEqual(['1.2', '1.1.2', '1.1.1', '1.2a', '1.1', '1.0'],
+                         list(sorted_release_names_from_releases(releases)))
+
+    def testLongHistory(self):
+        # Much deeper than the recursion limit, with two heads, so that sort values have to be computed:
+        links = {'%05d' % (x,): ['%05d' % (x - 1,)] if x else [] for x in range(5000)}
+        links['hotfix'] = ['04000']
+        names = list(sorted_release_names_from_releases(make_release_dicts(links)))
+        self.assertEqual(['04999', '04998'], names[:2])
+        self.assertEqual(['04001', 'hotfix', '04000'], names[998:1001])
+        self.assertEqual('00000', names[-1])
+
+    def testTiesAreBrokenByName(self):
+        releases = make_release_dicts({'b': [], 'c': [], 'a': []})
+        with self.assertLogs('seano_cli.db.release_sorting', level='WARNING') as logs:
+            self.assertEqual(['a', 'b', 'c'], list(sorted_release_names_from_releases(releases)))
+        self.assertIn("can't decide which of a or b or c should come first", logs.output[0])
+
+    def testCycles(self):
+        releases = make_release_dicts({'a': ['b'], 'b': ['a'], 'c': ['a']})
+        with self.assertLogs('seano_cli.db.release_sorting', level='WARNING') as logs:
+            self.assertEqual(['c', 'a', 'b'], list(sorted_release_names_from_releases(releases)))
+        self.assertIn('a might be in the wrong position', logs.output[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
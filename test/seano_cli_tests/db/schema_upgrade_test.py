@@ -1,8 +1,10 @@
 # schema_upgrade_test.py
 #
 # Automated unit tests for the schema upgrading logic in seano
-from seano_cli.db.schema_upgrade import upgrade_note_schema
+from seano_cli.db.schema_upgrade import upgrade_note_schema, upgrade_root_object_schema
+from seano_cli.utils import SeanoYamlLoader
 import unittest
+import yaml
 
 
 class SchemaUpgradeTest(unittest.TestCase):
@@ -12,6 +14,28 @@ class SchemaUpgradeTest(unittest.TestCase):
         # Data already formatted as loc-md:
         self.assertEqual({'en-US': 'foo'}, upgrade_note_schema('sample-loc-md', {'en-US': 'foo'}))
 
+    def testYamlLoaderMatchesPurePythonLoader(self):
+        text = '''---
+current_version: 1.2.3
+parent_versions: 1.2.2
+releases:
+- name: 1.2.2
+  after: [1.2.1]
+  date: 2020-01-02
+  shipped: 2020-01-02 03:04:05
+  delta: 1.5
+  count: 0x10
+  public: yes
+  notes: ~
+- name: 1.2.1
+---
+'''
+        expected = [upgrade_root_object_schema(d) for d in yaml.load_all(text, Loader=yaml.FullLoader) if d]
+        actual = [upgrade_root_object_schema(d) for d in yaml.load_all(text, Loader=SeanoYamlLoader) if d]
+        self.assertEqual(expected, actual)
+        self.assertEqual([type(x) for x in expected[0]['releases'][0].values()],
+                         [type(x) for x in actual[0]['releases'][0].values()])
+
 
 if __name__ == '__main__':
     unittest.main()